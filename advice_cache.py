@@ -0,0 +1,94 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class AdviceCache:
+    """AI助言の応答キャッシュ。
+
+    キーはモデル名・システムプロンプト・睡眠データ・プロフィールのハッシュなので、
+    記録や助言が変わればキーも変わり、古い応答が返ることはない。
+    メモリ上のLRUと、advice_cache テーブル（TTLと件数上限つき）の2段構成。
+    """
+
+    def __init__(self, db_manager, max_memory_entries=64, max_disk_entries=500,
+                 ttl_seconds=7 * 24 * 60 * 60):
+        self.db_manager = db_manager
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_entries = max_disk_entries
+        self.ttl_seconds = ttl_seconds
+        self._memory = OrderedDict()  # key -> (advice, created_at)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(model, system_prompt, sleep_data, user_profile):
+        profile_fields = {k: v for k, v in (user_profile or {}).items() if k != 'id'}
+        payload = json.dumps(
+            [model, system_prompt, sleep_data, profile_fields],
+            ensure_ascii=False, sort_keys=True, default=str
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        now = int(time.time())
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                advice, created_at = entry
+                if now - created_at < self.ttl_seconds:
+                    self._memory.move_to_end(key)
+                    return advice
+                del self._memory[key]
+
+        result = self.db_manager.execute_query(
+            "SELECT advice, created_at FROM advice_cache WHERE key = ? AND created_at > ?",
+            (key, now - self.ttl_seconds)
+        )
+        if not result:
+            return None
+        advice, created_at = result[0]
+        self.db_manager.execute_query(
+            "UPDATE advice_cache SET last_used_at = ? WHERE key = ?", (now, key)
+        )
+        self._remember(key, advice, created_at)
+        return advice
+
+    def put(self, key, advice):
+        now = int(time.time())
+        self._remember(key, advice, now)
+        try:
+            with self.db_manager.transaction():
+                self.db_manager.execute_query(
+                    '''INSERT OR REPLACE INTO advice_cache (key, advice, created_at, last_used_at)
+                       VALUES (?, ?, ?, ?)''',
+                    (key, advice, now, now)
+                )
+                self._evict(now)
+        except sqlite3.Error:
+            # 書き込めなくても助言そのものは返せるので、メモリ上のキャッシュだけで続ける
+            pass
+
+    def _remember(self, key, advice, created_at):
+        with self._lock:
+            self._memory[key] = (advice, created_at)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_memory_entries:
+                self._memory.popitem(last=False)
+
+    def _evict(self, now):
+        self.db_manager.execute_query(
+            "DELETE FROM advice_cache WHERE created_at <= ?", (now - self.ttl_seconds,)
+        )
+        self.db_manager.execute_query(
+            '''DELETE FROM advice_cache WHERE key IN
+               (SELECT key FROM advice_cache ORDER BY last_used_at DESC LIMIT -1 OFFSET ?)''',
+            (self.max_disk_entries,)
+        )
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+        self.db_manager.execute_query("DELETE FROM advice_cache")
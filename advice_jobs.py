@@ -0,0 +1,111 @@
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class AdviceJob:
+    def __init__(self, future):
+        self.future = future
+        self._cancelled = threading.Event()
+
+    def cancel(self):
+        # 実行中のAPI呼び出しは中断できないので、完了しても結果を捨てるように印を付ける
+        self._cancelled.set()
+        self.future.cancel()
+
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def done(self):
+        return self.future.done()
+
+
+class AdviceJobExecutor:
+    """AI助言の生成などの重い処理をワーカースレッドで実行し、結果をTkのメインスレッドに戻す。
+
+    完了したジョブはキューに入れ、メインスレッド側で master.after によるポーリングで
+    取り出してコールバックを呼ぶ。Tkのウィジェットにはメインスレッド以外から触れない。
+    """
+
+    def __init__(self, master, max_workers=2, poll_interval=50):
+        self.master = master
+        self.poll_interval = poll_interval
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="advice")
+        self._completed = queue.Queue()
+        self._pending = 0
+        self._polling = False
+
+    def submit(self, func, *args, on_success=None, on_error=None, **kwargs):
+        future = self._pool.submit(func, *args, **kwargs)
+        job = AdviceJob(future)
+        self._pending += 1
+        future.add_done_callback(lambda f: self._completed.put((job, on_success, on_error)))
+        self._schedule_poll()
+        return job
+
+    def _schedule_poll(self):
+        if not self._polling:
+            self._polling = True
+            self.master.after(self.poll_interval, self._poll)
+
+    def _poll(self):
+        self._polling = False
+        while True:
+            try:
+                job, on_success, on_error = self._completed.get_nowait()
+            except queue.Empty:
+                break
+            self._pending -= 1
+            self._dispatch(job, on_success, on_error)
+        if self._pending > 0:
+            self._schedule_poll()
+
+    def _dispatch(self, job, on_success, on_error):
+        if job.cancelled() or job.future.cancelled():
+            return
+        error = job.future.exception()
+        if error is not None:
+            if on_error:
+                on_error(error)
+            else:
+                print(f"バックグラウンド処理でエラーが発生しました: {error}")
+            return
+        if on_success:
+            on_success(job.future.result())
+
+    def shutdown(self, wait=False):
+        self._pool.shutdown(wait=wait, cancel_futures=True)
+
+
+class AdviceStreamCancelled(Exception):
+    pass
+
+
+class AdviceStream:
+    """ワーカースレッドが受け取ったトークンを溜め、メインスレッドがまとめて取り出すためのバッファ。"""
+
+    def __init__(self):
+        self._chunks = []
+        self._lock = threading.Lock()
+        self._cancelled = threading.Event()
+        self.closed = False
+
+    def append(self, text):
+        # キャンセル後は例外で生成ループを抜け、残りのトークンを受信しない
+        if self._cancelled.is_set():
+            raise AdviceStreamCancelled()
+        with self._lock:
+            self._chunks.append(text)
+
+    def drain(self):
+        with self._lock:
+            text = "".join(self._chunks)
+            self._chunks = []
+        return text
+
+    def close(self):
+        self.closed = True
+
+    def cancel(self):
+        self._cancelled.set()
+        self.closed = True
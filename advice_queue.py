@@ -0,0 +1,181 @@
+import json
+import random
+import threading
+import time
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class AdviceQueued(Exception):
+    """API呼び出しに失敗し、助言のリクエストを再試行キューに保存したことを表す。"""
+
+    def __init__(self, job_id):
+        super().__init__(f"advice request queued as job {job_id}")
+        self.job_id = job_id
+
+
+class CircuitBreaker:
+    """連続して失敗したエンドポイントへの呼び出しを一定時間止める。
+
+    closed: 通常どおり呼び出す / open: 呼び出さずに失敗させる /
+    half_open: reset_timeout 経過後に1件だけ試し、成功すれば closed に戻す。
+    """
+
+    def __init__(self, failure_threshold=3, reset_timeout=60, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = None
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow_request(self):
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and self.clock() - self.opened_at >= self.reset_timeout:
+                self.state = "half_open"
+            if self.state == "half_open" and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+            self.opened_at = None
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._probe_in_flight = False
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                self.state = "open"
+                self.opened_at = self.clock()
+
+    def call(self, func, *args, **kwargs):
+        if not self.allow_request():
+            raise CircuitOpenError("AI endpoint is temporarily disabled after repeated failures")
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            self.record_failure()
+            raise
+        self.record_success()
+        return result
+
+
+class RetryPolicy:
+    def __init__(self, base_delay=30, max_delay=6 * 60 * 60, max_attempts=10, rng=None):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self.rng = rng or random.Random()
+
+    def next_delay(self, attempts):
+        # 指数バックオフに揺らぎ（上限の半分〜上限）を加え、復旧直後に再試行が集中しないようにする
+        ceiling = min(self.max_delay, self.base_delay * (2 ** max(attempts - 1, 0)))
+        return ceiling / 2 + self.rng.uniform(0, ceiling / 2)
+
+
+class OfflineAdviceQueue:
+    """送信に失敗したAI助言のリクエストを advice_jobs テーブルに保存し、後で再送する。
+
+    send は messages を受け取って助言の文字列を返す関数、on_complete は
+    (target, advice) を受け取り結果を保存する関数。どちらもワーカースレッドから呼ばれる。
+    on_complete はジョブを完了にするのと同じトランザクションの中で呼ぶので、同じ connection_manager の
+    transaction() で書き込めば保存と完了がまとめてコミットされる。
+    """
+
+    def __init__(self, connection_manager, send, on_complete, breaker=None, policy=None,
+                 clock=time.time):
+        self.connection_manager = connection_manager
+        self.send = send
+        self.on_complete = on_complete
+        self.breaker = breaker or CircuitBreaker()
+        self.policy = policy or RetryPolicy()
+        self.clock = clock
+        self._drain_lock = threading.Lock()
+
+    def enqueue(self, target, messages, error=None):
+        now = self.clock()
+        with self.connection_manager.transaction() as conn:
+            cursor = conn.execute(
+                '''INSERT INTO advice_jobs
+                   (target, messages, status, attempts, next_attempt_at, last_error, created_at, updated_at)
+                   VALUES (?, ?, 'pending', 0, ?, ?, ?, ?)''',
+                (json.dumps(target, ensure_ascii=False), json.dumps(messages, ensure_ascii=False),
+                 now + self.policy.next_delay(1), str(error) if error else None, now, now)
+            )
+        return cursor.lastrowid
+
+    def pending_count(self):
+        conn = self.connection_manager.get_connection()
+        return conn.execute("SELECT COUNT(*) FROM advice_jobs WHERE status = 'pending'").fetchone()[0]
+
+    def has_due_jobs(self):
+        conn = self.connection_manager.get_connection()
+        row = conn.execute(
+            "SELECT 1 FROM advice_jobs WHERE status = 'pending' AND next_attempt_at <= ? LIMIT 1",
+            (self.clock(),)
+        ).fetchone()
+        return row is not None
+
+    def drain(self, limit=20):
+        """期限が来たジョブを古い順に再送し、完了した (target, advice) のリストを返す。
+
+        ブレーカーが開いている間は何もしない。1件でも失敗したら残りは次回に回す。
+        """
+        if not self._drain_lock.acquire(blocking=False):
+            return []
+        completed = []
+        try:
+            conn = self.connection_manager.get_connection()
+            jobs = conn.execute(
+                '''SELECT id, target, messages, attempts FROM advice_jobs
+                   WHERE status = 'pending' AND next_attempt_at <= ?
+                   ORDER BY next_attempt_at LIMIT ?''',
+                (self.clock(), limit)
+            ).fetchall()
+            for job_id, target, messages, attempts in jobs:
+                try:
+                    advice = self.breaker.call(self.send, json.loads(messages))
+                except CircuitOpenError:
+                    break
+                except Exception as e:
+                    self._record_failure(job_id, attempts + 1, e)
+                    break
+                target = json.loads(target)
+                try:
+                    # 保存と完了の記録を1つのトランザクションにし、同じ助言を二度保存しないようにする
+                    with self.connection_manager.transaction() as conn:
+                        self.on_complete(target, advice)
+                        conn.execute(
+                            "UPDATE advice_jobs SET status = 'done', attempts = ?, updated_at = ? WHERE id = ?",
+                            (attempts + 1, self.clock(), job_id)
+                        )
+                except Exception as e:
+                    self._record_failure(job_id, attempts + 1, e)
+                    break
+                completed.append((target, advice))
+        finally:
+            self._drain_lock.release()
+        return completed
+
+    def _record_failure(self, job_id, attempts, error):
+        now = self.clock()
+        status = 'failed' if attempts >= self.policy.max_attempts else 'pending'
+        with self.connection_manager.transaction() as conn:
+            conn.execute(
+                '''UPDATE advice_jobs
+                   SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ?, updated_at = ?
+                   WHERE id = ?''',
+                (status, attempts, now + self.policy.next_delay(attempts + 1), str(error), now, job_id)
+            )
+        print(f"AI助言の再送に失敗しました（{attempts}回目）: {error}")
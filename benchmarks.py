@@ -0,0 +1,389 @@
+"""保存・読み込み・助言生成の処理時間を計測するベンチマーク。
+
+数年分の日記を data2.db と以前の不眠症アプリの sleep_data.db に作り、主な処理を繰り返し実行して
+中央値などを出す。sleep_data.db は storage_migrator で共通のストレージに取り込む時間も測る。AIの助言はローカルのモックサーバー（mock_chat_server）に送るので、
+本物のAPIは使わない。結果はJSONで書き出し、前回の結果と比べられる。
+
+    python benchmarks.py --years 3 --latency 0.2 --json bench.json
+    python benchmarks.py --compare bench.json --max-regression 1.3
+"""
+import argparse
+import contextlib
+import importlib.util
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+
+from checklist_catalog import BAD, CATALOG, IMPROVED, PRACTICED
+from mock_chat_server import MockChatServer
+from schema_migrations import SLEEP_DATA_MIGRATIONS, migrate
+from sleep_time_utils import format_duration
+from storage_migrator import StorageMigrator
+
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+DATA2_APP = "睡眠改善支援アプリ2.py"
+CBT_APP = "不眠症 認知行動療法 支援アプリ.py"
+
+PREPARATIONS = [
+    "ぬるめのお風呂に入った", "ストレッチをした", "スマートフォンを寝る1時間前にやめた",
+    "ハーブティーを飲んだ", "読書をした", "部屋の照明を暗くした", "",
+]
+REFLECTIONS = [
+    "夜中に一度目が覚めたが、すぐに眠れた", "ホテルに泊まったので寝付きが悪かった",
+    "夕方にカフェインを摂ったせいか眠りが浅かった", "朝すっきり起きられた",
+    "仕事のことを考えて不安になった", "時計を何度も見てしまった", "いつもより早く眠れた",
+    "外泊で環境が違って緊張した", "",
+]
+REPLY = "記録を拝見しました。起床時刻を一定に保つことから始めてみると、変化があるかも知れません。"
+
+PROFILE = {
+    'id': 1,
+    'nickname': "ベンチマーク",
+    'sleep_medication': "使用していない",
+    'medication_reduction': "該当なし",
+    'advice_intensity': "ライト",
+}
+
+
+def load_app(filename, module_name):
+    # アプリのファイル名は日本語と空白を含むので、パスを指定して読み込む
+    spec = importlib.util.spec_from_file_location(module_name, os.path.join(REPO_DIR, filename))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class DiaryGenerator:
+    """それらしい毎晩の記録を作る。就寝時刻・睡眠時間は正規分布、週末は遅め、1割ほど記録のない夜がある。"""
+
+    def __init__(self, seed=0):
+        self.rng = random.Random(seed)
+
+    def nights(self, start_date, end_date, skip_rate=0.1):
+        day = start_date
+        while day <= end_date:
+            if self.rng.random() >= skip_rate:
+                yield self.night(day)
+            day += timedelta(days=1)
+
+    def night(self, wake_date):
+        rng = self.rng
+        weekend = wake_date.weekday() >= 5
+        bedtime = datetime.combine(wake_date - timedelta(days=1), datetime.min.time()) + timedelta(
+            minutes=23 * 60 + 15 + rng.gauss(0, 40) + (45 if weekend else 0)
+        )
+        latency = max(0, int(rng.gauss(20, 15)))
+        awake = max(0, int(rng.gauss(15, 15)))
+        time_in_bed = int(min(600, max(180, rng.gauss(420, 60))))
+        wake_time = bedtime + timedelta(minutes=time_in_bed)
+        quality = min(5, max(1, round((time_in_bed - latency - awake) / 90 + rng.gauss(0, 0.8))))
+        return {
+            'wake_date': wake_time.date(),
+            'sleep_time': bedtime.replace(microsecond=0),
+            'wake_time': wake_time.replace(microsecond=0),
+            'satisfaction': quality,
+            'quality': min(5, max(1, quality + rng.choice((-1, 0, 0, 1)))),
+            'dissatisfaction': 6 - quality,
+            'anxiety': min(5, max(1, 6 - quality + rng.choice((-1, 0, 1)))),
+            'latency': latency,
+            'awake': awake,
+            'preparation': rng.choice(PREPARATIONS),
+            'reflection': rng.choice(REFLECTIONS),
+            'checklist': [item for item in CATALOG.items if rng.random() < 0.15],
+        }
+
+
+def build_data2(app, path, nights, rng):
+    db_manager = app.DatabaseManager(path)
+    db_manager.create_tables()
+    ai_advice_manager = app.AIAdviceManager(db_manager, "benchmark")
+    sleep_record_manager = app.SleepRecordManager(db_manager, ai_advice_manager)
+    with db_manager.transaction():
+        for night in nights:
+            record = data2_record(night)
+            sleep_record_manager.save_sleep_record(record)
+            if rng.random() < 0.6:
+                ai_advice_manager.save_advice(REPLY, record['date'])
+    return db_manager, ai_advice_manager, sleep_record_manager
+
+
+def data2_record(night):
+    # SleepTherapyApp.save_sleep_record と同じ形の辞書
+    sleep_time = night['sleep_time'].strftime("%Y-%m-%d %H:%M:%S")
+    wake_time = night['wake_time'].strftime("%Y-%m-%d %H:%M:%S")
+    return {
+        'date': night['wake_date'].isoformat(),
+        'sleep_time': sleep_time,
+        'wake_time': wake_time,
+        'sleep_duration': format_duration((night['wake_time'] - night['sleep_time']).total_seconds() // 60),
+        'sleep_satisfaction': night['satisfaction'],
+        'sleep_quality': night['quality'],
+        'sleep_dissatisfaction': night['dissatisfaction'],
+        'sleep_anxiety': night['anxiety'],
+        'sleep_preparation': night['preparation'],
+        'sleep_reflection': night['reflection'],
+        'sleep_latency_minutes': night['latency'],
+        'awake_minutes': night['awake'],
+    }
+
+
+def build_sleep_data(path, nights):
+    # 不眠症アプリの save_feedback と同じ列を書き込む
+    conn = sqlite3.connect(path)
+    try:
+        migrate(conn, SLEEP_DATA_MIGRATIONS)
+        rows = []
+        for night in nights:
+            sleep_epoch = int(night['sleep_time'].timestamp())
+            wake_epoch = int(night['wake_time'].timestamp())
+            items = night['checklist']
+            rows.append((
+                night['wake_date'].isoformat(),
+                night['sleep_time'].strftime("%Y-%m-%d %H:%M:%S"),
+                night['wake_time'].strftime("%Y-%m-%d %H:%M:%S"),
+                None, None, night['reflection'], None, "", "", REPLY,
+                f"{(wake_epoch - sleep_epoch) // 3600}時間{(wake_epoch - sleep_epoch) % 3600 // 60}分",
+                None, sleep_epoch, wake_epoch, (wake_epoch - sleep_epoch) // 60,
+                CATALOG.encode(item for item in items if item.group == PRACTICED),
+                CATALOG.encode(item for item in items if item.group == IMPROVED),
+                CATALOG.encode(item for item in items if item.group == BAD),
+            ))
+        with conn:
+            conn.executemany("""INSERT INTO sleep_records
+                (date, sleep_time, wake_time, nap_time, good_points, good_points_free,
+                bad_points, bad_points_free, therapy_notes, ai_advice, sleep_duration, practiced_points,
+                sleep_epoch, wake_epoch, duration_minutes, practiced_mask, improved_mask, bad_mask)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""", rows)
+    finally:
+        conn.close()
+
+
+def measure(func, repeat, warmup=1):
+    """func を repeat 回実行した時間（ミリ秒）の統計。func には実行回数（0始まり）を渡す。"""
+    for i in range(warmup):
+        func(-1 - i)
+    timings = []
+    for i in range(repeat):
+        started = time.perf_counter()
+        func(i)
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    return {
+        'runs': repeat,
+        'median_ms': round(statistics.median(timings), 4),
+        'mean_ms': round(statistics.fmean(timings), 4),
+        'p95_ms': round(timings[min(len(timings) - 1, int(len(timings) * 0.95))], 4),
+        'min_ms': round(timings[0], 4),
+    }
+
+
+@contextlib.contextmanager
+def quiet():
+    # アプリの print を計測の出力に混ぜない
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+
+def bench_data2(app, workdir, args, end_date, results):
+    rng = random.Random(args.seed)
+    generator = DiaryGenerator(args.seed)
+    start_date = end_date - timedelta(days=int(args.years * 365))
+    with quiet():
+        db_manager, ai_advice_manager, sleep_record_manager = build_data2(
+            app, os.path.join(workdir, "data2.db"), generator.nights(start_date, end_date), rng
+        )
+    results['data2.nights'] = db_manager.execute_query("SELECT COUNT(*) FROM sleep_records")[0][0]
+
+    future = list(generator.nights(end_date + timedelta(days=1), end_date + timedelta(days=args.repeat + 1), 0))
+    with quiet():
+        results['data2.save_sleep_record'] = measure(
+            lambda i: sleep_record_manager.save_sleep_record(data2_record(future[i])), args.repeat, warmup=0
+        )
+        results['data2.get_recent_records_with_advice'] = measure(
+            lambda i: sleep_record_manager.get_recent_records_with_advice(days=7), args.repeat
+        )
+        for days in (7, 30, 365):
+            results[f'data2.get_sleep_records_{days}d'] = measure(
+                lambda i, days=days: sleep_record_manager.get_sleep_records(
+                    str(end_date - timedelta(days=days)), str(end_date)
+                ), args.repeat
+            )
+
+        month = sleep_record_manager.get_records_with_advice(end_date - timedelta(days=30), end_date)
+        results['data2._create_prompt'] = measure(
+            lambda i: ai_advice_manager._create_prompt(month, PROFILE), args.repeat
+        )
+        # プロンプトの組み立てで記録を読むのは PromptEncoder（_create_prompt は指示文だけ）
+        results['data2.prompt_encoder.encode'] = measure(
+            lambda i: ai_advice_manager.prompt_encoder.encode(month), args.repeat
+        )
+        results['data2.calculate_sleep_duration'] = measure(
+            lambda i: sleep_record_manager.calculate_sleep_duration("2024-01-01 23:30:00", "2024-01-02 06:45:00"),
+            args.repeat
+        )
+    return db_manager, ai_advice_manager, sleep_record_manager
+
+
+def bench_advice(ai_advice_manager, sleep_record_manager, args, end_date, results):
+    try:
+        import openai  # noqa: F401
+    except ImportError:
+        results['data2.generate_advice'] = {'skipped': "openai is not installed"}
+        return
+
+    with MockChatServer(latency=args.latency, reply=REPLY, seed=args.seed) as server:
+        os.environ["OPENAI_BASE_URL"] = server.base_url
+        ai_advice_manager.client  # openai の読み込みとクライアントの作成は計測に含めない
+        with quiet():
+            # 毎回ちがう週を送り、キャッシュに当たらないようにする
+            weeks = [
+                sleep_record_manager.get_records_with_advice(
+                    end_date - timedelta(days=7 * (i + 1)), end_date - timedelta(days=7 * i)
+                ) for i in range(args.advice_repeat + 1)
+            ]
+            results['data2.generate_advice'] = measure(
+                lambda i: ai_advice_manager.generate_advice(weeks[i + 1], PROFILE), args.advice_repeat, warmup=0
+            )
+            results['data2.generate_advice_stream'] = measure(
+                lambda i: ai_advice_manager.generate_advice(weeks[i], PROFILE, on_chunk=lambda delta: None),
+                1, warmup=0
+            )
+            results['data2.generate_advice_cached'] = measure(
+                lambda i: ai_advice_manager.generate_advice(weeks[1], PROFILE), args.repeat
+            )
+        results['mock.latency_s'] = args.latency
+        results['mock.requests'] = server.request_count
+
+
+def bench_cbt(app, workdir, args, end_date, results):
+    generator = DiaryGenerator(args.seed + 1)
+    start_date = end_date - timedelta(days=int(args.years * 365))
+    legacy_path = os.path.join(workdir, "sleep_data.db")
+    with quiet():
+        build_sleep_data(legacy_path, generator.nights(start_date, end_date))
+
+    # 以前の sleep_data.db を共通のストレージに取り込む（起動時の create_database と同じ処理）
+    db_manager = app.DatabaseManager(os.path.join(workdir, "cbt_store.db"))
+    started = time.perf_counter()
+    with quiet():
+        verified = StorageMigrator(legacy_path, db_manager).run()
+    results['cbt.migrate_legacy_ms'] = round((time.perf_counter() - started) * 1000, 1)
+    results['cbt.migrate_legacy_verified'] = all(ok for _, _, _, ok in verified)
+
+    # 画面は作らず、データの読み込み部分のメソッドだけを呼ぶ
+    cbt = app.SleepTherapyApp.__new__(app.SleepTherapyApp)
+    cbt.db_manager = db_manager
+    cbt.store = app.SleepStore(db_manager)
+    try:
+        results['cbt.nights'] = sum(count for _, count in cbt.load_history_months())
+
+        def load_history(i):
+            # populate_history は月ごとの件数を読み、最初の月のタブで1ページ目を読む
+            months = cbt.load_history_months()
+            year, month = map(int, months[0][0].split("-"))
+            start = f"{year:04d}-{month:02d}-01"
+            end = f"{year + 1:04d}-01-01" if month == 12 else f"{year:04d}-{month + 1:02d}-01"
+            cbt.fetch_history_page(start, end, None, 50)
+
+        results['cbt.populate_history_load'] = measure(load_history, args.repeat)
+        sleep_time = datetime(2024, 1, 1, 23, 30)
+        wake_time = datetime(2024, 1, 2, 6, 45)
+        results['cbt.calculate_sleep_duration'] = measure(
+            lambda i: cbt.calculate_sleep_duration(sleep_time, wake_time), args.repeat
+        )
+    finally:
+        db_manager.close()
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    data2_app = load_app(DATA2_APP, "sleep_app2")
+    cbt_app = load_app(CBT_APP, "cbt_app")
+    end_date = date.today()
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        db_manager, ai_advice_manager, sleep_record_manager = bench_data2(data2_app, workdir, args, end_date, results)
+        try:
+            if args.advice_repeat:
+                bench_advice(ai_advice_manager, sleep_record_manager, args, end_date, results)
+        finally:
+            db_manager.close()
+        bench_cbt(cbt_app, workdir, args, end_date, results)
+    return {
+        'commit': git_commit(),
+        'created_at': datetime.now().isoformat(timespec="seconds"),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'params': {'years': args.years, 'seed': args.seed, 'repeat': args.repeat,
+                   'advice_repeat': args.advice_repeat, 'latency': args.latency},
+        'results': results,
+    }
+
+
+def compare(report, baseline, max_regression):
+    """中央値の比（今回 / 前回）を表示し、max_regression を超えた処理の名前を返す。"""
+    regressions = []
+    for name, result in report['results'].items():
+        before = baseline.get('results', {}).get(name)
+        if not isinstance(result, dict) or not isinstance(before, dict):
+            continue
+        if 'median_ms' not in result or not before.get('median_ms'):
+            continue
+        ratio = result['median_ms'] / before['median_ms']
+        marker = ""
+        if max_regression and ratio > max_regression:
+            marker = "  <- regression"
+            regressions.append(name)
+        print(f"  {name:<40} {before['median_ms']:10.3f} -> {result['median_ms']:10.3f} ms  x{ratio:.2f}{marker}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="保存・読み込み・助言生成の処理時間を計測する")
+    parser.add_argument("--years", type=float, default=3, help="作成する日記の年数")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=50, help="各処理の実行回数")
+    parser.add_argument("--advice-repeat", type=int, default=5, help="助言生成の実行回数（0で省略）")
+    parser.add_argument("--latency", type=float, default=0.2, help="モックサーバーの応答遅延（秒）")
+    parser.add_argument("--json", help="結果をJSONで書き出すパス")
+    parser.add_argument("--compare", help="比較する前回の結果（JSON）")
+    parser.add_argument("--max-regression", type=float, help="中央値がこの倍率を超えて遅くなったら終了コード1")
+    args = parser.parse_args()
+
+    report = run(args)
+    for name, result in report['results'].items():
+        if isinstance(result, dict) and 'median_ms' in result:
+            print(f"{name:<40} median {result['median_ms']:10.3f} ms  p95 {result['p95_ms']:10.3f} ms")
+        else:
+            print(f"{name:<40} {result}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        print(f"compared with {baseline.get('commit')}:")
+        if compare(report, baseline, args.max_regression):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
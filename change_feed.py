@@ -0,0 +1,194 @@
+"""記録・助言・プロフィールの変更の記録（チェンジフィード）。
+
+sleep_records / advice_history / user_profiles への追加・更新・削除は、トリガーで changelog に
+1行ずつ追記される。seq は AUTOINCREMENT なので、古い行を消しても番号が戻ることはない。
+changelog には変わった行のID・利用者・日付だけを残し、内容が必要なら利用者側で読み直す。
+INSERT OR REPLACE による置き換えは insert として記録される。
+
+後から処理する側（集計・キャッシュ・同期など）は名前を付けたカーソル（change_cursors）で
+どこまで処理したかを保存し、ChangeFeed.consume でそれより新しい変更だけを受け取る。
+読むのは seq の範囲検索だけなので、手間は履歴の長さではなく新しい変更の数に比例する。
+
+    python change_feed.py status
+    python change_feed.py prune
+"""
+import argparse
+import time
+from collections import namedtuple
+
+
+# (テーブル, 利用者IDの式, 日付の式)。式の中の {row} は NEW か OLD に置き換える
+TRACKED_TABLES = (
+    ('sleep_records', '{row}.user_id', '{row}.date'),
+    ('advice_history', '{row}.user_id', '{row}.date'),
+    ('user_profiles', '{row}.id', 'NULL'),
+)
+
+CHANGE_FEED_TABLES = [
+    '''CREATE TABLE IF NOT EXISTS changelog
+        (seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        table_name TEXT NOT NULL,
+        op TEXT NOT NULL,
+        row_id INTEGER NOT NULL,
+        user_id INTEGER,
+        date TEXT,
+        changed_at REAL NOT NULL)''',
+    '''CREATE TABLE IF NOT EXISTS change_cursors
+        (consumer TEXT PRIMARY KEY,
+        seq INTEGER NOT NULL,
+        updated_at REAL)''',
+]
+
+# トリガーの中で time.time() と同じエポック秒（小数）を作る
+_NOW_SQL = "(julianday('now') - 2440587.5) * 86400.0"
+
+
+def change_feed_triggers(tables=TRACKED_TABLES):
+    steps = []
+    for table, user_expr, date_expr in tables:
+        for op, event, row in (('insert', 'INSERT', 'NEW'), ('update', 'UPDATE', 'NEW'), ('delete', 'DELETE', 'OLD')):
+            steps.append(
+                f'''CREATE TRIGGER IF NOT EXISTS trg_changelog_{table}_{op} AFTER {event} ON {table}
+                    BEGIN
+                        INSERT INTO changelog (table_name, op, row_id, user_id, date, changed_at)
+                        VALUES ('{table}', '{op}', {row}.id, {user_expr.format(row=row)},
+                                {date_expr.format(row=row)}, {_NOW_SQL});
+                    END'''
+            )
+    return steps
+
+
+Change = namedtuple('Change', 'seq table_name op row_id user_id date changed_at')
+
+_CHANGE_COLUMNS = "seq, table_name, op, row_id, user_id, date, changed_at"
+
+
+class ChangeFeed:
+    """changelog の読み出しと、利用者（consumer）ごとのカーソル。"""
+
+    def __init__(self, connection_manager):
+        self.connection_manager = connection_manager
+
+    def latest_seq(self):
+        row = self.connection_manager.get_connection().execute("SELECT MAX(seq) FROM changelog").fetchone()
+        return row[0] or 0
+
+    def changes(self, after_seq, limit=500):
+        """seq が after_seq より大きい変更を古い順に limit 件。"""
+        rows = self.connection_manager.get_connection().execute(
+            f"SELECT {_CHANGE_COLUMNS} FROM changelog WHERE seq > ? ORDER BY seq LIMIT ?",
+            (after_seq, limit)
+        ).fetchall()
+        return [Change(*row) for row in rows]
+
+    def cursor(self, consumer):
+        """consumer が処理済みの seq。登録されていなければ None。"""
+        row = self.connection_manager.get_connection().execute(
+            "SELECT seq FROM change_cursors WHERE consumer = ?", (consumer,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def register(self, consumer, from_start=False):
+        """consumer のカーソルを作る。既にあれば保存済みの位置をそのまま使う。
+
+        新しいカーソルは、from_start なら残っている最も古い変更から、そうでなければ今より後の変更から読む。
+        既にあるカーソルは読むだけで確かめ、書き込みのロックを取らない。
+        """
+        if self.cursor(consumer) is not None:
+            return
+        # 1文なので transaction() を使わず autocommit で書く
+        self.connection_manager.get_connection().execute(
+            "INSERT OR IGNORE INTO change_cursors (consumer, seq, updated_at) VALUES (?, ?, ?)",
+            (consumer, 0 if from_start else self.latest_seq(), time.time())
+        )
+
+    def seek(self, consumer, seq=None):
+        """カーソルを seq（省略すると最新）に動かす。作り直した状態から読み始めるときに使う。"""
+        with self.connection_manager.transaction() as conn:
+            conn.execute(
+                '''INSERT INTO change_cursors (consumer, seq, updated_at) VALUES (?, ?, ?)
+                   ON CONFLICT(consumer) DO UPDATE SET seq = excluded.seq, updated_at = excluded.updated_at''',
+                (consumer, self.latest_seq() if seq is None else seq, time.time())
+            )
+
+    def has_changes(self, consumer):
+        """consumer にまだ処理していない変更があるか。読むだけなので書き込みのロックは取らない。
+
+        カーソルがなければ True（consume で作るときに位置が決まる）。
+        """
+        after = self.cursor(consumer)
+        return after is None or bool(self.changes(after, 1))
+
+    def unregister(self, consumer):
+        with self.connection_manager.transaction() as conn:
+            conn.execute("DELETE FROM change_cursors WHERE consumer = ?", (consumer,))
+
+    def consume(self, consumer, handler, batch_size=500):
+        """consumer の新しい変更を batch_size 件ずつ handler（変更のリストを受け取る関数）に渡す。
+
+        handler の呼び出しとカーソルの更新は同じトランザクションで行う。handler が同じデータベースに
+        書き込む場合は、その書き込みとカーソルがまとめてコミットされるので、同じ変更を二度処理しない。
+        handler が例外を出すとカーソルは進まず、次の consume で同じ変更をもう一度受け取る。
+        処理した変更の数を返す。
+        """
+        self.register(consumer)
+        total = 0
+        while True:
+            # 新しい変更がなければ書き込みのロックを取らずに戻る
+            if not self.has_changes(consumer):
+                return total
+            with self.connection_manager.transaction() as conn:
+                after = conn.execute("SELECT seq FROM change_cursors WHERE consumer = ?", (consumer,)).fetchone()[0]
+                changes = self.changes(after, batch_size)
+                if not changes:
+                    return total
+                handler(changes)
+                conn.execute("UPDATE change_cursors SET seq = ?, updated_at = ? WHERE consumer = ?",
+                             (changes[-1].seq, time.time(), consumer))
+            total += len(changes)
+
+    def status(self):
+        """[(consumer, 処理済みの seq, 未処理の変更の数), ...]"""
+        rows = self.connection_manager.get_connection().execute(
+            '''SELECT c.consumer, c.seq, (SELECT COUNT(*) FROM changelog WHERE seq > c.seq)
+               FROM change_cursors c ORDER BY c.consumer'''
+        ).fetchall()
+        return rows
+
+    def prune(self):
+        """すべてのカーソルが処理し終えた変更を消す。カーソルが1つもなければ何も消さない。"""
+        with self.connection_manager.transaction() as conn:
+            cursor = conn.execute(
+                '''DELETE FROM changelog
+                   WHERE seq <= (SELECT MIN(seq) FROM change_cursors)'''
+            )
+            return cursor.rowcount
+
+
+def main():
+    from sleep_store import DatabaseManager
+
+    parser = argparse.ArgumentParser(description="変更の記録（changelog）とカーソルの確認・整理")
+    parser.add_argument("command", choices=("status", "prune"))
+    parser.add_argument("--db", default="data2.db")
+    parser.add_argument("--unregister", action="append", default=[],
+                        help="使わなくなったカーソルを消してから実行する（複数指定可）")
+    args = parser.parse_args()
+
+    db_manager = DatabaseManager(args.db)
+    db_manager.create_tables()
+    feed = ChangeFeed(db_manager.connection_manager)
+    try:
+        for consumer in args.unregister:
+            feed.unregister(consumer)
+        if args.command == "prune":
+            print(f"Removed {feed.prune()} changes")
+        print(f"Latest seq: {feed.latest_seq()}")
+        for consumer, seq, pending in feed.status():
+            print(f"  {consumer:<40} seq {seq:>10}  pending {pending}")
+    finally:
+        db_manager.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+"""起床時の感想のチェック項目の一覧（checklist_items）と、選択のビットマスク。
+
+各項目は変わらない整数のID と、グループ（実践したこと・改善が見られた点・気になった点）内のビット位置を持つ。
+1晩の選択はグループごとに1つの整数（practiced_mask / improved_mask / bad_mask）で保存する。
+項目を追加するときは末尾に新しいID とビット位置で足し、既存の番号は変えないこと（1グループ63項目まで）。
+"""
+import json
+
+
+PRACTICED = 'practiced'
+IMPROVED = 'improved'
+BAD = 'bad'
+
+# グループ -> sleep_records の列
+MASK_COLUMNS = {
+    PRACTICED: 'practiced_mask',
+    IMPROVED: 'improved_mask',
+    BAD: 'bad_mask',
+}
+
+# (ID, グループ, カテゴリ, ビット位置, 項目)
+CHECKLIST_ITEMS = (
+    (1, PRACTICED, None, 0, "睡眠制限で、規則正しい就寝,起床時間を維持できた（多少の前後は気にしない）"),
+    (2, PRACTICED, None, 1, "睡眠時間の把握や、質の良い睡眠時間がわかってきた"),
+    (3, PRACTICED, None, 2, "睡眠制限により、以前より少し早く眠れるようになった気がする"),
+    (4, PRACTICED, None, 3, "睡眠準備で、何か習慣化できることを探した、行ってみた"),
+    (5, PRACTICED, None, 4, "睡眠準備で、リラックスする方法を探した、行ってみた"),
+    (6, PRACTICED, None, 5, "睡眠環境整備で、室温を考えたり、寝具を変えてみた"),
+    (7, PRACTICED, None, 6, "寝る前のカフェイン、アルコール、ニコチンの摂取を避けてみた"),
+    (8, PRACTICED, None, 7, "寝る前にパソコンやスマートフォン等のブルーライトを避けてみた"),
+    (9, PRACTICED, None, 8, "データと自分の認知を見直し、眠りの質について考える機会を持ち、意識を変えてみた"),
+    (10, PRACTICED, None, 9, "データと自分の認知を見直し、期待と実際の睡眠時間のギャップを考えてみた"),
+    (11, PRACTICED, None, 10, "データと自分の認知を見直し、リラックスや環境改善の効果について考えた"),
+    (12, PRACTICED, None, 11, "データと自分の認知を見直し、就寝前の習慣の重要性を考え、意識を変えてみた"),
+
+    (13, IMPROVED, None, 0, "日中の眠気が以前より改善した気がする"),
+    (14, IMPROVED, None, 1, "よく寝れた（気がするだけでも大丈夫です）"),
+    (15, IMPROVED, None, 2, "熟睡できた感覚があった"),
+    (16, IMPROVED, None, 3, "睡眠の質が向上した気がする"),
+    (17, IMPROVED, None, 4, "目覚めがすっきりしている"),
+    (18, IMPROVED, None, 5, "睡眠にストレスを感じなかった"),
+    (19, IMPROVED, None, 6, "入眠がスムーズだった"),
+    (20, IMPROVED, None, 7, "途中覚醒が少なかった、もしくは無かった"),
+    (21, IMPROVED, None, 8, "全体的に睡眠パターンが改善してきたと感じる"),
+    (22, IMPROVED, None, 9, "認知の変化で、睡眠に対する不安が少し和らいだ感じがする"),
+    (23, IMPROVED, None, 10, "認知の変化で、眠れないことへの焦りが以前より減った感じがする"),
+    (24, IMPROVED, None, 11, "認知の変化で、睡眠時間にこだわりすぎないようになった"),
+    (25, IMPROVED, None, 12, "認知の変化で、夜中に目覚めても、以前より落ち着いて対処できたと思う"),
+    (26, IMPROVED, None, 13, "睡眠薬が良く効いていた気がする"),
+    (27, IMPROVED, None, 14, "睡眠薬を減らせるかもと自信がついてきたので、医師や専門家に相談してみたい"),
+    (28, IMPROVED, None, 15, "医師や専門家に相談して睡眠薬を減らしても、睡眠の傾向が良かったと思う"),
+
+    (29, BAD, "不安感", 0, "睡眠薬の効果を感じられず、不安だったり、寝起きを繰り返した"),
+    (30, BAD, "不安感", 1, "なぜ眠れないのか色々考えすぎて不安だった"),
+    (31, BAD, "不安感", 2, "今日も寝付きが悪いのではないかと不安だった"),
+    (32, BAD, "不安感", 3, "全く眠れないかもしれないと不安だった"),
+    (33, BAD, "不安感", 4, "何時に寝られるか気になって不快だった"),
+    (34, BAD, "不安感", 5, "途中で起きたり、早く起きたりしないか不安だった"),
+    (35, BAD, "不安感", 6, "寝坊やそれによるトラブルが心配で不安だった"),
+    (36, BAD, "不安感", 7, "寝不足による集中力や気力不足の発生に不安があった"),
+    (37, BAD, "不安感", 8, "ホテル宿泊などの外泊で環境がいつもと違ったので、入眠や睡眠時間に不安を感じた"),
+    (38, BAD, "焦り", 9, "昼寝を長時間したので、寝られるか焦りがあった"),
+    (39, BAD, "焦り", 10, "寝る前にカフェイン摂取したりニコチンを摂取したので、寝られるか焦った"),
+    (40, BAD, "焦り", 11, "寝具の中で眠れないと悲観的になり、焦りがあった"),
+    (41, BAD, "焦り", 12, "眠れないと健康面での支障や、仕事面での支障を感じ焦りがあった"),
+    (42, BAD, "焦り", 13, "時計や目覚まし時計を見て睡眠時間を考えると焦りが出た"),
+    (43, BAD, "焦り", 14, "早く起きなければならないなど、寝られる時間が限られていて入眠に焦りがあった"),
+    (44, BAD, "焦り", 15, "眠れないと取り返しがつかないと焦りがあった"),
+    (45, BAD, "焦り", 16, "ホテル宿泊などの外泊で環境がいつもと違ったので、寝られるかどうか焦りがあった"),
+    (46, BAD, "緊張、ストレス感", 17, "寝室や寝具に入ると緊張してしまった"),
+    (47, BAD, "緊張、ストレス感", 18, "夜中に何度も起きたり、15分くらいかそれ以上の中途覚醒があってストレスを感じた"),
+    (48, BAD, "緊張、ストレス感", 19, "中途覚醒してトイレに何度も行って不快だった"),
+    (49, BAD, "緊張、ストレス感", 20, "眠るまでの時間や起きるまでの時間がゆっくり感じてストレスだった"),
+    (50, BAD, "緊張、ストレス感", 21, "恐怖を感じる悪夢をみた、もしくは悪夢を見ないか恐怖があった"),
+    (51, BAD, "緊張、ストレス感", 22, "かなしばりのような感覚があった"),
+    (52, BAD, "緊張、ストレス感", 23, "かなり長い時間夢を見ている感覚があり、ストレスを感じた"),
+    (53, BAD, "緊張、ストレス感", 24, "ホテル宿泊の外泊で環境がいつもと違ったので、寝られるか緊張した"),
+    (54, BAD, "期待への不満", 25, "眠りが浅いことへの不満があった"),
+    (55, BAD, "期待への不満", 26, "眠る環境が悪いと感じて寝れた気がせず不満だった"),
+    (56, BAD, "期待への不満", 27, "自分の期待した時間寝られなかったことに悲観的になり、不満があった"),
+    (57, BAD, "期待への不満", 28, "若い頃と同じ睡眠パターンを維持できると期待していて悲観的になった"),
+    (58, BAD, "期待への不満", 29, "リラックスや環境改善したのに、期待通りの睡眠ができず不満や悲観があった"),
+    (59, BAD, "期待への不満", 30, "ストレスや心配事があると絶対に眠れないと決めつけてしまっていた"),
+    (60, BAD, "期待への不満", 31, "睡眠薬を飲まないと絶対に眠れないと信じ込み、寝つきや質が悪いと感じた"),
+    (61, BAD, "期待への不満", 32, "寝る前の習慣を1つでも忘れたので、寝られないと思い込んだ"),
+    (62, BAD, "期待への不満", 33, "外泊などで睡眠環境が違ったので、寝られないと思い込んだ"),
+)
+
+CHECKLIST_TABLES = [
+    '''CREATE TABLE IF NOT EXISTS checklist_items
+        (id INTEGER PRIMARY KEY,
+        item_group TEXT NOT NULL,
+        category TEXT,
+        bit INTEGER NOT NULL,
+        label TEXT NOT NULL,
+        UNIQUE (item_group, bit))''',
+]
+
+
+class ChecklistItem:
+    def __init__(self, item_id, group, category, bit, label):
+        self.id = item_id
+        self.group = group
+        self.category = category
+        self.bit = bit
+        self.label = label
+
+    @property
+    def mask(self):
+        return 1 << self.bit
+
+
+class ChecklistCatalog:
+    """チェック項目の一覧。表示の順番は ID の順。"""
+
+    def __init__(self, items=CHECKLIST_ITEMS):
+        self.items = [ChecklistItem(*item) for item in items]
+        self.by_id = {item.id: item for item in self.items}
+        self._by_label = {(item.group, item.label): item for item in self.items}
+
+    def group_items(self, group):
+        return [item for item in self.items if item.group == group]
+
+    def categories(self, group):
+        # {カテゴリ: [項目, ...]}。カテゴリの順番は最初に出てくる項目の順
+        categories = {}
+        for item in self.group_items(group):
+            categories.setdefault(item.category, []).append(item)
+        return categories
+
+    def encode(self, items):
+        mask = 0
+        for item in items:
+            mask |= item.mask
+        return mask
+
+    def decode(self, group, mask):
+        if not mask:
+            return []
+        return [item for item in self.group_items(group) if mask & item.mask]
+
+    def find(self, group, label):
+        return self._by_label.get((group, label))
+
+    def encode_text(self, group, text):
+        # 以前の「項目をカンマでつないだ文字列」からの変換。項目自体にカンマを含むものがあるので、
+        # 分割せずに各項目が含まれているかで判定する
+        if not text:
+            return 0
+        return self.encode(item for item in self.group_items(group) if item.label in text)
+
+
+CATALOG = ChecklistCatalog()
+
+
+def seed_catalog(conn):
+    """checklist_items を CHECKLIST_ITEMS に合わせる。既存のIDは上書きしない。"""
+    conn.executemany(
+        "INSERT OR IGNORE INTO checklist_items (id, item_group, category, bit, label) VALUES (?, ?, ?, ?, ?)",
+        CHECKLIST_ITEMS
+    )
+
+
+def legacy_masks(practiced, improved, bad):
+    """以前のチェック項目の列（文字列・JSON）の値を (practiced_mask, improved_mask, bad_mask) にする。"""
+    bad_mask = 0
+    if bad:
+        try:
+            categories = json.loads(bad)
+        except ValueError:
+            categories = {}
+        for points in categories.values():
+            for label in points:
+                item = CATALOG.find(BAD, label)
+                if item:
+                    bad_mask |= item.mask
+    return CATALOG.encode_text(PRACTICED, practiced), CATALOG.encode_text(IMPROVED, improved), bad_mask
+
+
+def backfill_masks(conn):
+    """以前の good_points / practiced_points（文字列）と bad_points（JSON）から選択のビットマスクを作る。"""
+    rows = conn.execute(
+        "SELECT rowid, practiced_points, good_points, bad_points FROM sleep_records"
+    ).fetchall()
+    conn.executemany(
+        "UPDATE sleep_records SET practiced_mask = ?, improved_mask = ?, bad_mask = ? WHERE rowid = ?",
+        [legacy_masks(practiced, improved, bad) + (rowid,) for rowid, practiced, improved, bad in rows]
+    )
+
+
+def frequency_query(group, by_user=False):
+    """期間内に、グループの各項目がチェックされた夜の数を1回の走査で数えるクエリ。
+
+    パラメータは (開始日, 終了日)、by_user なら (利用者ID, 開始日, 終了日)。
+    結果は (記録の件数, 項目ごとの件数, ...) の1行で、項目は ID の順。
+    """
+    column = MASK_COLUMNS[group]
+    counts = ", ".join(f"SUM(({column} >> {item.bit}) & 1)" for item in CATALOG.group_items(group))
+    user_condition = "user_id = ? AND " if by_user else ""
+    return f"SELECT COUNT(*), {counts} FROM sleep_records WHERE {user_condition}date BETWEEN ? AND ?"
+
+
+def item_frequencies(conn, group, start_date, end_date, user_id=None):
+    """[(項目, チェックされた夜の数), ...] と記録の件数を返す。回数の多い順。"""
+    params = (str(start_date), str(end_date))
+    if user_id is not None:
+        params = (user_id,) + params
+    row = conn.execute(frequency_query(group, user_id is not None), params).fetchone()
+    nights = row[0]
+    counts = [(item, count or 0) for item, count in zip(CATALOG.group_items(group), row[1:])]
+    counts.sort(key=lambda pair: pair[1], reverse=True)
+    return counts, nights
+
+
+def item_frequency(conn, item_id, start_date, end_date, user_id=None):
+    """1つの項目がチェックされた夜の数。"""
+    item = CATALOG.by_id[item_id]
+    column = MASK_COLUMNS[item.group]
+    params = (str(start_date), str(end_date), item.mask)
+    user_condition = ""
+    if user_id is not None:
+        user_condition = "user_id = ? AND "
+        params = (user_id,) + params
+    return conn.execute(
+        f"SELECT COUNT(*) FROM sleep_records WHERE {user_condition}date BETWEEN ? AND ? AND ({column} & ?) != 0",
+        params
+    ).fetchone()[0]
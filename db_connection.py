@@ -0,0 +1,148 @@
+import os
+import sqlite3
+import threading
+import zlib
+from contextlib import contextmanager
+
+
+class ConnectionManager:
+    """スレッドごとに長寿命のSQLite接続を保持する接続マネージャー。
+
+    接続は初回使用時に開き、WALジャーナルと各種PRAGMAを一度だけ設定する。
+    通常の文はautocommitで実行し、複数の文をまとめたい場合は transaction() を使う。
+    """
+
+    def __init__(self, db_name, busy_timeout=5000, synchronous="NORMAL",
+                 cache_size=-8000, mmap_size=64 * 1024 * 1024):
+        self.db_name = db_name
+        self.busy_timeout = busy_timeout  # ミリ秒
+        self.synchronous = synchronous
+        self.cache_size = cache_size  # 負の値はKiB単位
+        self.mmap_size = mmap_size
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = []
+        self._generation = 0  # close_all() のたびに進め、他スレッドの古い接続を無効化する
+
+    def get_connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.generation != self._generation:
+            conn = sqlite3.connect(
+                self.db_name,
+                timeout=self.busy_timeout / 1000,
+                isolation_level=None,  # トランザクションは transaction() で明示的に管理する
+                check_same_thread=False,
+            )
+            self._configure(conn)
+            self._local.conn = conn
+            self._local.depth = 0
+            self._local.generation = self._generation
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def _configure(self, conn):
+        conn.execute(f"PRAGMA busy_timeout = {int(self.busy_timeout)}")
+        if self.db_name != ":memory:":
+            conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute(f"PRAGMA synchronous = {self.synchronous}")
+        conn.execute(f"PRAGMA cache_size = {int(self.cache_size)}")
+        conn.execute(f"PRAGMA mmap_size = {int(self.mmap_size)}")
+        conn.execute("PRAGMA temp_store = MEMORY")
+
+    def in_transaction(self):
+        return getattr(self._local, "depth", 0) > 0
+
+    @contextmanager
+    def transaction(self):
+        conn = self.get_connection()
+        depth = self._local.depth
+        # 入れ子のトランザクションはSAVEPOINTで表現する
+        if depth == 0:
+            conn.execute("BEGIN IMMEDIATE")
+        else:
+            conn.execute(f"SAVEPOINT sp_{depth}")
+        self._local.depth = depth + 1
+        try:
+            yield conn
+        except BaseException:
+            self._rollback(conn, depth)
+            raise
+        else:
+            if depth == 0:
+                try:
+                    conn.execute("COMMIT")
+                except BaseException:
+                    # コミットに失敗したら開いたままのトランザクションを閉じ、次の BEGIN が失敗しないようにする
+                    self._rollback(conn, depth)
+                    raise
+            else:
+                conn.execute(f"RELEASE sp_{depth}")
+        finally:
+            self._local.depth = depth
+
+    @staticmethod
+    def _rollback(conn, depth):
+        # SQLite が既にロールバックしていれば何もしない。ロールバックの失敗で元の例外を隠さない
+        if not conn.in_transaction:
+            return
+        try:
+            if depth == 0:
+                conn.execute("ROLLBACK")
+            else:
+                conn.execute(f"ROLLBACK TO sp_{depth}")
+                conn.execute(f"RELEASE sp_{depth}")
+        except sqlite3.Error as e:
+            print(f"Rollback error: {e}")
+
+    def close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            with self._lock:
+                if conn in self._connections:
+                    self._connections.remove(conn)
+            conn.close()
+            self._local.conn = None
+
+    def close_all(self):
+        with self._lock:
+            connections, self._connections = self._connections, []
+            self._generation += 1
+        for conn in connections:
+            try:
+                conn.close()
+            except sqlite3.Error as e:
+                print(f"Database close error: {e}")
+        self._local.conn = None
+
+
+class ShardRouter:
+    """利用者IDから、その利用者のデータを置くSQLiteファイルを決める。
+
+    shard_count が1ならすべての利用者が db_name に入る。2以上なら利用者IDのハッシュで
+    data2.shard03.db のようなファイルに振り分ける。ハッシュは crc32 なので、プロセスや
+    Python のバージョンが変わっても同じ利用者は同じファイルになる。
+    """
+
+    def __init__(self, db_name, shard_count=1):
+        if shard_count < 1:
+            raise ValueError("shard_count must be at least 1")
+        self.db_name = db_name
+        self.shard_count = shard_count
+
+    def shard_for(self, user_id):
+        if self.shard_count == 1:
+            return 0
+        return zlib.crc32(str(int(user_id)).encode("ascii")) % self.shard_count
+
+    def path_for_shard(self, index):
+        if self.shard_count == 1:
+            return self.db_name
+        root, ext = os.path.splitext(self.db_name)
+        return f"{root}.shard{index:02d}{ext}"
+
+    def path_for(self, user_id):
+        return self.path_for_shard(self.shard_for(user_id))
+
+    def paths(self):
+        return [self.path_for_shard(index) for index in range(self.shard_count)]
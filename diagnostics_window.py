@@ -0,0 +1,50 @@
+import tkinter as tk
+from tkinter import ttk
+
+
+class DiagnosticsWindow:
+    """計測値（perf_metrics.Metrics）の p50/p95/p99 を一覧する隠しウィンドウ。開いている間は定期的に更新する。"""
+
+    COLUMNS = (
+        ("kind", "種類", 60),
+        ("count", "件数", 60),
+        ("p50_ms", "p50 ms", 80),
+        ("p95_ms", "p95 ms", 80),
+        ("p99_ms", "p99 ms", 80),
+        ("max_ms", "最大 ms", 80),
+        ("rows", "行数", 70),
+        ("tokens", "トークン", 70),
+    )
+
+    def __init__(self, master, metrics, interval_ms=2000):
+        self.metrics = metrics
+        self.interval_ms = interval_ms
+
+        self.window = tk.Toplevel(master)
+        self.window.title("診断: 処理時間")
+        self.window.geometry("900x500")
+
+        self.table = ttk.Treeview(self.window, columns=[key for key, _, _ in self.COLUMNS])
+        self.table.heading("#0", text="名前")
+        self.table.column("#0", width=260)
+        for key, heading, width in self.COLUMNS:
+            self.table.heading(key, text=heading)
+            self.table.column(key, width=width, anchor="e")
+        self.table.pack(fill="both", expand=True, padx=10, pady=10)
+
+        ttk.Button(self.window, text="閉じる", command=self.window.destroy).pack(pady=(0, 10))
+        self.refresh()
+
+    def refresh(self):
+        if not self.window.winfo_exists():
+            return
+        summary = self.metrics.summary()
+        self.table.delete(*self.table.get_children())
+        # 遅いものが上に来るように p95 の降順で並べる
+        for name, values in sorted(summary.items(), key=lambda item: item[1]['p95_ms'], reverse=True):
+            self.table.insert("", "end", text=name, values=[
+                values['kind'], values['count'],
+                f"{values['p50_ms']:.2f}", f"{values['p95_ms']:.2f}", f"{values['p99_ms']:.2f}",
+                f"{values['max_ms']:.2f}", values['rows'], values['tokens'],
+            ])
+        self.window.after(self.interval_ms, self.refresh)
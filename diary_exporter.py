@@ -0,0 +1,256 @@
+"""利用者の睡眠日記（記録とAIの助言）の書き出し。医師への共有や表計算・分析ソフトでの利用向け。
+
+記録は ID のキーセットで page_size 件ずつ読み、読んだ分をすぐに書き出すので、履歴が何年分でも
+メモリに載るのは1ページ分だけ。時刻と数値は型付きの列にし、チェック項目は1項目1列の真偽値に展開する。
+
+形式は Parquet / Arrow（pyarrow が必要）と CSV / JSONL。pyarrow がなければ CSV で書き出す。
+
+    python diary_exporter.py diary.parquet --user 1
+"""
+import argparse
+import csv
+import json
+import os
+from datetime import date, datetime
+
+from checklist_catalog import BAD, CATALOG, IMPROVED, MASK_COLUMNS, PRACTICED
+from perf_metrics import METRICS
+from sleep_store import DatabaseManager, SleepStore
+
+
+FORMATS = ('parquet', 'arrow', 'csv', 'jsonl')
+ARROW_FORMATS = ('parquet', 'arrow')
+
+GROUP_TITLES = {PRACTICED: "実践したこと", IMPROVED: "改善が見られた点", BAD: "気になった点"}
+
+# (列名, 型)。型は int / float / date / timestamp / string / bool。点数は入力画面のスケールが小数を保存するので float
+RECORD_COLUMNS = (
+    ('id', 'int'),
+    ('date', 'date'),
+    ('sleep_time', 'timestamp'),
+    ('wake_time', 'timestamp'),
+    ('nap_time', 'timestamp'),
+    ('duration_minutes', 'int'),
+    ('sleep_latency_minutes', 'int'),
+    ('awake_minutes', 'int'),
+    ('sleep_satisfaction', 'float'),
+    ('sleep_quality', 'float'),
+    ('sleep_dissatisfaction', 'float'),
+    ('sleep_anxiety', 'float'),
+    ('sleep_preparation', 'string'),
+    ('sleep_reflection', 'string'),
+    ('bad_points_free', 'string'),
+    ('therapy_notes', 'string'),
+    ('advice', 'string'),
+)
+
+# チェック項目の列は「グループ: 項目」。項目の順番は checklist_items の ID の順
+CHECKLIST_COLUMNS = tuple((f"{GROUP_TITLES[item.group]}: {item.label}", 'bool', item)
+                          for item in CATALOG.items)
+
+COLUMNS = RECORD_COLUMNS + tuple((name, kind) for name, kind, _ in CHECKLIST_COLUMNS)
+
+
+class ExportError(Exception):
+    pass
+
+
+def _timestamp(epoch, text):
+    # 集計用のエポック秒があればそれを、なければ表示用の文字列を読む（どちらもローカル時刻）
+    if epoch is not None:
+        return datetime.fromtimestamp(epoch)
+    if text:
+        try:
+            return datetime.fromisoformat(text)
+        except ValueError:
+            return None
+    return None
+
+
+def export_row(record):
+    """StoredRecord を COLUMNS の順の値（date / datetime / int / float / str / bool）にする。"""
+    try:
+        record_date = date.fromisoformat(record.date) if record.date else None
+    except ValueError:
+        record_date = None
+    row = [
+        record.id,
+        record_date,
+        _timestamp(record.sleep_epoch, record.sleep_time),
+        _timestamp(record.wake_epoch, record.wake_time),
+        _timestamp(None, record.nap_time),
+        record.duration_minutes,
+        record.sleep_latency_minutes,
+        record.awake_minutes,
+        record.sleep_satisfaction,
+        record.sleep_quality,
+        record.sleep_dissatisfaction,
+        record.sleep_anxiety,
+        record.sleep_preparation,
+        record.sleep_reflection,
+        record.bad_points_free,
+        record.therapy_notes,
+        record.advice,
+    ]
+    masks = {group: getattr(record, column) or 0 for group, column in MASK_COLUMNS.items()}
+    row.extend(bool(masks[item.group] & item.mask) for _, _, item in CHECKLIST_COLUMNS)
+    return row
+
+
+def _text(value):
+    # CSV / JSONL での表記。真偽値は表計算ソフトで数えやすいよう 1 / 0 にする
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, datetime):
+        return value.strftime("%Y-%m-%d %H:%M:%S")
+    if isinstance(value, date):
+        return value.isoformat()
+    return value
+
+
+class CsvWriter:
+    def __init__(self, path):
+        # Excel で文字化けしないよう BOM 付きの UTF-8 にする
+        self._file = open(path, "w", encoding="utf-8-sig", newline="")
+        self._writer = csv.writer(self._file)
+        self._writer.writerow([name for name, _ in COLUMNS])
+
+    def write(self, rows):
+        self._writer.writerows([_text(value) for value in row] for row in rows)
+
+    def close(self):
+        self._file.close()
+
+
+class JsonlWriter:
+    def __init__(self, path):
+        self._file = open(path, "w", encoding="utf-8")
+        self._names = [name for name, _ in COLUMNS]
+
+    def write(self, rows):
+        for row in rows:
+            record = {name: _text(value) for name, value in zip(self._names, row)}
+            self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def close(self):
+        self._file.close()
+
+
+class ArrowWriter:
+    """Parquet または Arrow IPC ファイル。ページごとに1つの RecordBatch として書く。"""
+
+    def __init__(self, path, file_format):
+        import pyarrow as pa
+
+        self.pa = pa
+        types = {'int': pa.int64(), 'float': pa.float64(), 'date': pa.date32(), 'timestamp': pa.timestamp('s'),
+                 'string': pa.string(), 'bool': pa.bool_()}
+        self.schema = pa.schema([pa.field(name, types[kind]) for name, kind in COLUMNS])
+        if file_format == 'parquet':
+            import pyarrow.parquet as pq
+
+            self._writer = pq.ParquetWriter(path, self.schema, compression="zstd")
+        else:
+            self._writer = pa.ipc.new_file(path, self.schema)
+
+    def write(self, rows):
+        columns = [list(column) for column in zip(*rows)]
+        self._writer.write_batch(self.pa.RecordBatch.from_arrays(
+            [self.pa.array(values, type=field.type) for values, field in zip(columns, self.schema)],
+            schema=self.schema
+        ))
+
+    def close(self):
+        self._writer.close()
+
+
+def pyarrow_available():
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def resolve_format(path, file_format=None):
+    """(書き出す形式, パス)。Parquet / Arrow で pyarrow がなければ拡張子を .csv にして CSV にする。"""
+    if file_format is None:
+        extension = os.path.splitext(path)[1].lower().lstrip(".")
+        file_format = {'feather': 'arrow', 'ipc': 'arrow', 'json': 'jsonl'}.get(extension, extension)
+    if file_format not in FORMATS:
+        raise ExportError(f"unknown export format: {file_format!r} (use one of {', '.join(FORMATS)})")
+    if file_format in ARROW_FORMATS and not pyarrow_available():
+        print("pyarrow is not installed; exporting as CSV instead")
+        return 'csv', os.path.splitext(path)[0] + ".csv"
+    return file_format, path
+
+
+class DiaryExporter:
+    """db_manager.user_id の利用者の記録を書き出す。
+
+    progress は書き出した件数の累計を受け取る関数。
+    """
+
+    def __init__(self, db_manager, page_size=1000, progress=None):
+        self.store = SleepStore(db_manager)
+        self.page_size = page_size
+        self.progress = progress
+
+    def export(self, path, file_format=None, start_date=None, end_date=None):
+        """{'path', 'format', 'rows'} を返す。書き出し先のパスは形式の切り替えで変わることがある。"""
+        file_format, path = resolve_format(path, file_format)
+        if file_format in ARROW_FORMATS:
+            writer = ArrowWriter(path, file_format)
+        elif file_format == 'csv':
+            writer = CsvWriter(path)
+        else:
+            writer = JsonlWriter(path)
+
+        rows = 0
+        last_id = 0
+        try:
+            while True:
+                with METRICS.timer("export.page", "db") as sample:
+                    records = self.store.records_after(last_id, self.page_size, start_date, end_date)
+                    if records:
+                        writer.write([export_row(record) for record in records])
+                    sample['rows'] = len(records)
+                if not records:
+                    break
+                last_id = records[-1].id
+                rows += len(records)
+                if self.progress:
+                    self.progress(rows)
+        finally:
+            writer.close()
+        return {'path': path, 'format': file_format, 'rows': rows}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="睡眠日記を Parquet / Arrow / CSV / JSONL に書き出す")
+    parser.add_argument("path", help="書き出し先（拡張子で形式を判断する）")
+    parser.add_argument("--db", default="data2.db")
+    parser.add_argument("--user", type=int, default=1, help="利用者ID")
+    parser.add_argument("--shards", type=int, default=1)
+    parser.add_argument("--format", choices=FORMATS)
+    parser.add_argument("--from", dest="start_date", help="この日付以降（YYYY-MM-DD）")
+    parser.add_argument("--to", dest="end_date", help="この日付まで（YYYY-MM-DD）")
+    parser.add_argument("--page-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    db_manager = DatabaseManager(args.db, user_id=args.user, shard_count=args.shards)
+    db_manager.create_tables()
+    exporter = DiaryExporter(db_manager, page_size=args.page_size,
+                             progress=lambda rows: print(f"\r{rows} records", end="", flush=True))
+    try:
+        result = exporter.export(args.path, args.format, args.start_date, args.end_date)
+    except ExportError as e:
+        raise SystemExit(str(e))
+    finally:
+        db_manager.close()
+    print()
+    print(f"Exported {result['rows']} records to {result['path']} ({result['format']})")
+
+
+if __name__ == "__main__":
+    main()
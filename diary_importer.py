@@ -0,0 +1,313 @@
+"""過去の睡眠日記（CSV / JSONL）の一括取り込み。
+
+ファイルは1行ずつ読み、batch_size 行ごとに検証して executemany でまとめて書き込む
+（1バッチが1トランザクション）。メモリに持つのは1バッチ分だけなので、何年分のファイルでも使える。
+読めない行は理由を付けて別ファイル（既定は <元のファイル>.rejects.csv / .rejects.jsonl）に書き出す。
+
+列名は sleep_records の列名（sleep_time, wake_time, sleep_satisfaction, sleep_reflection など）。
+必須は sleep_time と wake_time で、date を省くと起床日になる。時差付きの時刻（+09:00 など）はローカル時刻に直す。
+点数は入力画面と同じ 0〜100。チェック項目は practiced / improved / bad に項目の文章を並べて書ける。
+
+    python diary_importer.py diary.csv --user 1
+"""
+import argparse
+import csv
+import json
+import os
+from datetime import datetime
+
+from checklist_catalog import BAD, CATALOG, IMPROVED, PRACTICED
+from perf_metrics import METRICS
+from sleep_store import SLEEP_RECORD_COLUMNS, DatabaseManager
+from sleep_time_utils import TIME_FORMAT, format_duration, parse_minutes
+
+
+# 一晩の睡眠として受け付ける最長の時間
+MAX_SLEEP_MINUTES = 24 * 60
+
+# 点数の列と、入力画面のスケール（ttk.Scale の from_ / to）の範囲
+SCORE_COLUMNS = ('sleep_satisfaction', 'sleep_quality', 'sleep_dissatisfaction', 'sleep_anxiety')
+SCORE_RANGE = (0, 100)
+MINUTE_COLUMNS = ('sleep_latency_minutes', 'awake_minutes')
+TEXT_COLUMNS = ('sleep_preparation', 'sleep_reflection', 'bad_points_free', 'therapy_notes')
+CHECKLIST_COLUMNS = (('practiced', PRACTICED, 'practiced_mask'),
+                     ('improved', IMPROVED, 'improved_mask'),
+                     ('bad', BAD, 'bad_mask'))
+
+_INSERT_COLUMNS = tuple(column for column in SLEEP_RECORD_COLUMNS
+                        if column not in ('id', 'user_id', 'advice_history_id'))
+_INSERT = f'''INSERT INTO sleep_records ({", ".join(_INSERT_COLUMNS)}, user_id)
+              VALUES ({", ".join("?" for _ in _INSERT_COLUMNS)}, ?)'''
+
+
+class RejectedRow(Exception):
+    pass
+
+
+def parse_time(value, column):
+    if not value:
+        raise RejectedRow(f"{column} is empty")
+    try:
+        # "YYYY-MM-DD HH:MM[:SS]" と ISO 形式（T 区切り）の両方を読める
+        parsed = datetime.fromisoformat(str(value).strip())
+    except ValueError:
+        raise RejectedRow(f"{column} is not a date and time: {value!r}")
+    if parsed.tzinfo is not None:
+        # 時差付きの時刻はローカル時刻に直す（保存する時刻もエポック秒もローカル時刻が基準）
+        try:
+            parsed = parsed.astimezone().replace(tzinfo=None)
+        except (OverflowError, OSError, ValueError):
+            raise RejectedRow(f"{column} is out of range: {value!r}")
+    return parsed
+
+
+def parse_score(value, column):
+    try:
+        score = float(value)
+    except (TypeError, ValueError):
+        raise RejectedRow(f"{column} is not a number: {value!r}")
+    low, high = SCORE_RANGE
+    if not low <= score <= high:  # NaN もここで落ちる
+        raise RejectedRow(f"{column} is not between {low} and {high}: {value!r}")
+    # 入力画面のスケールは小数を保存するので、小数もそのまま受け付ける
+    return int(score) if score.is_integer() else score
+
+
+def parse_mask(value, column, group):
+    try:
+        mask = int(value)
+    except (TypeError, ValueError):
+        raise RejectedRow(f"{column} is not an integer: {value!r}")
+    if mask < 0 or mask & ~CATALOG.encode(CATALOG.group_items(group)):
+        raise RejectedRow(f"{column} has bits that are not checklist items: {value!r}")
+    return mask
+
+
+def parse_record(raw):
+    """ファイルの1行（列名 -> 文字列などの辞書）を sleep_records の列の辞書にする。"""
+    sleep_time = parse_time(raw.get('sleep_time'), 'sleep_time')
+    wake_time = parse_time(raw.get('wake_time'), 'wake_time')
+    if wake_time <= sleep_time:
+        raise RejectedRow("wake_time is not after sleep_time")
+    try:
+        sleep_epoch = int(sleep_time.timestamp())
+        wake_epoch = int(wake_time.timestamp())
+    except (OverflowError, OSError, ValueError):
+        raise RejectedRow("sleep_time or wake_time is out of range")
+    minutes = (wake_epoch - sleep_epoch) // 60
+    if minutes > MAX_SLEEP_MINUTES:
+        raise RejectedRow(f"sleep of {minutes} minutes is longer than {MAX_SLEEP_MINUTES}")
+
+    date = raw.get('date')
+    if date:
+        try:
+            date = datetime.fromisoformat(str(date).strip()).date().isoformat()
+        except ValueError:
+            raise RejectedRow(f"date is not YYYY-MM-DD: {date!r}")
+    else:
+        date = wake_time.date().isoformat()
+
+    record = {
+        'date': date,
+        'sleep_time': sleep_time.strftime(TIME_FORMAT),
+        'wake_time': wake_time.strftime(TIME_FORMAT),
+        'sleep_duration': format_duration(minutes),
+        'sleep_epoch': sleep_epoch,
+        'wake_epoch': wake_epoch,
+        'duration_minutes': minutes,
+    }
+    if raw.get('nap_time'):
+        record['nap_time'] = parse_time(raw['nap_time'], 'nap_time').strftime(TIME_FORMAT)
+    for column in SCORE_COLUMNS:
+        value = raw.get(column)
+        if value not in (None, ""):
+            record[column] = parse_score(value, column)
+    for column in MINUTE_COLUMNS:
+        value = raw.get(column)
+        if value in (None, ""):
+            continue
+        record[column] = parse_minutes(value)
+        if record[column] is None:
+            raise RejectedRow(f"{column} is not a number of minutes: {value!r}")
+    for column in TEXT_COLUMNS:
+        if raw.get(column):
+            record[column] = str(raw[column])
+    for column, group, mask_column in CHECKLIST_COLUMNS:
+        value = raw.get(mask_column)
+        if value not in (None, ""):
+            record[mask_column] = parse_mask(value, mask_column, group)
+        text = raw.get(column)
+        if text:
+            record[mask_column] = (record.get(mask_column) or 0) | CATALOG.encode_text(group, str(text))
+    return record
+
+
+def read_csv(reader):
+    for raw in reader:
+        if None in raw:
+            yield reader.line_num, raw, "row has more fields than the header"
+        else:
+            yield reader.line_num, raw, None
+
+
+def read_jsonl(f):
+    for line_number, line in enumerate(f, 1):
+        if not line.strip():
+            continue
+        try:
+            raw = json.loads(line)
+        except json.JSONDecodeError as e:
+            yield line_number, {'text': line.rstrip("\n")}, f"invalid JSON: {e}"
+            continue
+        if not isinstance(raw, dict):
+            yield line_number, {'text': line.rstrip("\n")}, "line is not a JSON object"
+            continue
+        yield line_number, raw, None
+
+
+class RejectWriter:
+    """取り込めなかった行を元と同じ形式で書き出す。最初の1行が出るまでファイルは作らない。"""
+
+    def __init__(self, path, file_format, fieldnames=None):
+        self.path = path
+        self.file_format = file_format
+        self.fieldnames = fieldnames
+        self.count = 0
+        self._file = None
+        self._writer = None
+
+    def write(self, line_number, raw, error):
+        if self._file is None:
+            self._file = open(self.path, "w", encoding="utf-8", newline="")
+            if self.file_format == 'csv':
+                self._writer = csv.DictWriter(self._file, list(self.fieldnames or []) + ['line', 'error'],
+                                              extrasaction='ignore')
+                self._writer.writeheader()
+        self.count += 1
+        if self.file_format == 'csv':
+            self._writer.writerow(dict(raw, line=line_number, error=error))
+        else:
+            self._file.write(json.dumps({'line': line_number, 'error': error, 'record': raw},
+                                        ensure_ascii=False) + "\n")
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+
+class DiaryImporter:
+    """ファイルの記録を db_manager.user_id の利用者の記録として追加する。
+
+    同じ利用者に同じ日付・起床時刻の記録が既にあれば、重複として取り込まない。
+    progress は (読んだ行数, 取り込んだ行数, 取り込めなかった行数) を受け取る関数。
+    """
+
+    def __init__(self, db_manager, batch_size=1000, progress=None):
+        self.db_manager = db_manager
+        self.batch_size = batch_size
+        self.progress = progress
+
+    def import_file(self, path, reject_path=None, file_format=None):
+        """{'read', 'imported', 'rejected', 'reject_path'} を返す。"""
+        file_format = file_format or ('jsonl' if path.lower().endswith(('.jsonl', '.json')) else 'csv')
+        if file_format not in ('csv', 'jsonl'):
+            raise ValueError(f"unknown format: {file_format}")
+        root, _ = os.path.splitext(path)
+        reject_path = reject_path or f"{root}.rejects.{file_format}"
+
+        with open(path, encoding="utf-8-sig", newline="") as f:
+            if file_format == 'csv':
+                reader = csv.DictReader(f)
+                fieldnames = reader.fieldnames  # 見出しの行だけを読む
+                rows = read_csv(reader)
+            else:
+                rows = read_jsonl(f)
+                fieldnames = None
+            rejects = RejectWriter(reject_path, file_format, fieldnames)
+            try:
+                totals = self._import_rows(rows, rejects)
+            finally:
+                rejects.close()
+        totals['reject_path'] = reject_path if rejects.count else None
+        return totals
+
+    def _import_rows(self, rows, rejects):
+        totals = {'read': 0, 'imported': 0, 'rejected': 0}
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= self.batch_size:
+                self._import_batch(batch, rejects, totals)
+                batch = []
+        if batch:
+            self._import_batch(batch, rejects, totals)
+        return totals
+
+    def _import_batch(self, batch, rejects, totals):
+        records = []
+        for line_number, raw, error in batch:
+            if error is None:
+                try:
+                    records.append((line_number, raw, parse_record(raw)))
+                    continue
+                except RejectedRow as e:
+                    error = str(e)
+            rejects.write(line_number, raw, error)
+
+        user_id = self.db_manager.user_id
+        with METRICS.timer("import.batch", "db") as sample, self.db_manager.transaction() as conn:
+            # 既存の記録との重複は、このバッチの日付の範囲を1回の範囲検索で調べる
+            seen = set()
+            if records:
+                dates = [record['date'] for _, _, record in records]
+                seen = set(conn.execute(
+                    "SELECT date, wake_time FROM sleep_records WHERE user_id = ? AND date BETWEEN ? AND ?",
+                    (user_id, min(dates), max(dates))
+                ).fetchall())
+            values = []
+            for line_number, raw, record in records:
+                key = (record['date'], record['wake_time'])
+                if key in seen:
+                    rejects.write(line_number, raw, "a record with the same date and wake_time already exists")
+                    continue
+                seen.add(key)
+                values.append(tuple(record.get(column) for column in _INSERT_COLUMNS) + (user_id,))
+            conn.executemany(_INSERT, values)
+            sample['rows'] = len(values)
+
+        totals['read'] += len(batch)
+        totals['imported'] += len(values)
+        totals['rejected'] = rejects.count
+        if self.progress:
+            self.progress(totals['read'], totals['imported'], totals['rejected'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="過去の睡眠日記（CSV / JSONL）を取り込む")
+    parser.add_argument("path", help="CSV または JSONL のファイル")
+    parser.add_argument("--db", default="data2.db")
+    parser.add_argument("--user", type=int, default=1, help="取り込み先の利用者ID")
+    parser.add_argument("--shards", type=int, default=1)
+    parser.add_argument("--format", choices=("csv", "jsonl"), help="拡張子から判断できない場合に指定する")
+    parser.add_argument("--rejects", help="取り込めなかった行の書き出し先")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    db_manager = DatabaseManager(args.db, user_id=args.user, shard_count=args.shards)
+    db_manager.create_tables()
+    importer = DiaryImporter(
+        db_manager, batch_size=args.batch_size,
+        progress=lambda read, imported, rejected: print(
+            f"\r{read} rows read, {imported} imported, {rejected} rejected", end="", flush=True)
+    )
+    try:
+        totals = importer.import_file(args.path, args.rejects, args.format)
+    finally:
+        db_manager.close()
+    print()
+    if totals['reject_path']:
+        print(f"Rejected rows were written to {totals['reject_path']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+"""日記（睡眠の振り返り・自由記入・AIの助言）の全文検索。
+
+FTS5 の trigram トークナイザで索引を作るので、日本語でも単語の区切りなしに部分一致で検索できる。
+索引（diary_fts）は元のテーブルのトリガーで保たれる。rowid は元の行から計算できる値にしておき、
+更新・削除のときに rowid だけで索引の行を特定する。
+
+3文字未満の語は trigram で引けないため、その語だけ LIKE で絞り込む。
+
+利用者ごとの記録がある data2.db では、索引の owner 列に利用者のキー（owner_key）を入れ、
+MATCH の条件に含める。検索はその利用者の行の転置リストだけを辿る。
+"""
+DIARY_FTS_TABLE = '''CREATE VIRTUAL TABLE IF NOT EXISTS diary_fts
+    USING fts5(body, kind UNINDEXED, date UNINDEXED, tokenize = 'trigram')'''
+
+DIARY_FTS_OWNER_TABLE = '''CREATE VIRTUAL TABLE IF NOT EXISTS diary_fts
+    USING fts5(body, owner, kind UNINDEXED, date UNINDEXED, tokenize = 'trigram')'''
+
+# 桁数をそろえるので、あるキーが別のキーの部分文字列として一致することはない
+OWNER_KEY_SQL = "printf('u%010d', {row}.user_id)"
+
+
+def owner_key(user_id):
+    return f"u{int(user_id):010d}"
+
+
+def _text(columns, row):
+    return " || char(10) || ".join(f"coalesce({row}.{column}, '')" for column in columns)
+
+
+def _index_columns(owner):
+    return "rowid, body, owner, kind, date" if owner else "rowid, body, kind, date"
+
+
+def _index_values(kind, rowid, columns, owner, row):
+    values = [rowid.format(row=row), _text(columns, row)]
+    if owner:
+        values.append(owner.format(row=row))
+    return ", ".join(values + [f"'{kind}'", f"{row}.date"])
+
+
+def index_triggers(table, kind, rowid, columns, owner=None):
+    """table の行を diary_fts に反映するトリガー。rowid と owner は {row} を OLD / NEW に置き換える式。"""
+    name = f"trg_diary_fts_{kind}"
+    insert = (f"INSERT INTO diary_fts ({_index_columns(owner)}) "
+              f"VALUES ({_index_values(kind, rowid, columns, owner, 'NEW')})")
+    delete = f"DELETE FROM diary_fts WHERE rowid = {rowid.format(row='OLD')}"
+    updated = ", ".join(("date",) + tuple(columns) + (("user_id",) if owner else ()))
+    return [
+        f"CREATE TRIGGER IF NOT EXISTS {name}_insert AFTER INSERT ON {table} BEGIN {insert}; END",
+        f"CREATE TRIGGER IF NOT EXISTS {name}_delete AFTER DELETE ON {table} BEGIN {delete}; END",
+        f'''CREATE TRIGGER IF NOT EXISTS {name}_update AFTER UPDATE OF {updated} ON {table}
+            BEGIN {delete}; {insert}; END''',
+    ]
+
+
+def index_backfill(table, kind, rowid, columns, owner=None):
+    """既存の行を索引に入れるSQL。"""
+    return (f"INSERT INTO diary_fts ({_index_columns(owner)}) "
+            f"SELECT {_index_values(kind, rowid, columns, owner, table)} FROM {table}")
+
+
+# data2.db: 記録（寝る前の準備・振り返り）は id * 2、助言は id * 2 + 1
+DATA2_SOURCES = [
+    ('sleep_records', 'record', "{row}.id * 2", ('sleep_preparation', 'sleep_reflection')),
+    ('advice_history', 'advice', "{row}.id * 2 + 1", ('advice',)),
+]
+
+# user_id 列の追加後（v10〜）の data2.db。rowid は同じで、owner 列に利用者のキーを入れる
+DATA2_USER_SOURCES = [source + (OWNER_KEY_SQL,) for source in DATA2_SOURCES]
+
+# 共通のストレージ（v11〜）。不眠症アプリから取り込んだ自由記入の列も記録の本文に含める
+STORE_SOURCES = [
+    ('sleep_records', 'record', "{row}.id * 2",
+     ('sleep_preparation', 'sleep_reflection', 'bad_points_free', 'therapy_notes'), OWNER_KEY_SQL),
+    ('advice_history', 'advice', "{row}.id * 2 + 1", ('advice',), OWNER_KEY_SQL),
+]
+
+# sleep_data.db: 記録の rowid をそのまま使う
+SLEEP_DATA_SOURCES = [
+    ('sleep_records', 'record', "{row}.rowid", ('good_points_free', 'bad_points_free', 'therapy_notes', 'ai_advice')),
+]
+
+
+def search_index_steps(sources):
+    """マイグレーションのステップ（索引の作成・既存の行の投入・トリガー）。"""
+    owned = any(len(source) > 4 for source in sources)
+    steps = [DIARY_FTS_OWNER_TABLE if owned else DIARY_FTS_TABLE]
+    for source in sources:
+        steps.append(index_backfill(*source))
+        steps.extend(index_triggers(*source))
+    return steps
+
+
+def drop_search_index_steps(sources):
+    """索引とトリガーを削除するSQL。索引の列を変えるマイグレーションで使う。"""
+    steps = []
+    for source in sources:
+        name = f"trg_diary_fts_{source[1]}"
+        steps.extend(f"DROP TRIGGER IF EXISTS {name}_{event}" for event in ("insert", "delete", "update"))
+    steps.append("DROP TABLE IF EXISTS diary_fts")
+    return steps
+
+
+def rebuild_search_index(conn, sources):
+    conn.execute("DELETE FROM diary_fts")
+    for source in sources:
+        conn.execute(index_backfill(*source))
+
+
+def build_match(text):
+    """入力をFTS5の条件に変換する。(MATCH の式 or None, LIKE のパターンのリスト) を返す。
+
+    各語はフレーズとして引用するので、入力に FTS5 の記号が含まれていても構文エラーにならない。
+    """
+    phrases = []
+    patterns = []
+    for term in text.split():
+        if len(term) >= 3:
+            phrases.append('"' + term.replace('"', '""') + '"')
+        else:
+            escaped = term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            patterns.append(f"%{escaped}%")
+    return (" AND ".join(phrases) or None), patterns
+
+
+class DiarySearch:
+    """diary_fts の検索。execute_query は (SQL, パラメータ) を受け取って行のリストを返す関数。
+
+    user_id を渡すと、その利用者の行だけを検索する（owner 列のある索引が必要）。
+    """
+
+    def __init__(self, execute_query, page_size=20, user_id=None):
+        self.execute_query = execute_query
+        self.page_size = page_size
+        self.user_id = user_id
+
+    def search(self, text, page=0):
+        """([(rowid, kind, date, 抜粋), ...], 次のページがあるか) を返す。"""
+        terms, patterns = build_match(text)
+        if not terms and not patterns:
+            return [], False
+
+        match = terms
+        if self.user_id is not None:
+            # 語は本文だけに一致させ、利用者のキーとは AND でつなぐ
+            owner = f'owner : "{owner_key(self.user_id)}"'
+            match = f"{owner} AND body : ({terms})" if terms else owner
+        conditions = []
+        params = []
+        if match:
+            conditions.append("diary_fts MATCH ?")
+            params.append(match)
+        for pattern in patterns:
+            conditions.append("body LIKE ? ESCAPE '\\'")
+            params.append(pattern)
+        # 関連度（bm25）は語の MATCH があるときだけ使える。短い語だけのときは新しい順
+        order = "rank, date DESC" if terms else "date DESC"
+        snippet = ("snippet(diary_fts, 0, '【', '】', '…', 16)" if terms
+                   else "substr(body, 1, 60)")
+        # ページは OFFSET で数える。関連度順のキーセットは作れないが、1ページは少ないので十分速い
+        query = f'''SELECT rowid, kind, date, {snippet} FROM diary_fts
+                    WHERE {" AND ".join(conditions)}
+                    ORDER BY {order}
+                    LIMIT ? OFFSET ?'''
+        params.extend([self.page_size + 1, page * self.page_size])
+        rows = self.execute_query(query, params) or []
+        return rows[:self.page_size], len(rows) > self.page_size
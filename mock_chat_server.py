@@ -0,0 +1,166 @@
+"""chat.completions エンドポイントのローカル代替サーバー。
+
+再試行キューやベンチマークを本物のAPIなしで試すためのもの。遅延と失敗率を指定できる。
+
+    python mock_chat_server.py --port 8765 --latency 0.5 --failure-rate 0.3
+    OPENAI_BASE_URL=http://127.0.0.1:8765/v1 OPENAI_API_KEY=dummy python 睡眠改善支援アプリ2.py
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+DEFAULT_REPLY = "記録を拝見しました。起床時刻を一定に保つことから始めてみると、変化があるかも知れません。"
+
+
+class MockChatServer:
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, latency_jitter=0.0,
+                 failure_rate=0.0, failure_status=503, reply=DEFAULT_REPLY,
+                 chunk_chars=8, seed=None):
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.failure_rate = failure_rate  # 1.0 にすると常に失敗する（オフライン状態の再現）
+        self.failure_status = failure_status
+        self.reply = reply
+        self.chunk_chars = chunk_chars
+        self.rng = random.Random(seed)
+        self.request_count = 0
+        self.failure_count = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._make_handler())
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _should_fail(self):
+        with self._lock:
+            self.request_count += 1
+            fail = self.rng.random() < self.failure_rate
+            if fail:
+                self.failure_count += 1
+            return fail
+
+    def _delay(self):
+        with self._lock:
+            jitter = self.rng.uniform(0, self.latency_jitter) if self.latency_jitter else 0.0
+        return self.latency + jitter
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = json.loads(self.rfile.read(length) or b"{}")
+                if not self.path.endswith("/chat/completions"):
+                    self._send_json(404, {"error": {"message": "not found"}})
+                    return
+
+                time.sleep(server._delay())
+                if server._should_fail():
+                    self._send_json(server.failure_status, {"error": {"message": "injected failure"}})
+                    return
+
+                model = body.get("model", "mock")
+                if body.get("stream"):
+                    self._send_stream(model)
+                else:
+                    self._send_json(200, {
+                        "id": "chatcmpl-mock",
+                        "object": "chat.completion",
+                        "created": int(time.time()),
+                        "model": model,
+                        "choices": [{
+                            "index": 0,
+                            "message": {"role": "assistant", "content": server.reply},
+                            "finish_reason": "stop",
+                        }],
+                        "usage": {
+                            "prompt_tokens": sum(len(m.get("content", "")) for m in body.get("messages", [])),
+                            "completion_tokens": len(server.reply),
+                            "total_tokens": 0,
+                        },
+                    })
+
+            def _send_json(self, status, payload):
+                data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _send_stream(self, model):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.end_headers()
+                reply = server.reply
+                for start in range(0, len(reply), server.chunk_chars):
+                    chunk = {
+                        "id": "chatcmpl-mock",
+                        "object": "chat.completion.chunk",
+                        "created": int(time.time()),
+                        "model": model,
+                        "choices": [{
+                            "index": 0,
+                            "delta": {"content": reply[start:start + server.chunk_chars]},
+                            "finish_reason": None,
+                        }],
+                    }
+                    self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+                    self.wfile.flush()
+                self.wfile.write(b"data: [DONE]\n\n")
+                self.wfile.flush()
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="chat.completions のローカル代替サーバー")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.0, help="応答までの秒数")
+    parser.add_argument("--latency-jitter", type=float, default=0.0)
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="0〜1の失敗させる割合")
+    parser.add_argument("--failure-status", type=int, default=503)
+    args = parser.parse_args()
+
+    server = MockChatServer(
+        host=args.host, port=args.port, latency=args.latency, latency_jitter=args.latency_jitter,
+        failure_rate=args.failure_rate, failure_status=args.failure_status
+    )
+    print(f"Mock chat server listening on {server.base_url}")
+    try:
+        server._server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server._server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+"""処理時間の計測（DBのクエリ・AIの呼び出し・画面の更新）。
+
+計測値はメモリ上のリングバッファに入れ、名前ごとの累積ヒストグラムも持つ。print と違って
+記録はリストへの追加だけなので、毎回の呼び出しで使ってもコンソールの入出力は発生しない。
+
+flush_to_table は前回から増えた分の p50/p95/p99 を perf_metrics テーブルに書き、
+write_prometheus は累積値を Prometheus のテキスト形式で書き出す。
+アプリは環境変数 SLEEP_APP_METRICS_FILE にパスがあれば、定期的にそこへ書き出す。
+"""
+import bisect
+import functools
+import os
+import re
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+
+PROMETHEUS_ENV = "SLEEP_APP_METRICS_FILE"
+
+# ヒストグラムの区切り（ミリ秒）
+BUCKETS_MS = (0.1, 0.5, 1, 5, 10, 50, 100, 500, 1000, 5000, 30000)
+
+PERF_METRICS_TABLES = [
+    '''CREATE TABLE IF NOT EXISTS perf_metrics
+        (flushed_at REAL,
+        name TEXT,
+        kind TEXT,
+        count INTEGER,
+        p50_ms REAL,
+        p95_ms REAL,
+        p99_ms REAL,
+        max_ms REAL,
+        rows INTEGER,
+        tokens INTEGER)''',
+    "CREATE INDEX IF NOT EXISTS idx_perf_metrics_name ON perf_metrics(name, flushed_at)",
+]
+
+_STATEMENT = re.compile(r"^\s*(SELECT|INSERT|UPDATE|DELETE|REPLACE)\b.*?\b(?:FROM|INTO|UPDATE)\s+(\w+)",
+                        re.IGNORECASE | re.DOTALL)
+
+
+@functools.lru_cache(maxsize=512)
+def query_name(query):
+    """SQL文から "db.select.sleep_records" のような名前を作る。同じ文字列の解析は一度だけ。"""
+    match = _STATEMENT.match(query)
+    if match:
+        return f"db.{match.group(1).lower()}.{match.group(2)}"
+    return "db." + (query.split(None, 1)[0].lower() if query.strip() else "empty")
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+class Metrics:
+    def __init__(self, capacity=5000, clock=time.perf_counter):
+        self.clock = clock
+        self._samples = deque(maxlen=capacity)  # (連番, 名前, 種類, ミリ秒, 行数, トークン数)
+        self._totals = {}  # 名前 -> 累積値（Prometheus 用）
+        self._sequence = 0
+        self._flushed_sequence = 0
+        self._lock = threading.Lock()
+
+    def record(self, name, kind, elapsed_ms, rows=None, tokens=None):
+        with self._lock:
+            self._sequence += 1
+            self._samples.append((self._sequence, name, kind, elapsed_ms, rows, tokens))
+            totals = self._totals.get(name)
+            if totals is None:
+                totals = self._totals[name] = {
+                    'kind': kind, 'count': 0, 'sum_ms': 0.0, 'rows': 0, 'tokens': 0,
+                    'buckets': [0] * (len(BUCKETS_MS) + 1),
+                }
+            totals['count'] += 1
+            totals['sum_ms'] += elapsed_ms
+            totals['rows'] += rows or 0
+            totals['tokens'] += tokens or 0
+            totals['buckets'][bisect.bisect_left(BUCKETS_MS, elapsed_ms)] += 1
+
+    @contextmanager
+    def timer(self, name, kind):
+        """with METRICS.timer(...) as sample: の中で sample['rows'] / sample['tokens'] を設定できる。"""
+        sample = {'rows': None, 'tokens': None}
+        started = self.clock()
+        try:
+            yield sample
+        finally:
+            self.record(name, kind, (self.clock() - started) * 1000, sample['rows'], sample['tokens'])
+
+    def timed(self, name, kind="ui"):
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.timer(name, kind):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def summary(self, since=0):
+        """名前ごとの件数・p50/p95/p99・最大・行数・トークン数（リングバッファに残っている分）。"""
+        with self._lock:
+            samples = [sample for sample in self._samples if sample[0] > since]
+        grouped = {}
+        for _, name, kind, elapsed_ms, rows, tokens in samples:
+            entry = grouped.setdefault(name, {'kind': kind, 'times': [], 'rows': 0, 'tokens': 0})
+            entry['times'].append(elapsed_ms)
+            entry['rows'] += rows or 0
+            entry['tokens'] += tokens or 0
+        result = {}
+        for name, entry in grouped.items():
+            times = sorted(entry['times'])
+            result[name] = {
+                'kind': entry['kind'],
+                'count': len(times),
+                'p50_ms': percentile(times, 0.50),
+                'p95_ms': percentile(times, 0.95),
+                'p99_ms': percentile(times, 0.99),
+                'max_ms': times[-1],
+                'rows': entry['rows'],
+                'tokens': entry['tokens'],
+            }
+        return result
+
+    def flush_to_table(self, conn):
+        """前回の flush 以降の計測を perf_metrics に書き込む。コミットは呼び出し側で行う。"""
+        with self._lock:
+            since = self._flushed_sequence
+            self._flushed_sequence = self._sequence
+        summary = self.summary(since)
+        if not summary:
+            return 0
+        now = time.time()
+        conn.executemany(
+            '''INSERT INTO perf_metrics
+               (flushed_at, name, kind, count, p50_ms, p95_ms, p99_ms, max_ms, rows, tokens)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+            [(now, name, s['kind'], s['count'], s['p50_ms'], s['p95_ms'], s['p99_ms'], s['max_ms'],
+              s['rows'], s['tokens']) for name, s in summary.items()]
+        )
+        return len(summary)
+
+    def prometheus_text(self):
+        with self._lock:
+            totals = {name: dict(values, buckets=list(values['buckets'])) for name, values in self._totals.items()}
+        lines = [
+            "# HELP sleep_app_latency_ms Latency of queries, AI calls and UI refreshes in milliseconds.",
+            "# TYPE sleep_app_latency_ms histogram",
+        ]
+        for name, values in sorted(totals.items()):
+            labels = f'name="{name}",kind="{values["kind"]}"'
+            cumulative = 0
+            for bound, count in zip(BUCKETS_MS + ("+Inf",), values['buckets']):
+                cumulative += count
+                lines.append(f'sleep_app_latency_ms_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f"sleep_app_latency_ms_sum{{{labels}}} {values['sum_ms']:.3f}")
+            lines.append(f"sleep_app_latency_ms_count{{{labels}}} {values['count']}")
+        lines.append("# TYPE sleep_app_rows_total counter")
+        for name, values in sorted(totals.items()):
+            lines.append(f'sleep_app_rows_total{{name="{name}"}} {values["rows"]}')
+        lines.append("# TYPE sleep_app_tokens_total counter")
+        for name, values in sorted(totals.items()):
+            if values['tokens']:
+                lines.append(f'sleep_app_tokens_total{{name="{name}"}} {values["tokens"]}')
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        # 読み取り側が書きかけのファイルを読まないよう、一時ファイルから置き換える
+        temp_path = f"{path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            f.write(self.prometheus_text())
+        os.replace(temp_path, path)
+
+
+METRICS = Metrics()
+
+
+def usage_tokens(response):
+    usage = getattr(response, 'usage', None)
+    if usage is None:
+        return None
+    total = getattr(usage, 'total_tokens', None)
+    if total:
+        return total
+    return (getattr(usage, 'prompt_tokens', 0) or 0) + (getattr(usage, 'completion_tokens', 0) or 0)
@@ -0,0 +1,209 @@
+from datetime import datetime
+
+from sleep_time_utils import format_duration
+
+
+SCORE_FIELDS = (
+    ('sleep_satisfaction', '満足'),
+    ('sleep_quality', '快眠'),
+    ('sleep_dissatisfaction', '不満'),
+    ('sleep_anxiety', '不安'),
+)
+
+
+def estimate_tokens(text):
+    # 日本語は1文字1トークン、英数字は4文字1トークン程度として見積もる
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    return (len(text) - ascii_chars) + ascii_chars // 4 + 1
+
+
+def _as_dict(record):
+    if isinstance(record, dict):
+        return record
+    if hasattr(record, '_asdict'):
+        return record._asdict()
+    raise TypeError(f"unsupported record type: {type(record).__name__}")
+
+
+def _clip(text, limit):
+    text = " ".join((text or "").split())
+    return text if len(text) <= limit else text[:limit] + "…"
+
+
+def _mean(values):
+    values = [v for v in values if v is not None]
+    return sum(values) / len(values) if values else None
+
+
+def _fmt_score(value):
+    return "-" if value is None else str(int(round(value)))
+
+
+def _cost(lines):
+    return sum(estimate_tokens(line) for line in lines)
+
+
+NIGHT_HEADING = "夜ごと: 日付|就寝|起床|睡眠|満足|快眠|不満|不安"
+WEEK_HEADING = "それ以前（週ごと）: 週|件数|平均睡眠|満足|快眠|不満|不安"
+MONTH_HEADING = "それ以前（月ごと）: 月|件数|平均睡眠|満足|快眠|不満|不安"
+
+
+class PromptEncoder:
+    """睡眠記録の範囲を、AIに送るための短く決定的なテキストに変換する。
+
+    直近の夜は1行ずつ、予算を超える古い夜は週ごと（さらに長ければ月ごと）の集計行にまとめるので、
+    期間が長くなってもトークン数はほぼ一定に抑えられる。詳細行は集計行の分（予算の group_share）を
+    残して追加し、月ごとでも収まらない古い月は1行にまとめる。
+    """
+
+    def __init__(self, token_budget=800, latest_text_chars=300, text_chars=40, advice_chars=80, group_share=1 / 3):
+        self.token_budget = token_budget
+        self.latest_text_chars = latest_text_chars
+        self.text_chars = text_chars
+        self.advice_chars = advice_chars
+        self.group_share = group_share
+
+    def encode(self, sleep_data):
+        records = [sleep_data] if isinstance(sleep_data, dict) else list(sleep_data or [])
+        records = sorted((_as_dict(r) for r in records), key=lambda r: str(r.get('date')), reverse=True)
+        if not records:
+            return "記録なし"
+
+        lines = self._summary_lines(records)
+        latest_advice = next((r.get('advice') for r in records if r.get('advice')), None)
+        advice_lines = [f"直近の助言: {_clip(latest_advice, self.advice_chars)}"] if latest_advice else []
+        budget = self.token_budget - _cost(lines + advice_lines + [NIGHT_HEADING])
+
+        # 直近の夜から予算の範囲で詳細行を追加する（直近の1夜は必ず入れる）
+        night_lines = []
+        costs = []
+        for index, record in enumerate(records):
+            line = self._night_line(record, latest=(index == 0))
+            cost = estimate_tokens(line)
+            if index > 0 and sum(costs) + cost > budget:
+                break
+            night_lines.append(line)
+            costs.append(cost)
+
+        group_lines = []
+        if len(night_lines) < len(records):
+            # 入りきらない夜があれば、集計行の分を残すまで古い詳細行を外してからまとめる
+            detail_budget = budget - int(budget * self.group_share)
+            while len(night_lines) > 1 and sum(costs) > detail_budget:
+                night_lines.pop()
+                costs.pop()
+            group_lines = self._fit_group_lines(records[len(night_lines):], budget - sum(costs))
+
+        return "\n".join(lines + [NIGHT_HEADING] + night_lines + group_lines + advice_lines)
+
+    def _fit_group_lines(self, records, budget):
+        # 日付は一度だけ読み、週ごと、月ごとの順に予算に収まるものを使う
+        dated = []
+        for record in records:
+            try:
+                dated.append((datetime.strptime(str(record.get('date')), "%Y-%m-%d"), record))
+            except ValueError:
+                continue
+        for heading, period_key in ((WEEK_HEADING, _week_key), (MONTH_HEADING, _month_key)):
+            group_lines = [heading] + self._group_lines(dated, period_key)
+            if _cost(group_lines) <= budget:
+                return group_lines
+
+        # 月ごとでも収まらなければ、新しい月から入るだけ残し、それより古い月を1行にまとめる
+        months = group_lines[1:]
+        kept = []
+        budget -= estimate_tokens(MONTH_HEADING)
+        for line in months:
+            if _cost(kept) + estimate_tokens(line) > budget:
+                break
+            kept.append(line)
+        while True:
+            merged = months[len(kept):]
+            newest, oldest = merged[0].split("|")[0], merged[-1].split("|")[0]
+            label = f"{oldest}〜{newest}"
+            merged_line = self._group_lines(dated, lambda day: label if _month_key(day) <= newest else None)
+            if _cost(kept + merged_line) <= budget:
+                return [MONTH_HEADING] + kept + merged_line
+            if not kept:
+                return []  # 1行にまとめても入らない。期間全体は最初の要約行に含まれている
+            kept.pop()
+
+    def _summary_lines(self, records):
+        durations = [r.get('duration_minutes') for r in records]
+        known = [d for d in durations if d is not None]
+        lines = [f"期間: {records[-1].get('date')}〜{records[0].get('date')}（記録{len(records)}件）"]
+        if known:
+            lines.append(
+                f"平均睡眠: {format_duration(sum(known) // len(known))}"
+                f"（最短 {format_duration(min(known))} / 最長 {format_duration(max(known))}）"
+            )
+        scores = " ".join(
+            f"{label}{_fmt_score(_mean([r.get(field) for r in records]))}" for field, label in SCORE_FIELDS
+        )
+        lines.append(f"平均スコア(0-100): {scores}")
+
+        if len(records) >= 4:
+            # 古い半分と新しい半分の平均を比べて傾向を示す
+            half = len(records) // 2
+            newer, older = records[:half], records[half:]
+            trend = []
+            newer_duration = _mean([r.get('duration_minutes') for r in newer])
+            older_duration = _mean([r.get('duration_minutes') for r in older])
+            if newer_duration is not None and older_duration is not None:
+                trend.append(f"睡眠{int(round(newer_duration - older_duration)):+d}分")
+            for field, label in SCORE_FIELDS:
+                newer_score = _mean([r.get(field) for r in newer])
+                older_score = _mean([r.get(field) for r in older])
+                if newer_score is not None and older_score is not None:
+                    trend.append(f"{label}{int(round(newer_score - older_score)):+d}")
+            if trend:
+                lines.append(f"傾向（前半→後半）: {' '.join(trend)}")
+        return lines
+
+    def _night_line(self, record, latest=False):
+        sleep_time = str(record.get('sleep_time') or '')
+        wake_time = str(record.get('wake_time') or '')
+        minutes = record.get('duration_minutes')
+        fields = [
+            str(record.get('date'))[5:],
+            sleep_time[11:16] or '-',
+            wake_time[11:16] or '-',
+            '-' if minutes is None else str(minutes),
+        ] + [_fmt_score(record.get(field)) for field, _ in SCORE_FIELDS]
+        line = "|".join(fields)
+
+        limit = self.latest_text_chars if latest else self.text_chars
+        notes = []
+        if record.get('sleep_preparation'):
+            notes.append(f"前:{_clip(record['sleep_preparation'], limit)}")
+        if record.get('sleep_reflection'):
+            notes.append(f"後:{_clip(record['sleep_reflection'], limit)}")
+        if notes:
+            line += " " + " ".join(notes)
+        return line
+
+    def _group_lines(self, dated, period_key):
+        # dated は (日付, 記録) のリスト
+        groups = {}
+        for day, record in dated:
+            period = period_key(day)
+            if period is not None:
+                groups.setdefault(period, []).append(record)
+
+        lines = []
+        for period in sorted(groups, reverse=True):
+            group = groups[period]
+            duration = _mean([r.get('duration_minutes') for r in group])
+            fields = [period, str(len(group)), '-' if duration is None else str(int(round(duration)))]
+            fields += [_fmt_score(_mean([r.get(field) for r in group])) for field, _ in SCORE_FIELDS]
+            lines.append("|".join(fields))
+        return lines
+
+
+def _week_key(day):
+    year, week, _ = day.isocalendar()
+    return f"{year}-W{week:02d}"
+
+
+def _month_key(day):
+    return day.strftime("%Y-%m")
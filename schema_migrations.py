@@ -0,0 +1,266 @@
+from change_feed import CHANGE_FEED_TABLES, change_feed_triggers
+from checklist_catalog import CHECKLIST_TABLES, backfill_masks, seed_catalog
+from diary_search import (DATA2_SOURCES, DATA2_USER_SOURCES, SLEEP_DATA_SOURCES, STORE_SOURCES,
+                          drop_search_index_steps, search_index_steps)
+from perf_metrics import PERF_METRICS_TABLES
+from sleep_aggregates import (drop_period_stats_steps, period_stats_table, period_stats_triggers,
+                              rebuild as rebuild_period_stats, rebuild_unscoped, replace_update_trigger_steps)
+
+# 各マイグレーションは (バージョン, 説明, ステップのリスト)。
+# ステップはSQL文字列か、接続を受け取る関数（データの変換などに使う）。
+# 適用済みのバージョンは PRAGMA user_version に記録する。
+
+# sleep_time / wake_time はローカル時刻の文字列なので、'utc' 修飾子でエポック秒に直す
+BACKFILL_EPOCHS = '''UPDATE sleep_records
+    SET sleep_epoch = CAST(strftime('%s', sleep_time, 'utc') AS INTEGER),
+        wake_epoch = CAST(strftime('%s', wake_time, 'utc') AS INTEGER)'''
+
+BACKFILL_DURATION_MINUTES = '''UPDATE sleep_records
+    SET duration_minutes = (wake_epoch - sleep_epoch
+        + CASE WHEN wake_epoch <= sleep_epoch THEN 86400 ELSE 0 END) / 60
+    WHERE sleep_epoch IS NOT NULL AND wake_epoch IS NOT NULL'''
+
+# 送信できなかったAI助言のリクエスト（advice_queue.OfflineAdviceQueue）。どちらのDBでも同じ定義
+ADVICE_JOBS_TABLES = [
+    '''CREATE TABLE IF NOT EXISTS advice_jobs
+        (id INTEGER PRIMARY KEY AUTOINCREMENT,
+        target TEXT,
+        messages TEXT,
+        status TEXT,
+        attempts INTEGER,
+        next_attempt_at REAL,
+        last_error TEXT,
+        created_at REAL,
+        updated_at REAL)''',
+    "CREATE INDEX IF NOT EXISTS idx_advice_jobs_due ON advice_jobs(status, next_attempt_at)",
+]
+
+# storage_migrator が以前のファイルを取り込んだ進み具合と、元の行から取り込み先の行への対応
+STORAGE_IMPORT_TABLES = [
+    '''CREATE TABLE IF NOT EXISTS storage_imports
+        (source TEXT PRIMARY KEY,
+        kind TEXT,
+        user_id INTEGER,
+        phase TEXT,
+        last_rowid INTEGER,
+        rows INTEGER,
+        status TEXT,
+        updated_at REAL)''',
+    '''CREATE TABLE IF NOT EXISTS storage_import_map
+        (source TEXT,
+        source_table TEXT,
+        source_rowid INTEGER,
+        target_id INTEGER,
+        PRIMARY KEY (source, source_table, source_rowid)) WITHOUT ROWID''',
+]
+
+DATA2_MIGRATIONS = [
+    (1, "初期テーブル", [
+        '''CREATE TABLE IF NOT EXISTS sleep_records
+            (id INTEGER PRIMARY KEY AUTOINCREMENT,
+            date TEXT,
+            sleep_time TEXT,
+            wake_time TEXT,
+            sleep_duration TEXT,
+            sleep_satisfaction INTEGER,
+            sleep_quality INTEGER,
+            sleep_dissatisfaction INTEGER,
+            sleep_anxiety INTEGER,
+            sleep_preparation TEXT,
+            sleep_reflection TEXT,
+            advice_history_id INTEGER)''',
+        '''CREATE TABLE IF NOT EXISTS advice_history
+            (id INTEGER PRIMARY KEY,
+            advice TEXT,
+            date TEXT,
+            FOREIGN KEY(id) REFERENCES sleep_records(id))''',
+        '''CREATE TABLE IF NOT EXISTS user_profiles
+            (id INTEGER PRIMARY KEY AUTOINCREMENT,
+            nickname TEXT,
+            sleep_medication TEXT,
+            medication_reduction TEXT,
+            advice_intensity TEXT)''',
+        '''CREATE TABLE IF NOT EXISTS cbt_info
+            (id INTEGER PRIMARY KEY,
+            content TEXT)''',
+    ]),
+    (2, "日付列のインデックス", [
+        # get_sleep_records の date BETWEEN と ORDER BY date
+        "CREATE INDEX IF NOT EXISTS idx_sleep_records_date ON sleep_records(date)",
+        # get_advice_for_date / fetch_advice_for_record / AdviceDateIndex をインデックスだけで解決する
+        "CREATE INDEX IF NOT EXISTS idx_advice_history_date ON advice_history(date, advice)",
+    ]),
+    (3, "睡眠時刻の数値列", [
+        # 表示用の文字列とは別に、集計用のエポック秒と分単位の睡眠時間を持つ。既存の行はSQLで一括変換する
+        "ALTER TABLE sleep_records ADD COLUMN sleep_epoch INTEGER",
+        "ALTER TABLE sleep_records ADD COLUMN wake_epoch INTEGER",
+        "ALTER TABLE sleep_records ADD COLUMN duration_minutes INTEGER",
+        BACKFILL_EPOCHS,
+        BACKFILL_DURATION_MINUTES,
+    ]),
+    (4, "AI助言の応答キャッシュ", [
+        '''CREATE TABLE IF NOT EXISTS advice_cache
+            (key TEXT PRIMARY KEY,
+            advice TEXT,
+            created_at INTEGER,
+            last_used_at INTEGER)''',
+        "CREATE INDEX IF NOT EXISTS idx_advice_cache_last_used ON advice_cache(last_used_at)",
+    ]),
+    (5, "AI助言の再試行キュー", [
+        *ADVICE_JOBS_TABLES,
+    ]),
+    (6, "睡眠効率の計算用の列", [
+        # 寝付くまでの時間と夜中に目覚めていた時間（分）。既存の行は不明（NULL）のまま
+        "ALTER TABLE sleep_records ADD COLUMN sleep_latency_minutes INTEGER",
+        "ALTER TABLE sleep_records ADD COLUMN awake_minutes INTEGER",
+    ]),
+    (7, "日・週・月ごとの集計テーブル", [
+        # 集計はトリガーで保たれる。既存の記録からは一度だけ作り直す
+        period_stats_table(()),
+        *period_stats_triggers(()),
+        rebuild_unscoped,
+    ]),
+    (8, "振り返りと助言の全文検索", [
+        *search_index_steps(DATA2_SOURCES),
+    ]),
+    (9, "処理時間の計測値", [
+        *PERF_METRICS_TABLES,
+    ]),
+    (10, "利用者ごとの記録と助言", [
+        # 既存の行は、これまで唯一の利用者だったプロフィール1のもの
+        "ALTER TABLE sleep_records ADD COLUMN user_id INTEGER NOT NULL DEFAULT 1",
+        "ALTER TABLE advice_history ADD COLUMN user_id INTEGER NOT NULL DEFAULT 1",
+        # 利用者ごとのクエリはすべて user_id で始まるインデックスの範囲検索にする
+        "CREATE INDEX IF NOT EXISTS idx_sleep_records_user_date ON sleep_records(user_id, date)",
+        "CREATE INDEX IF NOT EXISTS idx_advice_history_user_date ON advice_history(user_id, date)",
+        "DROP INDEX IF EXISTS idx_sleep_records_date",
+        "DROP INDEX IF EXISTS idx_advice_history_date",
+        # 集計と全文検索の索引も利用者ごとに作り直す
+        *drop_period_stats_steps(),
+        period_stats_table(),
+        *period_stats_triggers(),
+        rebuild_period_stats,
+        *drop_search_index_steps(DATA2_SOURCES),
+        *search_index_steps(DATA2_USER_SOURCES),
+    ]),
+    (11, "不眠症アプリと共通のストレージ", [
+        # 不眠症アプリの記録の列。助言は advice_history に入れ、advice_history_id で結び付ける
+        "ALTER TABLE sleep_records ADD COLUMN nap_time TEXT",
+        "ALTER TABLE sleep_records ADD COLUMN bad_points_free TEXT",
+        "ALTER TABLE sleep_records ADD COLUMN therapy_notes TEXT",
+        "ALTER TABLE sleep_records ADD COLUMN practiced_mask INTEGER",
+        "ALTER TABLE sleep_records ADD COLUMN improved_mask INTEGER",
+        "ALTER TABLE sleep_records ADD COLUMN bad_mask INTEGER",
+        *CHECKLIST_TABLES,
+        seed_catalog,
+        # 履歴の一覧は (date, wake_time, id) のキーセットで読むので、起床時刻までインデックスに含める
+        "CREATE INDEX IF NOT EXISTS idx_sleep_records_user_date_wake ON sleep_records(user_id, date, wake_time)",
+        "DROP INDEX IF EXISTS idx_sleep_records_user_date",
+        *drop_search_index_steps(DATA2_USER_SOURCES),
+        *search_index_steps(STORE_SOURCES),
+        *STORAGE_IMPORT_TABLES,
+    ]),
+    (12, "変更の記録（チェンジフィード）", [
+        # 既存の行は記録しない。それまでの状態は各利用者がテーブルから読み、以降の変更を changelog で追う
+        *CHANGE_FEED_TABLES,
+        *change_feed_triggers(),
+    ]),
+    (13, "集計の更新トリガーを集計に使う列の変更に限定", [
+        # 助言の結び付け（advice_history_id の更新）のたびに期間の行を数え直していた
+        *replace_update_trigger_steps(),
+    ]),
+    (14, "助言のインデックスから本文を外す", [
+        # 本文を含めると助言の全文を2回保存することになる。日付の最新の1件は rowid の順で読めば足りる
+        "DROP INDEX IF EXISTS idx_advice_history_user_date",
+        "CREATE INDEX IF NOT EXISTS idx_advice_history_user_date ON advice_history(user_id, date)",
+    ]),
+    (15, "利用者ごとのIDの順のインデックス", [
+        # 書き出し（SleepStore.records_after）は利用者の記録だけを ID のキーセットで読む
+        "CREATE INDEX IF NOT EXISTS idx_sleep_records_user_id ON sleep_records(user_id, id)",
+    ]),
+]
+
+SLEEP_DATA_MIGRATIONS = [
+    (1, "初期テーブル", [
+        '''CREATE TABLE IF NOT EXISTS sleep_records
+            (date TEXT, sleep_time TEXT, wake_time TEXT, nap_time TEXT,
+            good_points TEXT, good_points_free TEXT,
+            bad_points TEXT, bad_points_free TEXT, therapy_notes TEXT, ai_advice TEXT,
+            sleep_duration TEXT, practiced_points TEXT)''',
+        '''CREATE TABLE IF NOT EXISTS cbt_info
+            (id INTEGER PRIMARY KEY, content TEXT)''',
+    ]),
+    (2, "日付列のインデックス", [
+        # delete_record の date = ? AND wake_time = ? と、date >= ? / ORDER BY date
+        "CREATE INDEX IF NOT EXISTS idx_sleep_records_date_wake ON sleep_records(date, wake_time)",
+    ]),
+    (3, "睡眠時刻の数値列", [
+        # 表示用の文字列とは別に、集計用のエポック秒と分単位の睡眠時間を持つ。既存の行はSQLで一括変換する
+        "ALTER TABLE sleep_records ADD COLUMN sleep_epoch INTEGER",
+        "ALTER TABLE sleep_records ADD COLUMN wake_epoch INTEGER",
+        "ALTER TABLE sleep_records ADD COLUMN duration_minutes INTEGER",
+        BACKFILL_EPOCHS,
+        BACKFILL_DURATION_MINUTES,
+    ]),
+    (4, "AI助言の再試行キュー", [
+        *ADVICE_JOBS_TABLES,
+    ]),
+    (5, "チェック項目の一覧と選択のビットマスク", [
+        # 以前の文字列・JSONの列はそのまま残し、既存の行はビットマスクに変換する
+        *CHECKLIST_TABLES,
+        seed_catalog,
+        "ALTER TABLE sleep_records ADD COLUMN practiced_mask INTEGER",
+        "ALTER TABLE sleep_records ADD COLUMN improved_mask INTEGER",
+        "ALTER TABLE sleep_records ADD COLUMN bad_mask INTEGER",
+        backfill_masks,
+    ]),
+    (6, "自由記入とAIの助言の全文検索", [
+        *search_index_steps(SLEEP_DATA_SOURCES),
+    ]),
+    (7, "処理時間の計測値", [
+        *PERF_METRICS_TABLES,
+    ]),
+]
+
+
+def get_schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def latest_version(migrations):
+    return migrations[-1][0] if migrations else 0
+
+
+def migrate(conn, migrations):
+    """未適用のマイグレーションを順番に適用し、最終的なスキーマバージョンを返す。
+
+    各バージョンは1つのトランザクションで適用するため、途中で失敗しても
+    そのバージョンの変更は残らず、次回起動時に再試行される。
+    """
+    if get_schema_version(conn) >= latest_version(migrations):
+        return get_schema_version(conn)
+
+    isolation_level = conn.isolation_level
+    conn.isolation_level = None
+    try:
+        for version, description, steps in migrations:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # 他のプロセスが先に適用している場合があるので、ロック取得後に確認する
+                if get_schema_version(conn) >= version:
+                    conn.execute("COMMIT")
+                    continue
+                for step in steps:
+                    if callable(step):
+                        step(conn)
+                    else:
+                        conn.execute(step)
+                conn.execute(f"PRAGMA user_version = {int(version)}")
+                conn.execute("COMMIT")
+                print(f"Applied schema migration {version}: {description}")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+    finally:
+        conn.isolation_level = isolation_level
+    return get_schema_version(conn)
@@ -0,0 +1,74 @@
+import tkinter as tk
+from tkinter import ttk
+
+
+class SearchPanel:
+    """入力するたびに検索する検索ウィンドウ。結果をダブルクリックすると on_open(rowid, kind, date) を呼ぶ。"""
+
+    KIND_LABELS = {'record': "記録", 'advice': "AIの助言"}
+
+    def __init__(self, master, search, on_open, delay_ms=250):
+        self.search = search
+        self.on_open = on_open
+        self.delay_ms = delay_ms
+        self.page = 0
+        self._pending = None
+        self._rows = {}
+
+        self.window = tk.Toplevel(master)
+        self.window.title("記録を検索")
+        self.window.geometry("700x500")
+
+        self.query_var = tk.StringVar()
+        entry = ttk.Entry(self.window, textvariable=self.query_var)
+        entry.pack(fill="x", padx=10, pady=10)
+        entry.focus_set()
+        self.query_var.trace_add("write", lambda *args: self.schedule_search())
+
+        self.results = ttk.Treeview(self.window, columns=("date", "kind", "text"), show="headings")
+        self.results.heading("date", text="日付")
+        self.results.heading("kind", text="種類")
+        self.results.heading("text", text="内容")
+        self.results.column("date", width=90, stretch=False)
+        self.results.column("kind", width=70, stretch=False)
+        self.results.pack(fill="both", expand=True, padx=10)
+        self.results.bind("<Double-1>", self.open_selected)
+
+        nav_frame = ttk.Frame(self.window)
+        nav_frame.pack(fill="x", padx=10, pady=10)
+        self.prev_button = ttk.Button(nav_frame, text="前へ", command=lambda: self.show_page(self.page - 1))
+        self.prev_button.pack(side="left")
+        self.next_button = ttk.Button(nav_frame, text="次へ", command=lambda: self.show_page(self.page + 1))
+        self.next_button.pack(side="right")
+        self.status_label = ttk.Label(nav_frame, text="")
+        self.status_label.pack()
+        self.update_buttons(False)
+
+    def schedule_search(self):
+        # 入力が止まってから検索する
+        if self._pending:
+            self.window.after_cancel(self._pending)
+        self._pending = self.window.after(self.delay_ms, lambda: self.show_page(0))
+
+    def show_page(self, page):
+        self._pending = None
+        if page < 0:
+            return
+        rows, has_next = self.search.search(self.query_var.get().strip(), page)
+        self.page = page
+        self.results.delete(*self.results.get_children())
+        self._rows = {}
+        for rowid, kind, date, text in rows:
+            item = self.results.insert("", "end", values=(date, self.KIND_LABELS.get(kind, kind), text.replace("\n", " ")))
+            self._rows[item] = (rowid, kind, date)
+        self.status_label.config(text=f"{page + 1}ページ目" if rows else "該当なし")
+        self.update_buttons(has_next)
+
+    def update_buttons(self, has_next):
+        self.prev_button.state(["!disabled"] if self.page > 0 else ["disabled"])
+        self.next_button.state(["!disabled"] if has_next else ["disabled"])
+
+    def open_selected(self, event=None):
+        selected = self.results.focus()
+        if selected in self._rows:
+            self.on_open(*self._rows[selected])
@@ -0,0 +1,232 @@
+"""sleep_records の利用者ごと・日・週・月ごとの集計テーブル（sleep_period_stats）。
+
+集計はトリガーで保たれる。追加は該当する3行（日・週・月）に足し込み、更新と削除は
+その期間の行だけを元の記録から数え直す。既存のデータベースは rebuild で作り直せる。
+
+    python sleep_aggregates.py rebuild data2.db
+"""
+import argparse
+import sqlite3
+from datetime import date, timedelta
+
+
+METRICS = ('duration_minutes', 'sleep_satisfaction', 'sleep_quality', 'sleep_dissatisfaction', 'sleep_anxiety')
+
+# (期間の種類, キー, 期間の最初の日, 最後の日)。{d} に日付の式が入る。週は月曜始まりで、キーは月曜日の日付
+PERIODS = (
+    ('day', "{d}", "{d}", "{d}"),
+    ('week', "date({d}, 'weekday 0', '-6 days')", "date({d}, 'weekday 0', '-6 days')", "date({d}, 'weekday 0')"),
+    ('month', "substr({d}, 1, 7)", "date({d}, 'start of month')", "date({d}, 'start of month', '+1 month', '-1 day')"),
+)
+
+METRIC_COLUMNS = [f"{m}_{part}" for m in METRICS for part in ('count', 'sum', 'min', 'max')]
+
+# 集計を分ける列。利用者ごとの記録になってからは user_id ごとに集計する（空のタプルは v7 の全体集計）
+USER_SCOPE = ('user_id',)
+
+TRIGGER_NAMES = ("trg_sleep_period_stats_insert", "trg_sleep_period_stats_delete", "trg_sleep_period_stats_update")
+
+
+def period_stats_table(scope=USER_SCOPE):
+    scope_columns = "".join(f"{column} INTEGER NOT NULL,\n    " for column in scope)
+    return f'''CREATE TABLE IF NOT EXISTS sleep_period_stats
+    ({scope_columns}period TEXT NOT NULL,
+    period_key TEXT NOT NULL,
+    period_start TEXT,
+    period_end TEXT,
+    record_count INTEGER,
+    {", ".join(f"{column} {'REAL' if column.endswith('_sum') else 'INTEGER'}" for column in METRIC_COLUMNS)},
+    PRIMARY KEY ({"".join(f"{column}, " for column in scope)}period, period_key))'''
+
+
+def _aggregate_select(scope_values, period, key, start, end, where):
+    metrics = ", ".join(
+        f"COUNT({m}), SUM({m}), MIN({m}), MAX({m})" for m in METRICS
+    )
+    return f'''SELECT {"".join(f"{value}, " for value in scope_values)}'{period}', {key}, {start}, {end}, COUNT(*), {metrics}
+               FROM sleep_records WHERE {where}'''
+
+
+def _insert_columns(scope):
+    return ("".join(f"{column}, " for column in scope)
+            + "period, period_key, period_start, period_end, record_count, " + ", ".join(METRIC_COLUMNS))
+
+
+def _scope_condition(scope, row):
+    return "".join(f"{column} = {row}.{column} AND " for column in scope)
+
+
+def _recompute_statements(scope, row):
+    # row（OLD か NEW）が属する期間の行を、その期間の記録だけから数え直す
+    statements = []
+    for period, key, start, end in PERIODS:
+        key, start, end = (expr.format(d=f"{row}.date") for expr in (key, start, end))
+        statements.append(
+            f"DELETE FROM sleep_period_stats WHERE {_scope_condition(scope, row)}"
+            f"period = '{period}' AND period_key = {key}"
+        )
+        statements.append(
+            f"INSERT INTO sleep_period_stats ({_insert_columns(scope)}) "
+            + _aggregate_select([f"{row}.{column}" for column in scope], period, key, start, end,
+                                f"{_scope_condition(scope, row)}date BETWEEN {start} AND {end}")
+            + " GROUP BY 1"  # 記録が残っていなければ行を作らない
+        )
+    return statements
+
+
+def _upsert_statements(scope):
+    # 追加された1件を、日・週・月の行にそのまま足し込む
+    statements = []
+    for period, key, start, end in PERIODS:
+        key, start, end = (expr.format(d="NEW.date") for expr in (key, start, end))
+        values = []
+        updates = ["record_count = record_count + 1"]
+        for m in METRICS:
+            values.append(f"NEW.{m} IS NOT NULL, NEW.{m}, NEW.{m}, NEW.{m}")
+            updates.append(f"{m}_count = {m}_count + (excluded.{m}_count)")
+            updates.append(f"{m}_sum = coalesce({m}_sum + excluded.{m}_sum, {m}_sum, excluded.{m}_sum)")
+            updates.append(f"{m}_min = coalesce(min({m}_min, excluded.{m}_min), {m}_min, excluded.{m}_min)")
+            updates.append(f"{m}_max = coalesce(max({m}_max, excluded.{m}_max), {m}_max, excluded.{m}_max)")
+        statements.append(
+            f"INSERT INTO sleep_period_stats ({_insert_columns(scope)}) "
+            f"VALUES ({''.join(f'NEW.{column}, ' for column in scope)}'{period}', {key}, {start}, {end}, 1, "
+            f"{', '.join(values)}) "
+            f"ON CONFLICT ({''.join(f'{column}, ' for column in scope)}period, period_key) "
+            f"DO UPDATE SET {', '.join(updates)}"
+        )
+    return statements
+
+
+def _trigger(name, event, statements):
+    body = ";\n        ".join(statements)
+    return f'''CREATE TRIGGER IF NOT EXISTS {name} AFTER {event} ON sleep_records
+    WHEN {'NEW' if event != 'DELETE' else 'OLD'}.date IS NOT NULL
+    BEGIN
+        {body};
+    END'''
+
+
+def _update_trigger(scope):
+    # 集計に使う列が変わったときだけ数え直す（advice_history_id の付け替えなどでは動かない）。
+    # 日付（や利用者）が変わった場合に備えて、変更前と変更後の両方の期間を数え直す
+    columns = ", ".join(scope + ('date',) + METRICS)
+    return _trigger(TRIGGER_NAMES[2], f"UPDATE OF {columns}",
+                    _recompute_statements(scope, "OLD") + _recompute_statements(scope, "NEW"))
+
+
+def period_stats_triggers(scope=USER_SCOPE):
+    insert_name, delete_name, _ = TRIGGER_NAMES
+    return [
+        _trigger(insert_name, "INSERT", _upsert_statements(scope)),
+        _trigger(delete_name, "DELETE", _recompute_statements(scope, "OLD")),
+        _update_trigger(scope),
+    ]
+
+
+def replace_update_trigger_steps(scope=USER_SCOPE):
+    """更新のトリガーを、集計に使う列の変更だけで動くものに作り直すSQL。"""
+    return [f"DROP TRIGGER IF EXISTS {TRIGGER_NAMES[2]}", _update_trigger(scope)]
+
+
+def drop_period_stats_steps():
+    """集計テーブルとトリガーを削除するSQL。集計の分け方を変えるマイグレーションで使う。"""
+    return [f"DROP TRIGGER IF EXISTS {name}" for name in TRIGGER_NAMES] + ["DROP TABLE IF EXISTS sleep_period_stats"]
+
+
+def rebuild(conn, scope=USER_SCOPE):
+    """既存の記録から集計テーブルを作り直す。マイグレーションのステップとしても使う。"""
+    conn.execute("DELETE FROM sleep_period_stats")
+    group_by = ", ".join(str(index) for index in range(1, len(scope) + 3) if index != len(scope) + 1)
+    for period, key, start, end in PERIODS:
+        key, start, end = (expr.format(d="date") for expr in (key, start, end))
+        conn.execute(
+            f"INSERT INTO sleep_period_stats ({_insert_columns(scope)}) "
+            + _aggregate_select(scope, period, key, start, end, "date IS NOT NULL")
+            + f" GROUP BY {group_by}"
+        )
+
+
+def rebuild_unscoped(conn):
+    # v7 のマイグレーション用（user_id 列を追加する前の、全体で1つの集計）
+    rebuild(conn, ())
+
+
+def split_range(start_date, end_date):
+    """期間を、端の日・まるごと含まれる週・まるごと含まれる月の組み合わせに分ける。
+
+    [(period, period_key), ...] を返す。30日なら10行前後で済む。
+    """
+    start_date = date.fromisoformat(str(start_date))
+    end_date = date.fromisoformat(str(end_date))
+    keys = []
+    day = start_date
+    while day <= end_date:
+        month_end = (day.replace(day=28) + timedelta(days=4)).replace(day=1) - timedelta(days=1)
+        week_end = day + timedelta(days=6)
+        if day.day == 1 and month_end <= end_date:
+            keys.append(('month', day.strftime("%Y-%m")))
+            day = month_end + timedelta(days=1)
+        elif day.weekday() == 0 and week_end <= end_date:
+            keys.append(('week', day.isoformat()))
+            day = week_end + timedelta(days=1)
+        else:
+            keys.append(('day', day.isoformat()))
+            day += timedelta(days=1)
+    return keys
+
+
+class PeriodStats:
+    """db_manager.user_id の利用者の集計を読む。"""
+
+    def __init__(self, db_manager):
+        self.db_manager = db_manager
+
+    def summary(self, start_date, end_date):
+        """start_date〜end_date の件数と、各指標の件数・合計・最小・最大・平均。"""
+        keys = split_range(start_date, end_date)
+        if not keys:
+            return None
+        conditions = " OR ".join("(period = ? AND period_key = ?)" for _ in keys)
+        params = [self.db_manager.user_id] + [value for key in keys for value in key]
+        rows = self.db_manager.execute_query(
+            f'''SELECT record_count, {', '.join(METRIC_COLUMNS)} FROM sleep_period_stats
+               WHERE user_id = ? AND ({conditions})''',
+            params
+        ) or []
+
+        result = {'count': sum(row[0] for row in rows), 'metrics': {}}
+        for index, metric in enumerate(METRICS):
+            parts = [row[1 + index * 4:5 + index * 4] for row in rows]
+            count = sum(p[0] for p in parts)
+            total = sum(p[1] for p in parts if p[1] is not None)
+            minimums = [p[2] for p in parts if p[2] is not None]
+            maximums = [p[3] for p in parts if p[3] is not None]
+            result['metrics'][metric] = {
+                'count': count,
+                'sum': total,
+                'min': min(minimums) if minimums else None,
+                'max': max(maximums) if maximums else None,
+                'mean': total / count if count else None,
+            }
+        return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="睡眠記録の集計テーブルを管理する")
+    parser.add_argument("command", choices=["rebuild"])
+    parser.add_argument("database", nargs="?", default="data2.db")
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.database, isolation_level=None)
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        rebuild(conn)
+        conn.execute("COMMIT")
+        count = conn.execute("SELECT COUNT(*) FROM sleep_period_stats").fetchone()[0]
+        print(f"Rebuilt sleep_period_stats: {count} rows")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
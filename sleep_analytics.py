@@ -0,0 +1,226 @@
+import threading
+from datetime import datetime
+
+import numpy as np
+
+
+SCORE_COLUMNS = ('sleep_satisfaction', 'sleep_quality', 'sleep_dissatisfaction', 'sleep_anxiety')
+SCORE_LABELS = ('満足', '快眠', '不満', '不安')
+SERIES_NAMES = ('duration_minutes',) + SCORE_COLUMNS
+
+HISTORY_QUERY = f'''SELECT date, sleep_epoch, wake_epoch, duration_minutes, {", ".join(SCORE_COLUMNS)}
+                    FROM sleep_records
+                    WHERE user_id = ? AND date IS NOT NULL
+                    ORDER BY date, id'''
+
+DAY_SECONDS = 24 * 60 * 60
+
+
+def _local_offset_seconds():
+    return datetime.now().astimezone().utcoffset().total_seconds()
+
+
+def rolling_mean(values, window):
+    """欠損（NaN）を除いた移動平均。先頭の window-1 件は、それまでの件数で平均する。"""
+    present = ~np.isnan(values)
+    sums = np.cumsum(np.where(present, values, 0.0))
+    counts = np.cumsum(present)
+    sums[window:] = sums[window:] - sums[:-window]
+    counts[window:] = counts[window:] - counts[:-window]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(counts > 0, sums / counts, np.nan)
+
+
+def rolling_var(values, window):
+    """欠損を除いた移動分散（母分散）。"""
+    present = ~np.isnan(values)
+    filled = np.where(present, values, 0.0)
+    sums = np.cumsum(filled)
+    squares = np.cumsum(filled * filled)
+    counts = np.cumsum(present)
+    sums[window:] = sums[window:] - sums[:-window]
+    squares[window:] = squares[window:] - squares[:-window]
+    counts[window:] = counts[window:] - counts[:-window]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = sums / counts
+        variances = np.where(counts > 0, squares / counts - means * means, np.nan)
+    return np.clip(variances, 0.0, None)  # 丸め誤差で負になるのを防ぐ
+
+
+def pairwise_correlation(matrix):
+    """列どうしの相関係数を、両方の値がそろっている行だけで一度に計算する。"""
+    present = (~np.isnan(matrix)).astype(float)
+    filled = np.where(present > 0, matrix, 0.0)
+    counts = present.T @ present
+    sums = filled.T @ present  # sums[i, j]: 列jがそろっている行での列iの合計
+    squares = (filled * filled).T @ present
+    products = filled.T @ filled
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_i = sums / counts
+        mean_j = sums.T / counts
+        covariance = products / counts - mean_i * mean_j
+        var_i = squares / counts - mean_i * mean_i
+        var_j = squares.T / counts - mean_j * mean_j
+        correlation = covariance / np.sqrt(var_i * var_j)
+    correlation[counts < 3] = np.nan
+    return correlation
+
+
+class SleepHistory:
+    """sleep_records を列ごとのNumPy配列にしたもの。日付順に並ぶ。"""
+
+    def __init__(self, rows, utc_offset=None):
+        utc_offset = _local_offset_seconds() if utc_offset is None else utc_offset
+        # 行のタプルを列ごとにまとめてから変換する（None は NaN になる）
+        columns = list(zip(*rows)) or [()] * (4 + len(SCORE_COLUMNS))
+        self.dates = np.array(columns[0], dtype='datetime64[D]')
+        values = np.array(columns[1:], dtype=float).reshape(3 + len(SCORE_COLUMNS), len(rows)).T
+        self.sleep_epoch = values[:, 0]
+        self.wake_epoch = values[:, 1]
+        self.duration = values[:, 2]
+        self.scores = values[:, 3:]
+
+        # 就寝時刻は正午からの分、起床時刻は0時からの分にすると、日付をまたいでも連続した値になる
+        local_sleep = (self.sleep_epoch + utc_offset) % DAY_SECONDS
+        local_wake = (self.wake_epoch + utc_offset) % DAY_SECONDS
+        self.bedtime_minutes = ((local_sleep - DAY_SECONDS / 2) % DAY_SECONDS) / 60
+        self.wake_minutes = local_wake / 60
+        # 1970-01-01 は木曜日なので、月曜日を0にそろえる
+        self.weekday = (self.dates.astype('int64') + 3) % 7
+
+    def __len__(self):
+        return len(self.dates)
+
+    def series(self):
+        return np.column_stack([self.duration, self.scores])
+
+
+class SleepAnalytics:
+    """db_manager.user_id の利用者の睡眠記録の統計。
+
+    履歴は一度だけ配列に読み込み、記録が変わったら invalidate() で読み直す。
+    """
+
+    def __init__(self, db_manager, window=7):
+        self.db_manager = db_manager
+        self.window = window
+        self._history = None
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        with self._lock:
+            self._history = None
+
+    def history(self):
+        with self._lock:
+            if self._history is None:
+                rows = self.db_manager.execute_query(HISTORY_QUERY, (self.db_manager.user_id,)) or []
+                self._history = SleepHistory(rows)
+            return self._history
+
+    def rolling(self, window=None):
+        history = self.history()
+        window = window or self.window
+        series = history.series()
+        return {
+            'dates': history.dates,
+            'mean': {name: rolling_mean(series[:, i], window) for i, name in enumerate(SERIES_NAMES)},
+            'var': {name: rolling_var(series[:, i], window) for i, name in enumerate(SERIES_NAMES)},
+        }
+
+    def regularity(self, days=None):
+        history = self._recent(days)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return {
+                'bedtime_sd_minutes': _nan_to_none(_nanstd(history.bedtime_minutes)),
+                'wake_sd_minutes': _nan_to_none(_nanstd(history.wake_minutes)),
+            }
+
+    def weekday_weekend(self, days=None):
+        # 週末（土日）の平均 - 平日の平均。就寝・起床は分単位のずれ
+        history = self._recent(days)
+        values = np.column_stack([history.series(), history.bedtime_minutes, history.wake_minutes])
+        names = SERIES_NAMES + ('bedtime_minutes', 'wake_minutes')
+        weekend = history.weekday >= 5
+        with np.errstate(invalid='ignore', divide='ignore'):
+            deltas = _nanmean(values[weekend]) - _nanmean(values[~weekend])
+        return {name: _nan_to_none(delta) for name, delta in zip(names, deltas)}
+
+    def correlations(self, days=None):
+        history = self._recent(days)
+        matrix = pairwise_correlation(history.series())
+        return {
+            (SERIES_NAMES[i], SERIES_NAMES[j]): _nan_to_none(matrix[i, j])
+            for i in range(len(SERIES_NAMES)) for j in range(i + 1, len(SERIES_NAMES))
+        }
+
+    def summary(self, days=None):
+        history = self._recent(days)
+        return {
+            'nights': len(history),
+            'regularity': self.regularity(days),
+            'weekend_delta': self.weekday_weekend(days),
+            'correlations': self.correlations(days),
+        }
+
+    def summary_lines(self, days=None):
+        """AIへのプロンプトや統計ウィンドウに載せる短い説明文。"""
+        summary = self.summary(days)
+        if summary['nights'] < 2:
+            return []
+        lines = []
+        regularity = summary['regularity']
+        if regularity['bedtime_sd_minutes'] is not None:
+            lines.append(
+                f"規則性: 就寝時刻のばらつき±{regularity['bedtime_sd_minutes']:.0f}分"
+                f" / 起床時刻のばらつき±{regularity['wake_sd_minutes'] or 0:.0f}分"
+            )
+        delta = summary['weekend_delta']
+        parts = []
+        if delta['duration_minutes'] is not None:
+            parts.append(f"睡眠{delta['duration_minutes']:+.0f}分")
+        if delta['bedtime_minutes'] is not None:
+            parts.append(f"就寝{delta['bedtime_minutes']:+.0f}分")
+        if delta['wake_minutes'] is not None:
+            parts.append(f"起床{delta['wake_minutes']:+.0f}分")
+        if parts:
+            lines.append(f"週末と平日の差: {' '.join(parts)}")
+        strongest = [
+            (pair, value) for pair, value in summary['correlations'].items()
+            if value is not None and abs(value) >= 0.4
+        ]
+        strongest.sort(key=lambda item: abs(item[1]), reverse=True)
+        if strongest:
+            labels = dict(zip(SERIES_NAMES, ('睡眠時間',) + SCORE_LABELS))
+            lines.append("相関: " + " ".join(
+                f"{labels[a]}×{labels[b]}{value:+.2f}" for (a, b), value in strongest[:3]
+            ))
+        return lines
+
+    def _recent(self, days):
+        history = self.history()
+        if not days or not len(history):
+            return history
+        cutoff = history.dates[-1] - np.timedelta64(days - 1, 'D')
+        return _slice(history, history.dates >= cutoff)
+
+
+def _slice(history, mask):
+    sliced = SleepHistory.__new__(SleepHistory)
+    for name, value in vars(history).items():
+        setattr(sliced, name, value[mask])
+    return sliced
+
+
+def _nanmean(values):
+    present = ~np.isnan(values)
+    return np.where(present, values, 0.0).sum(axis=0) / present.sum(axis=0)
+
+
+def _nanstd(values):
+    deviations = values - _nanmean(values)
+    return np.sqrt(_nanmean(deviations * deviations))
+
+
+def _nan_to_none(value):
+    return None if value is None or np.isnan(value) else float(value)
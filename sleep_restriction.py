@@ -0,0 +1,139 @@
+import threading
+from datetime import date, datetime, timedelta
+
+from sleep_time_utils import duration_minutes, format_duration
+
+
+class SleepWindowCalculator:
+    """睡眠制限法（床上時間の調整）の計算。
+
+    最初の baseline_nights 夜の平均睡眠時間（床上時間 - 寝付くまでの時間 - 夜中に目覚めていた時間）を
+    最初の床上時間とし、その後は7日ごとに睡眠効率（睡眠時間 / 床上時間）で調整する。
+    効率が raise_at 以上なら step 分延ばし、lower_at 未満なら step 分縮める（min_window〜max_window の範囲）。
+    起床時刻は直近の期間の平均に固定し、就寝時刻は起床時刻から床上時間を引いて求める。
+
+    夜を1件ずつ add_night で追加すると、その期間の合計だけを更新する。
+    """
+
+    def __init__(self, baseline_nights=7, period_days=7, step=15, min_window=300, max_window=540,
+                 raise_at=0.90, lower_at=0.85):
+        self.baseline_nights = baseline_nights
+        self.period_days = period_days
+        self.step = step
+        self.min_window = min_window
+        self.max_window = max_window
+        self.raise_at = raise_at
+        self.lower_at = lower_at
+
+        self.window_minutes = None
+        self.wake_anchor_minutes = None
+        self.period_start = None
+        self.adjustments = []  # (期間の開始日, 睡眠効率, 調整前, 調整後)
+        self._reset_period()
+        self._baseline_tst = []
+        self._lock = threading.Lock()
+
+    def _reset_period(self):
+        self._tib_sum = 0
+        self._tst_sum = 0
+        self._nights = 0
+        self._wake_sum = 0
+        self._wake_count = 0
+
+    def add_night(self, night_date, sleep_epoch, wake_epoch, latency_minutes=None, awake_minutes=None):
+        if isinstance(night_date, str):
+            try:
+                night_date = date.fromisoformat(night_date)
+            except ValueError:
+                return
+        time_in_bed = duration_minutes(sleep_epoch, wake_epoch)
+        if time_in_bed is None:
+            return
+        with self._lock:
+            wake_clock = datetime.fromtimestamp(wake_epoch)
+            if latency_minutes is None and awake_minutes is None:
+                total_sleep = None  # 睡眠時間が分からない夜は効率の計算に使わない
+            else:
+                total_sleep = max(time_in_bed - (latency_minutes or 0) - (awake_minutes or 0), 0)
+
+            if self.window_minutes is None:
+                if total_sleep is not None:
+                    self._baseline_tst.append(total_sleep)
+            else:
+                while night_date >= self.period_start + timedelta(days=self.period_days):
+                    self._close_period()
+            if total_sleep is not None:
+                self._tib_sum += time_in_bed
+                self._tst_sum += total_sleep
+                self._nights += 1
+            self._wake_sum += wake_clock.hour * 60 + wake_clock.minute
+            self._wake_count += 1
+            if self.window_minutes is None and len(self._baseline_tst) >= self.baseline_nights:
+                self._start_window(night_date)
+
+    def _start_window(self, night_date):
+        average = sum(self._baseline_tst) / len(self._baseline_tst)
+        window = int(round(average / self.step)) * self.step
+        self.window_minutes = min(self.max_window, max(self.min_window, window))
+        self.wake_anchor_minutes = int(round(self._wake_sum / self._wake_count))
+        self.period_start = night_date + timedelta(days=1)
+        self._reset_period()
+
+    def _close_period(self):
+        if self._wake_count:
+            self.wake_anchor_minutes = int(round(self._wake_sum / self._wake_count))
+        efficiency = self._tst_sum / self._tib_sum if self._tib_sum else None
+        previous = self.window_minutes
+        if efficiency is not None:
+            if efficiency >= self.raise_at:
+                self.window_minutes = min(self.max_window, self.window_minutes + self.step)
+            elif efficiency < self.lower_at:
+                self.window_minutes = max(self.min_window, self.window_minutes - self.step)
+        self.adjustments.append((self.period_start, efficiency, previous, self.window_minutes))
+        self.period_start += timedelta(days=self.period_days)
+        self._reset_period()
+
+    def prescription(self):
+        with self._lock:
+            current_efficiency = self._tst_sum / self._tib_sum if self._tib_sum else None
+            if self.window_minutes is None:
+                return {
+                    'status': 'baseline',
+                    'nights_needed': self.baseline_nights - len(self._baseline_tst),
+                    'efficiency': current_efficiency,
+                }
+            bedtime = (self.wake_anchor_minutes - self.window_minutes) % (24 * 60)
+            last = self.adjustments[-1] if self.adjustments else None
+            return {
+                'status': 'active',
+                'window_minutes': self.window_minutes,
+                'bedtime': f"{bedtime // 60}:{bedtime % 60:02d}",
+                'wake_time': f"{self.wake_anchor_minutes // 60}:{self.wake_anchor_minutes % 60:02d}",
+                'efficiency': current_efficiency,
+                'nights_this_period': self._nights,
+                'last_efficiency': last[1] if last else None,
+                'last_change': (last[3] - last[2]) if last else None,
+            }
+
+    def summary_lines(self):
+        """AIへのプロンプトと画面に表示する、計算済みの結果。"""
+        result = self.prescription()
+        lines = []
+        if result['status'] == 'baseline':
+            lines.append(
+                f"床上時間の目安: 寝付くまでの時間などを記録した夜があと{result['nights_needed']}件そろうと計算します"
+            )
+        else:
+            lines.append(
+                f"床上時間の目安: {format_duration(result['window_minutes'])}"
+                f"（就寝 {result['bedtime']} / 起床 {result['wake_time']}）"
+            )
+            if result['last_change'] is not None:
+                if result['last_efficiency'] is None:
+                    reason = "前の期間は睡眠効率を計算できる記録がなかったため据え置き"
+                else:
+                    reason = f"前の期間の睡眠効率 {result['last_efficiency']:.0%}"
+                lines.append(f"前回の調整: {result['last_change']:+d}分（{reason}）")
+        if result['efficiency'] is not None:
+            lines.append(f"今の期間の睡眠効率: {result['efficiency']:.0%}")
+        return lines
@@ -0,0 +1,274 @@
+"""記録と助言の保存（睡眠改善支援アプリ.py・睡眠改善支援アプリ2.py・不眠症アプリの共通のストレージ）。
+
+スキーマは data2.db のもの（schema_migrations.DATA2_MIGRATIONS）に一本化した。不眠症アプリの
+昼寝の時刻やチェック項目のビットマスクも sleep_records の列として持ち、AIの助言は advice_history に
+保存して advice_history_id で記録と結び付ける。以前の sleep_data.db は storage_migrator で取り込む。
+
+SleepStore の読み書きはすべて db_manager.user_id の利用者に絞る。
+"""
+import sqlite3
+import threading
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from db_connection import ConnectionManager, ShardRouter
+from perf_metrics import METRICS, query_name
+from schema_migrations import DATA2_MIGRATIONS, migrate
+
+
+class DatabaseManager:
+    """利用者1人分のデータへのアクセス。
+
+    記録と助言は user_id で分けて保存し、すべてのクエリをその利用者に絞る。
+    shard_count を2以上にすると、利用者IDのハッシュで複数のSQLiteファイルに振り分ける。
+    """
+
+    def __init__(self, db_name='data2.db', user_id=1, shard_count=1):
+        self.db_name = db_name
+        self.user_id = user_id
+        self.router = ShardRouter(db_name, shard_count)
+        self._shards = {}  # ファイルのパス -> ConnectionManager
+        self._shards_lock = threading.Lock()
+        self.connection_manager = self.connection_for(user_id)
+
+    def connection_for(self, user_id):
+        # 同じファイルの利用者は接続マネージャーを共有する
+        path = self.router.path_for(user_id)
+        with self._shards_lock:
+            manager = self._shards.get(path)
+            if manager is None:
+                manager = self._shards[path] = ConnectionManager(path)
+            return manager
+
+    def execute_query(self, query, params=None):
+        # すべてのクエリの時間と行数を計測する（名前はSQLの種類とテーブル名）
+        with METRICS.timer(query_name(query), "db") as sample:
+            try:
+                conn = self.connection_manager.get_connection()
+                if params:
+                    cursor = conn.execute(query, params)
+                else:
+                    cursor = conn.execute(query)
+                rows = cursor.fetchall()
+                sample['rows'] = len(rows) if rows else max(cursor.rowcount, 0)
+                return rows
+            except sqlite3.Error as e:
+                print(f"Database error: {e}")
+                if self.connection_manager.in_transaction():
+                    # transaction() の中では例外を伝えてロールバックさせる（失敗した文の残りをコミットしない）
+                    raise
+                return None
+
+    def transaction(self):
+        # with db_manager.transaction(): の中の execute_query は1回のコミットにまとめられる
+        return self.connection_manager.transaction()
+
+    def close(self):
+        with self._shards_lock:
+            managers = list(self._shards.values())
+        for manager in managers:
+            manager.close_all()
+
+    def create_tables(self):
+        # テーブル作成とインデックス追加はスキーマバージョンで管理し、既存のdata2.dbもその場で更新する
+        try:
+            version = migrate(self.connection_manager.get_connection(), DATA2_MIGRATIONS)
+        except sqlite3.Error as e:
+            print(f"Database error: {e}")
+            return
+        print(f"All tables created successfully (schema version {version})")
+
+    @staticmethod
+    def get_advice_for_recent_records(conn, user_id):
+        seven_days_ago = (datetime.now() - timedelta(days=7)).strftime("%Y-%m-%d")
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT sr.*, ah.advice
+            FROM sleep_records sr
+            LEFT JOIN advice_history ah ON ah.user_id = sr.user_id AND sr.date = ah.date
+            WHERE sr.user_id = ? AND sr.date >= ?
+            ORDER BY sr.date DESC
+        """, (user_id, seven_days_ago))
+        return cursor.fetchall()
+
+
+# sleep_records の列（テーブルの列の順）。SELECT * の結果もこの順に並ぶ
+SLEEP_RECORD_COLUMNS = (
+    'id', 'date', 'sleep_time', 'wake_time', 'sleep_duration',
+    'sleep_satisfaction', 'sleep_quality', 'sleep_dissatisfaction', 'sleep_anxiety',
+    'sleep_preparation', 'sleep_reflection', 'advice_history_id',
+    'sleep_epoch', 'wake_epoch', 'duration_minutes',
+    'sleep_latency_minutes', 'awake_minutes', 'user_id',
+    'nap_time', 'bad_points_free', 'therapy_notes', 'practiced_mask', 'improved_mask', 'bad_mask'
+)
+
+# 記録の1行とその助言。タプルとしても扱えるので record[1] などの既存の参照はそのまま使える
+StoredRecord = namedtuple('StoredRecord', SLEEP_RECORD_COLUMNS + ('advice',))
+
+# 不眠症アプリが保存する助言の最大文字数（キューのジョブの target['max_chars']）
+CBT_ADVICE_MAX_CHARS = 400
+
+_INSERT_COLUMNS = tuple(column for column in SLEEP_RECORD_COLUMNS if column not in ('id', 'user_id'))
+
+# 記録に結び付けた助言があればそれを、なければその日の最新の助言を使う
+_RECORD_SELECT = f'''SELECT {", ".join(f"sr.{column}" for column in SLEEP_RECORD_COLUMNS)}, ah.advice
+    FROM sleep_records sr
+    LEFT JOIN advice_history ah
+      ON ah.id = coalesce(sr.advice_history_id,
+                          (SELECT MAX(id) FROM advice_history WHERE user_id = sr.user_id AND date = sr.date))'''
+
+# 一覧は日付・起床時刻・IDの新しい順。idx_sleep_records_user_date_wake の範囲検索で読む
+_RECORD_ORDER = "ORDER BY sr.date DESC, sr.wake_time DESC, sr.id DESC"
+
+
+class SleepStore:
+    def __init__(self, db_manager):
+        self.db_manager = db_manager
+
+    @property
+    def user_id(self):
+        return self.db_manager.user_id
+
+    def _records(self, where, params, limit=None):
+        query = f"{_RECORD_SELECT} WHERE sr.user_id = ? AND {where} {_RECORD_ORDER}"
+        params = (self.user_id,) + tuple(params)
+        if limit is not None:
+            query += " LIMIT ?"
+            params += (limit,)
+        rows = self.db_manager.execute_query(query, params)
+        return [StoredRecord(*row) for row in rows] if rows else []
+
+    def sleep_records(self, start_date, end_date):
+        """助言を含まない sleep_records の行（SELECT * の順）。新しい順。"""
+        return self.db_manager.execute_query(
+            '''SELECT * FROM sleep_records
+               WHERE user_id = ? AND date BETWEEN ? AND ?
+               ORDER BY date DESC''',
+            (self.user_id, str(start_date), str(end_date))
+        )
+
+    def records_between(self, start_date, end_date=None):
+        """start_date〜end_date の記録と助言（end_date が None なら以降すべて）。新しい順。"""
+        if end_date is None:
+            return self._records("sr.date >= ?", (str(start_date),))
+        return self._records("sr.date BETWEEN ? AND ?", (str(start_date), str(end_date)))
+
+    def record(self, record_id):
+        records = self._records("sr.id = ?", (record_id,))
+        return records[0] if records else None
+
+    def page(self, start_date, end_date, after, limit):
+        """[start_date, end_date) の記録を、after（前のページの最後の記録）の次から limit 件。"""
+        if after is None:
+            return self._records("sr.date >= ? AND sr.date < ?", (start_date, end_date), limit)
+        return self._records(
+            "sr.date >= ? AND sr.date < ? AND (sr.date, sr.wake_time, sr.id) < (?, ?, ?)",
+            (start_date, end_date, after.date, after.wake_time, after.id),
+            limit
+        )
+
+    def records_after(self, after_id, limit, start_date=None, end_date=None):
+        """ID が after_id より大きい記録を ID の順に limit 件（書き出し用。日付の範囲は任意）。"""
+        # idx_sleep_records_user_id の範囲検索で、この利用者の行だけを ID の順に読む（並べ替えなし）
+        query = f"{_RECORD_SELECT} WHERE sr.user_id = ? AND sr.id > ?"
+        params = [self.user_id, after_id]
+        if start_date is not None:
+            query += " AND sr.date >= ?"
+            params.append(str(start_date))
+        if end_date is not None:
+            query += " AND sr.date <= ?"
+            params.append(str(end_date))
+        rows = self.db_manager.execute_query(query + " ORDER BY sr.id LIMIT ?", tuple(params) + (limit,))
+        return [StoredRecord(*row) for row in rows] if rows else []
+
+    def month_counts(self):
+        """[(YYYY-MM, 件数), ...] の新しい順。"""
+        return self.db_manager.execute_query(
+            '''SELECT substr(date, 1, 7) AS month, COUNT(*) FROM sleep_records
+               WHERE user_id = ? GROUP BY month ORDER BY month DESC''',
+            (self.user_id,)
+        ) or []
+
+    def save_record(self, record):
+        """record は列名 -> 値の辞書（足りない列は NULL）。追加した記録のIDを返す。"""
+        rows = self.db_manager.execute_query(
+            f'''INSERT INTO sleep_records ({", ".join(_INSERT_COLUMNS)}, user_id)
+                VALUES ({", ".join("?" for _ in _INSERT_COLUMNS)}, ?) RETURNING id''',
+            tuple(record.get(column) for column in _INSERT_COLUMNS) + (self.user_id,)
+        )
+        return rows[0][0] if rows else None
+
+    def delete_record(self, record_id):
+        self.db_manager.execute_query(
+            "DELETE FROM sleep_records WHERE id = ? AND user_id = ?", (record_id, self.user_id)
+        )
+
+    def link_advice(self, record_id, advice_id):
+        self.db_manager.execute_query(
+            "UPDATE sleep_records SET advice_history_id = ? WHERE id = ? AND user_id = ?",
+            (advice_id, record_id, self.user_id)
+        )
+
+    def save_advice(self, advice, date, user_id=None, record_id=None):
+        """助言を保存してIDを返す。record_id を渡すとその記録に結び付ける。"""
+        user_id = user_id or self.user_id
+        with self.db_manager.transaction():
+            rows = self.db_manager.execute_query(
+                "INSERT INTO advice_history (advice, date, user_id) VALUES (?, ?, ?) RETURNING id",
+                (advice, str(date), user_id)
+            )
+            advice_id = rows[0][0] if rows else None
+            if advice_id is not None and record_id is not None:
+                self.db_manager.execute_query(
+                    "UPDATE sleep_records SET advice_history_id = ? WHERE id = ? AND user_id = ?",
+                    (advice_id, record_id, user_id)
+                )
+        return advice_id
+
+    def save_queued_advice(self, target, advice):
+        """再試行キュー（advice_queue）で生成できた助言を保存する。どちらのアプリのジョブも同じ形。
+
+        target は {'date', 'user_id', 'record_id'（任意）, 'max_chars'（任意）}。
+        """
+        max_chars = target.get('max_chars')
+        if max_chars:
+            advice = advice[:max_chars]
+        return self.save_advice(advice, target['date'], target.get('user_id', 1), target.get('record_id'))
+
+    def latest_advice(self, date):
+        result = self.db_manager.execute_query(
+            "SELECT advice FROM advice_history WHERE user_id = ? AND date = ? ORDER BY id DESC LIMIT 1",
+            (self.user_id, str(date))
+        )
+        return result[0][0] if result else None
+
+    def advice(self, advice_id):
+        result = self.db_manager.execute_query(
+            "SELECT advice FROM advice_history WHERE id = ? AND user_id = ?", (advice_id, self.user_id)
+        )
+        return result[0][0] if result else None
+
+    def advice_history(self, limit=5):
+        return self.db_manager.execute_query(
+            "SELECT advice, date FROM advice_history WHERE user_id = ? ORDER BY date DESC LIMIT ?",
+            (self.user_id, limit)
+        )
+
+    def advice_dates(self, start_date, end_date):
+        # idx_advice_history_user_date の範囲検索で済む
+        result = self.db_manager.execute_query(
+            "SELECT DISTINCT date FROM advice_history WHERE user_id = ? AND date BETWEEN ? AND ?",
+            (self.user_id, str(start_date), str(end_date))
+        )
+        return {row[0] for row in result} if result else set()
+
+    def cbt_info(self, default_content):
+        # 認知行動療法の説明文は利用者で共通（id = 1 の1行）
+        result = self.db_manager.execute_query("SELECT content FROM cbt_info WHERE id = 1")
+        if result:
+            return result[0][0]
+        self.db_manager.execute_query("INSERT INTO cbt_info (id, content) VALUES (1, ?)", (default_content,))
+        return default_content
+
+    def save_cbt_info(self, content):
+        self.db_manager.execute_query("UPDATE cbt_info SET content = ? WHERE id = 1", (content,))
@@ -0,0 +1,50 @@
+from datetime import datetime
+
+
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def to_epoch(value):
+    """datetime または "YYYY-MM-DD HH:MM[:SS]" 形式の文字列をエポック秒（ローカル時刻基準）に変換する。"""
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        return int(value.timestamp())
+    for time_format in (TIME_FORMAT, "%Y-%m-%d %H:%M"):
+        try:
+            return int(datetime.strptime(value, time_format).timestamp())
+        except ValueError:
+            continue
+    return None
+
+
+def duration_minutes(sleep_epoch, wake_epoch):
+    if sleep_epoch is None or wake_epoch is None:
+        return None
+    seconds = wake_epoch - sleep_epoch
+    if seconds <= 0:
+        seconds += 24 * 60 * 60  # 起床時間が前日であれば調整
+    return seconds // 60
+
+
+def parse_minutes(text):
+    """入力欄の「15」「15分」などを分の整数にする。空欄や読めない値は None。"""
+    text = str(text or "").strip().rstrip("分").strip()
+    try:
+        minutes = int(float(text))
+    except ValueError:
+        return None
+    return minutes if minutes >= 0 else None
+
+
+def format_duration(minutes):
+    if minutes is None:
+        return "データなし"
+    hours, minutes = divmod(int(minutes), 60)
+    return f"{hours}時間{minutes}分"
+
+
+def format_epoch(epoch, time_format=TIME_FORMAT):
+    if epoch is None:
+        return ""
+    return datetime.fromtimestamp(epoch).strftime(time_format)
@@ -0,0 +1,119 @@
+"""起動時間の計測。
+
+アプリはモジュールの先頭で StartupProfile を作り、mark() で各段階までの経過ミリ秒を記録する。
+環境変数 SLEEP_APP_STARTUP_REPORT にパスを指定して起動すると、操作可能になった時点で
+JSONのレポートを書き出す。SLEEP_APP_EXIT_AFTER_STARTUP=1 ならそのまま終了する。
+
+CIでは次のように実行し、予算を超えたら終了コード1になる（画面のない環境では xvfb-run を使う）。
+
+    python startup_profile.py 睡眠改善支援アプリ2.py --max-first-paint-ms 1500 --max-interactive-ms 3000
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+
+REPORT_ENV = "SLEEP_APP_STARTUP_REPORT"
+EXIT_ENV = "SLEEP_APP_EXIT_AFTER_STARTUP"
+
+
+class StartupProfile:
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock
+        self.started = clock()
+        self.marks = {}
+
+    def mark(self, name):
+        self.marks[name] = round((self.clock() - self.started) * 1000, 1)
+
+    def watch_first_paint(self, master, then=None):
+        # after_idle の中で update_idletasks を呼ぶと、それまでに作ったウィジェットの描画が終わる。
+        # 残りの起動処理（then）は描画の後に回す
+        def on_idle():
+            master.update_idletasks()
+            self.mark("first_paint")
+            if then:
+                master.after(0, then)
+
+        master.after_idle(on_idle)
+
+    def finish(self, master=None):
+        self.mark("interactive")
+        path = os.environ.get(REPORT_ENV)
+        if path:
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump({"marks_ms": self.marks}, f, ensure_ascii=False, indent=2)
+        if master is not None and os.environ.get(EXIT_ENV):
+            master.after(0, master.destroy)
+
+
+def parse_importtime(stderr, top=10):
+    """python -X importtime の出力から、累積時間の大きいトップレベルのインポートを返す。"""
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|", 2)
+        if name.startswith("  "):
+            continue  # 他のモジュールから間接的に読み込まれたもの
+        imports.append((name.strip(), int(cumulative) / 1000))
+    imports.sort(key=lambda item: item[1], reverse=True)
+    return imports[:top]
+
+
+def measure(script, timeout=60):
+    with tempfile.TemporaryDirectory() as tmp:
+        report_path = os.path.join(tmp, "startup.json")
+        env = dict(os.environ, **{REPORT_ENV: report_path, EXIT_ENV: "1"})
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", script],
+            env=env, capture_output=True, text=True, timeout=timeout,
+            cwd=os.path.dirname(os.path.abspath(script)) or None
+        )
+        if not os.path.exists(report_path):
+            raise RuntimeError(f"{script} did not write a startup report:\n{result.stderr[-2000:]}")
+        with open(report_path, encoding="utf-8") as f:
+            report = json.load(f)
+    report["script"] = script
+    report["slowest_imports_ms"] = parse_importtime(result.stderr)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="アプリの起動時間とインポート時間を計測する")
+    parser.add_argument("scripts", nargs="+")
+    parser.add_argument("--max-first-paint-ms", type=float)
+    parser.add_argument("--max-interactive-ms", type=float)
+    parser.add_argument("--json", help="レポートをJSONで書き出すパス")
+    args = parser.parse_args()
+
+    reports = []
+    failed = False
+    for script in args.scripts:
+        report = measure(script)
+        reports.append(report)
+        marks = report["marks_ms"]
+        print(f"{script}")
+        for name, elapsed in marks.items():
+            print(f"  {name:<16} {elapsed:8.1f} ms")
+        print("  slowest imports:")
+        for name, elapsed in report["slowest_imports_ms"]:
+            print(f"    {name:<30} {elapsed:8.1f} ms")
+
+        for mark, budget in (("first_paint", args.max_first_paint_ms), ("interactive", args.max_interactive_ms)):
+            if budget is not None and marks.get(mark, float("inf")) > budget:
+                print(f"  {mark} exceeded budget: {marks.get(mark)} ms > {budget} ms")
+                failed = True
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(reports, f, ensure_ascii=False, indent=2)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,458 @@
+"""以前の sleep_data.db（不眠症アプリ）や別の data2.db を、共通のストレージ（sleep_store）に取り込む。
+
+元のファイルは rowid 順に batch_size 行ずつ読み、1バッチを1つのトランザクションで書き込む。
+最後に取り込んだ rowid と、元の行から取り込み先の行への対応も同じトランザクションで
+storage_imports / storage_import_map に記録する。途中で止まっても続きから再開でき、同じ行を
+二度取り込むことはない。メモリに持つのは1バッチ分だけ。
+
+元のファイルは読み取り専用で開き、書き換えない。古いバージョンのファイルにない列は NULL として読み、
+集計用の列（エポック秒・睡眠時間・チェック項目のマスク）はバッチを読むときに表示用の列から作る。
+
+取り込みの後は元と取り込み先の両方を流し読みし、件数とチェックサムが一致することを確かめる。
+結果は storage_imports.status に verified / mismatch として残し、次からは検証し直さない
+（mismatch のファイルをもう一度検証するには --recheck を付ける）。
+
+    python storage_migrator.py sleep_data.db data2.db --user 1
+"""
+import argparse
+import hashlib
+import json
+import os
+import pathlib
+import sqlite3
+import time
+
+from checklist_catalog import MASK_COLUMNS, legacy_masks
+from sleep_store import CBT_ADVICE_MAX_CHARS, SLEEP_RECORD_COLUMNS, DatabaseManager
+from sleep_time_utils import duration_minutes, to_epoch
+
+
+SLEEP_DATA = 'sleep_data'
+DATA2 = 'data2'
+
+# 種類ごとの取り込みの段階（この順に進む）。data2.db は記録が助言のIDを参照するので助言から
+PHASES = {
+    SLEEP_DATA: ('records', 'jobs'),
+    DATA2: ('advice', 'records'),
+}
+
+# 不眠症アプリの記録の列 -> 共通のストレージの列（自由記入は起床後の振り返りとして持つ）
+SLEEP_DATA_COLUMNS = (
+    ('date', 'date'),
+    ('sleep_time', 'sleep_time'),
+    ('wake_time', 'wake_time'),
+    ('nap_time', 'nap_time'),
+    ('sleep_duration', 'sleep_duration'),
+    ('good_points_free', 'sleep_reflection'),
+    ('bad_points_free', 'bad_points_free'),
+    ('therapy_notes', 'therapy_notes'),
+    ('sleep_epoch', 'sleep_epoch'),
+    ('wake_epoch', 'wake_epoch'),
+    ('duration_minutes', 'duration_minutes'),
+    ('practiced_mask', 'practiced_mask'),
+    ('improved_mask', 'improved_mask'),
+    ('bad_mask', 'bad_mask'),
+)
+
+# マスクの列ができる前（sleep_data.db の v5 より前）のチェック項目の列。legacy_masks の引数の順
+LEGACY_POINT_COLUMNS = ('practiced_points', 'good_points', 'bad_points')
+
+# data2.db から data2.db へはIDと利用者以外の列をそのまま写す
+DATA2_COLUMNS = tuple(column for column in SLEEP_RECORD_COLUMNS
+                      if column not in ('id', 'user_id', 'advice_history_id'))
+
+SOURCE_TABLES = ('sleep_records', 'advice_history', 'advice_jobs')
+
+
+class StorageMigrationError(Exception):
+    pass
+
+
+def detect_kind(conn):
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(sleep_records)")}
+    if 'good_points_free' in columns:
+        return SLEEP_DATA
+    if 'sleep_preparation' in columns:
+        return DATA2
+    raise StorageMigrationError("sleep_records of a known schema was not found")
+
+
+def open_read_only(path):
+    # 元のファイルにはマイグレーションも索引の作成もしない
+    return sqlite3.connect(f"{pathlib.Path(os.path.abspath(path)).as_uri()}?mode=ro", uri=True)
+
+
+def derive_record(values, legacy_points=None):
+    """元の行にない（空の）集計用の列を表示用の列から作る。values（列名 -> 値）を書き換えて返す。
+
+    legacy_points は LEGACY_POINT_COLUMNS の値。マスクの列が空のときだけ使う。
+    """
+    if values.get('sleep_epoch') is None:
+        values['sleep_epoch'] = to_epoch(values.get('sleep_time'))
+    if values.get('wake_epoch') is None:
+        values['wake_epoch'] = to_epoch(values.get('wake_time'))
+    if values.get('duration_minutes') is None:
+        values['duration_minutes'] = duration_minutes(values['sleep_epoch'], values['wake_epoch'])
+    mask_columns = tuple(MASK_COLUMNS.values())
+    if legacy_points is not None and all(values.get(column) is None for column in mask_columns):
+        values.update(zip(mask_columns, legacy_masks(*legacy_points)))
+    return values
+
+
+class RowChecksum:
+    """行のタプルの件数と、各行のハッシュの和（2**64 を法とする）。"""
+
+    def __init__(self):
+        self.count = 0
+        self.value = 0
+
+    def add(self, row):
+        digest = hashlib.blake2b(repr(tuple(row)).encode("utf-8"), digest_size=8).digest()
+        self.count += 1
+        self.value = (self.value + int.from_bytes(digest, "big")) % (1 << 64)
+
+    def result(self):
+        return self.count, f"{self.value:016x}"
+
+
+class StorageMigrator:
+    """source_path のファイルを db_manager の利用者（db_manager.user_id）の記録として取り込む。
+
+    data2.db からの取り込みでは、元のファイルの source_user_id の記録と助言を写す。
+    progress は (段階, 取り込んだ行数の累計) を受け取る関数。
+    """
+
+    def __init__(self, source_path, db_manager, batch_size=500, source_user_id=1, progress=None):
+        self.source_path = source_path
+        self.source_key = os.path.abspath(source_path)
+        self.db_manager = db_manager
+        self.batch_size = batch_size
+        self.source_user_id = source_user_id
+        self.progress = progress
+        self.kind = None
+        self.source_columns = {}  # テーブル -> 元のファイルにある列
+        self.status = None
+
+    def run(self, recheck=False):
+        """取り込みと検証を行い、検証の結果（verify の戻り値）を返す。
+
+        検証済み（verified）か、前回の検証が一致しなかった（mismatch）なら何もせず None を返す。
+        recheck なら mismatch のファイルをもう一度検証する。
+        """
+        if self.source_key == os.path.abspath(self.db_manager.connection_manager.db_name):
+            raise StorageMigrationError("source and target are the same file")
+        self.db_manager.create_tables()
+        state = self._state()
+        self.status = state['status'] if state else None
+        if self.status == 'verified' or (self.status == 'mismatch' and not recheck):
+            return None
+        source = self._open_source()
+        try:
+            self._migrate(source)
+            results = self.verify(source)
+        finally:
+            source.close()
+        # 一致しなくても最後の状態を残し、起動のたびに両方のファイルを読み直さないようにする
+        self.status = 'verified' if all(ok for _, _, _, ok in results) else 'mismatch'
+        self._set_status(self.status)
+        return results
+
+    def _open_source(self):
+        if not os.path.exists(self.source_path):
+            raise StorageMigrationError(f"{self.source_path} does not exist")
+        source = open_read_only(self.source_path)
+        self.kind = detect_kind(source)
+        self.source_columns = {table: {row[1] for row in source.execute(f"PRAGMA table_info({table})")}
+                               for table in SOURCE_TABLES}
+        return source
+
+    def _select(self, table, columns, prefix=""):
+        # 古いバージョンのファイルにない列は NULL として読む
+        present = self.source_columns[table]
+        return ", ".join(f"{prefix}{column}" if column in present else "NULL" for column in columns)
+
+    def _user_condition(self, table, prefix=""):
+        # user_id 列がない（v10 より前の）data2.db の行は、すべて利用者1のもの
+        if 'user_id' in self.source_columns[table]:
+            return f"{prefix}user_id = ?"
+        return "? = 1"
+
+    def _target(self):
+        return self.db_manager.connection_manager
+
+    def _state(self):
+        row = self._target().get_connection().execute(
+            "SELECT kind, user_id, phase, last_rowid, rows, status FROM storage_imports WHERE source = ?",
+            (self.source_key,)
+        ).fetchone()
+        if row is None:
+            return None
+        return dict(zip(('kind', 'user_id', 'phase', 'last_rowid', 'rows', 'status'), row))
+
+    def _set_status(self, status):
+        with self._target().transaction() as conn:
+            conn.execute("UPDATE storage_imports SET status = ?, updated_at = ? WHERE source = ?",
+                         (status, time.time(), self.source_key))
+
+    def _migrate(self, source):
+        state = self._state()
+        if state is None:
+            with self._target().transaction() as conn:
+                conn.execute(
+                    '''INSERT INTO storage_imports (source, kind, user_id, phase, last_rowid, rows, status, updated_at)
+                       VALUES (?, ?, ?, ?, 0, 0, 'running', ?)''',
+                    (self.source_key, self.kind, self.db_manager.user_id, PHASES[self.kind][0], time.time())
+                )
+            state = self._state()
+        elif state['user_id'] != self.db_manager.user_id or state['kind'] != self.kind:
+            raise StorageMigrationError(
+                f"{self.source_path} was already imported as {state['kind']} for user {state['user_id']}"
+            )
+        if state['status'] != 'running':
+            return
+
+        phases = PHASES[self.kind]
+        rows = state['rows']
+        for phase in phases[phases.index(state['phase']):]:
+            last_rowid = state['last_rowid'] if phase == state['phase'] else 0
+            read_batch, write_batch = getattr(self, f"_{self.kind}_{phase}")
+            while True:
+                batch = read_batch(source, last_rowid)
+                if not batch:
+                    break
+                last_rowid = batch[-1][0]
+                rows += len(batch)
+                with self._target().transaction() as conn:
+                    write_batch(conn, source, batch)
+                    conn.execute(
+                        "UPDATE storage_imports SET phase = ?, last_rowid = ?, rows = ?, updated_at = ? WHERE source = ?",
+                        (phase, last_rowid, rows, time.time(), self.source_key)
+                    )
+                if self.progress:
+                    self.progress(phase, rows)
+            next_phase = phases[phases.index(phase) + 1] if phase != phases[-1] else phase
+            with self._target().transaction() as conn:
+                conn.execute(
+                    "UPDATE storage_imports SET phase = ?, last_rowid = ?, status = ?, updated_at = ? WHERE source = ?",
+                    (next_phase, 0, 'running' if phase != phases[-1] else 'done', time.time(), self.source_key)
+                )
+
+    def _map(self, conn, source_table, source_rowid, target_id):
+        conn.execute(
+            "INSERT INTO storage_import_map (source, source_table, source_rowid, target_id) VALUES (?, ?, ?, ?)",
+            (self.source_key, source_table, source_rowid, target_id)
+        )
+
+    def _mapped_id(self, conn, source_table, source_rowid):
+        row = conn.execute(
+            "SELECT target_id FROM storage_import_map WHERE source = ? AND source_table = ? AND source_rowid = ?",
+            (self.source_key, source_table, source_rowid)
+        ).fetchone()
+        return row[0] if row else None
+
+    def _insert_record(self, conn, values, advice_id):
+        columns = list(values) + ['advice_history_id', 'user_id']
+        return conn.execute(
+            f'''INSERT INTO sleep_records ({", ".join(columns)})
+                VALUES ({", ".join("?" for _ in columns)}) RETURNING id''',
+            tuple(values.values()) + (advice_id, self.db_manager.user_id)
+        ).fetchone()[0]
+
+    def _insert_advice(self, conn, advice, date):
+        return conn.execute(
+            "INSERT INTO advice_history (advice, date, user_id) VALUES (?, ?, ?) RETURNING id",
+            (advice, date, self.db_manager.user_id)
+        ).fetchone()[0]
+
+    # --- sleep_data.db ---
+
+    def _sleep_data_select(self):
+        columns = [column for column, _ in SLEEP_DATA_COLUMNS] + list(LEGACY_POINT_COLUMNS) + ['ai_advice']
+        return f"SELECT rowid, {self._select('sleep_records', columns)} FROM sleep_records"
+
+    @staticmethod
+    def _sleep_data_values(row):
+        # (rowid, 列..., 以前のチェック項目の列..., ai_advice) -> 取り込み先の列の辞書
+        count = len(SLEEP_DATA_COLUMNS)
+        values = {target: value for (_, target), value in zip(SLEEP_DATA_COLUMNS, row[1:1 + count])}
+        return derive_record(values, row[1 + count:-1])
+
+    @property
+    def _sleep_data_records(self):
+        def read(source, last_rowid):
+            return source.execute(
+                f"{self._sleep_data_select()} WHERE rowid > ? ORDER BY rowid LIMIT ?",
+                (last_rowid, self.batch_size)
+            ).fetchall()
+
+        def write(conn, source, batch):
+            for row in batch:
+                values = self._sleep_data_values(row)
+                advice = row[-1]
+                advice_id = self._insert_advice(conn, advice, values['date']) if advice else None
+                self._map(conn, 'sleep_records', row[0], self._insert_record(conn, values, advice_id))
+        return read, write
+
+    @property
+    def _sleep_data_jobs(self):
+        # 送信待ちのAI助言のリクエストも、取り込んだ記録を指すように書き換えて引き継ぐ
+        def read(source, last_rowid):
+            if not self.source_columns['advice_jobs']:
+                return []  # 再試行キューができる前（v4 より前）のファイル
+            return source.execute(
+                '''SELECT id, target, messages, attempts, next_attempt_at, last_error, created_at, updated_at
+                   FROM advice_jobs WHERE status = 'pending' AND id > ? ORDER BY id LIMIT ?''',
+                (last_rowid, self.batch_size)
+            ).fetchall()
+
+        def write(conn, source, batch):
+            for job_id, target, messages, attempts, next_attempt_at, last_error, created_at, updated_at in batch:
+                target = json.loads(target)
+                found = source.execute(
+                    "SELECT rowid FROM sleep_records WHERE date = ? AND wake_time = ?",
+                    (target.get('date'), target.get('wake_time'))
+                ).fetchone()
+                record_id = self._mapped_id(conn, 'sleep_records', found[0]) if found else None
+                if record_id is None:
+                    continue  # 記録が削除されている
+                new_target = {'date': target['date'], 'user_id': self.db_manager.user_id,
+                              'record_id': record_id, 'max_chars': CBT_ADVICE_MAX_CHARS}
+                conn.execute(
+                    '''INSERT INTO advice_jobs
+                       (target, messages, status, attempts, next_attempt_at, last_error, created_at, updated_at)
+                       VALUES (?, ?, 'pending', ?, ?, ?, ?, ?)''',
+                    (json.dumps(new_target, ensure_ascii=False), messages, attempts, next_attempt_at,
+                     last_error, created_at, updated_at)
+                )
+        return read, write
+
+    # --- data2.db ---
+
+    @property
+    def _data2_advice(self):
+        def read(source, last_rowid):
+            return source.execute(
+                f'''SELECT id, advice, date FROM advice_history
+                    WHERE {self._user_condition('advice_history')} AND id > ? ORDER BY id LIMIT ?''',
+                (self.source_user_id, last_rowid, self.batch_size)
+            ).fetchall()
+
+        def write(conn, source, batch):
+            for advice_id, advice, date in batch:
+                self._map(conn, 'advice_history', advice_id, self._insert_advice(conn, advice, date))
+        return read, write
+
+    @property
+    def _data2_records(self):
+        def read(source, last_rowid):
+            return source.execute(
+                f'''SELECT id, {self._select('sleep_records', DATA2_COLUMNS)}, advice_history_id FROM sleep_records
+                    WHERE {self._user_condition('sleep_records')} AND id > ? ORDER BY id LIMIT ?''',
+                (self.source_user_id, last_rowid, self.batch_size)
+            ).fetchall()
+
+        def write(conn, source, batch):
+            for row in batch:
+                values = derive_record(dict(zip(DATA2_COLUMNS, row[1:-1])))
+                advice_id = self._mapped_id(conn, 'advice_history', row[-1]) if row[-1] is not None else None
+                self._map(conn, 'sleep_records', row[0], self._insert_record(conn, values, advice_id))
+        return read, write
+
+    # --- 検証 ---
+
+    def verify(self, source):
+        """[(テーブル, (元の件数, チェックサム), (取り込み先の件数, チェックサム), 一致したか), ...]"""
+        target = self._target().get_connection()
+        checks = []
+        # 元の行は取り込みと同じ変換をしてから数える
+        if self.kind == SLEEP_DATA:
+            source_rows = (
+                (row[0], *self._sleep_data_values(row).values(), row[-1] or None)
+                for row in source.execute(f"{self._sleep_data_select()} ORDER BY rowid")
+            )
+            target_rows = self._mapped_records(target, [column for _, column in SLEEP_DATA_COLUMNS])
+            checks.append(('sleep_records', source_rows, target_rows))
+        else:
+            source_rows = (
+                (row[0], *derive_record(dict(zip(DATA2_COLUMNS, row[1:-1]))).values(), row[-1])
+                for row in source.execute(
+                    f'''SELECT sr.id, {self._select('sleep_records', DATA2_COLUMNS, "sr.")}, ah.advice
+                        FROM sleep_records sr LEFT JOIN advice_history ah ON ah.id = sr.advice_history_id
+                        WHERE {self._user_condition('sleep_records', "sr.")} ORDER BY sr.id''',
+                    (self.source_user_id,)
+                )
+            )
+            target_rows = self._mapped_records(target, DATA2_COLUMNS)
+            checks.append(('sleep_records', source_rows, target_rows))
+            checks.append((
+                'advice_history',
+                source.execute(
+                    f"SELECT id, advice, date FROM advice_history WHERE {self._user_condition('advice_history')} ORDER BY id",
+                    (self.source_user_id,)
+                ),
+                target.execute(
+                    '''SELECT m.source_rowid, ah.advice, ah.date
+                       FROM storage_import_map m JOIN advice_history ah ON ah.id = m.target_id
+                       WHERE m.source = ? AND m.source_table = 'advice_history' ORDER BY m.source_rowid''',
+                    (self.source_key,)
+                ),
+            ))
+
+        results = []
+        for table, source_rows, target_rows in checks:
+            # カーソルを1行ずつ読むので、どちらの側も全件をメモリに載せない
+            source_sum, target_sum = RowChecksum(), RowChecksum()
+            for row in source_rows:
+                source_sum.add(row)
+            for row in target_rows:
+                target_sum.add(row)
+            results.append((table, source_sum.result(), target_sum.result(),
+                            source_sum.result() == target_sum.result()))
+        return results
+
+    def _mapped_records(self, target, columns):
+        return target.execute(
+            f'''SELECT m.source_rowid, {", ".join(f"sr.{column}" for column in columns)}, ah.advice
+                FROM storage_import_map m
+                JOIN sleep_records sr ON sr.id = m.target_id
+                LEFT JOIN advice_history ah ON ah.id = sr.advice_history_id
+                WHERE m.source = ? AND m.source_table = 'sleep_records' ORDER BY m.source_rowid''',
+            (self.source_key,)
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="以前のデータベースを共通のストレージに取り込む")
+    parser.add_argument("source", help="sleep_data.db または data2.db")
+    parser.add_argument("target", nargs="?", default="data2.db")
+    parser.add_argument("--user", type=int, default=1, help="取り込み先の利用者ID")
+    parser.add_argument("--source-user", type=int, default=1, help="data2.db から取り込む利用者ID")
+    parser.add_argument("--shards", type=int, default=1)
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--recheck", action="store_true", help="前回一致しなかったファイルをもう一度検証する")
+    args = parser.parse_args()
+
+    db_manager = DatabaseManager(args.target, user_id=args.user, shard_count=args.shards)
+    migrator = StorageMigrator(
+        args.source, db_manager, batch_size=args.batch_size, source_user_id=args.source_user,
+        progress=lambda phase, rows: print(f"\r{phase}: {rows} rows", end="", flush=True)
+    )
+    try:
+        results = migrator.run(recheck=args.recheck)
+    finally:
+        db_manager.close()
+    print()
+    if results is None:
+        if migrator.status == 'mismatch':
+            raise SystemExit(f"{args.source} was imported but did not verify (use --recheck to verify again)")
+        print(f"{args.source} has already been imported and verified")
+        return
+    for table, (source_count, source_sum), (target_count, target_sum), ok in results:
+        print(f"{table}: source {source_count} rows ({source_sum}), target {target_count} rows ({target_sum})"
+              f" -> {'OK' if ok else 'MISMATCH'}")
+    if not all(ok for _, _, _, ok in results):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+import tkinter as tk
+from tkinter import ttk
+
+
+class VirtualList:
+    """固定の高さの行を、見えている範囲の分だけウィジェットにして表示するスクロールリスト。
+
+    行のデータは fetch_page(last_row, limit) でページ単位に読み込む（last_row は読み込み済みの
+    最後の行で、最初は None）。キーセット方式のクエリに渡せば、何年分の履歴でも先頭から順に
+    必要な分だけ読める。行の中身は render_row(frame, row) で作る。
+    画面外に出た行の枠は破棄せず、次に見えた行に使い回す。
+    """
+
+    def __init__(self, parent, total, fetch_page, render_row, row_height=120, page_size=50, overscan=2):
+        self.total = total
+        self.fetch_page = fetch_page
+        self.render_row = render_row
+        self.row_height = row_height
+        self.page_size = page_size
+        self.overscan = overscan
+        self.rows = []
+        self._exhausted = False
+        self._visible = {}  # 行番号 -> (枠, キャンバス上のアイテムID)
+        self._free = []
+
+        self.canvas = tk.Canvas(parent, highlightthickness=0)
+        self.scrollbar = ttk.Scrollbar(parent, orient="vertical", command=self._on_scrollbar)
+        self.canvas.configure(yscrollcommand=self.scrollbar.set)
+        self.canvas.bind("<Configure>", self._on_configure)
+        self.canvas.pack(side="left", fill="both", expand=True)
+        self.scrollbar.pack(side="right", fill="y")
+        self._update_scrollregion()
+
+    def _on_scrollbar(self, *args):
+        self.canvas.yview(*args)
+        self.refresh()
+
+    def _on_configure(self, event):
+        for _, item in list(self._visible.values()) + self._free:
+            self.canvas.itemconfigure(item, width=event.width)
+        self.refresh()
+
+    def _update_scrollregion(self):
+        self.canvas.configure(scrollregion=(0, 0, self.canvas.winfo_width(), self.total * self.row_height))
+
+    def _ensure_loaded(self, count):
+        while len(self.rows) < count and not self._exhausted:
+            page = self.fetch_page(self.rows[-1] if self.rows else None, self.page_size)
+            self.rows.extend(page)
+            if len(page) < self.page_size:
+                # 件数を数えた後に記録が削除されていた場合は、実際の件数に合わせる
+                self._exhausted = True
+                self.total = len(self.rows)
+                self._update_scrollregion()
+
+    def refresh(self):
+        top = self.canvas.canvasy(0)
+        height = self.canvas.winfo_height()
+        first = max(int(top // self.row_height) - self.overscan, 0)
+        last = min(int((top + height) // self.row_height) + 1 + self.overscan, self.total)
+        self._ensure_loaded(last)
+        last = min(last, len(self.rows))
+
+        for index in [i for i in self._visible if not first <= i < last]:
+            self._release(index)
+        for index in range(first, last):
+            if index not in self._visible:
+                self._materialize(index)
+
+    def _materialize(self, index):
+        y = index * self.row_height
+        if self._free:
+            frame, item = self._free.pop()
+            for widget in frame.winfo_children():
+                widget.destroy()
+            self.canvas.coords(item, 0, y)
+            self.canvas.itemconfigure(item, state="normal")
+        else:
+            frame = ttk.Frame(self.canvas, height=self.row_height)
+            frame.pack_propagate(False)
+            item = self.canvas.create_window(
+                0, y, window=frame, anchor="nw", width=self.canvas.winfo_width(), height=self.row_height
+            )
+        self.render_row(frame, self.rows[index])
+        self._visible[index] = (frame, item)
+
+    def _release(self, index):
+        frame, item = self._visible.pop(index)
+        self.canvas.itemconfigure(item, state="hidden")
+        self._free.append((frame, item))
+
+    def remove(self, predicate):
+        # 削除した行より後ろは1行ずつ詰まるので、表示中の行はすべて描き直す
+        remaining = [row for row in self.rows if not predicate(row)]
+        self.total = max(self.total - (len(self.rows) - len(remaining)), len(remaining))
+        self.rows = remaining
+        for index in list(self._visible):
+            self._release(index)
+        self._update_scrollregion()
+        self.refresh()
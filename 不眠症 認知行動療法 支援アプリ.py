@@ -1,21 +1,56 @@
 
+from startup_profile import StartupProfile
+
+STARTUP = StartupProfile()  # 他のインポートより先に計測を始める
+
 import tkinter as tk
-from tkinter import ttk, messagebox, scrolledtext
+from tkinter import ttk, filedialog, messagebox, scrolledtext
+import argparse
 import sqlite3
 from datetime import datetime, timedelta
 from collections import defaultdict
-import json
-from openai import OpenAI
 import os
+import threading
+from advice_jobs import AdviceJobExecutor
+from advice_queue import CircuitBreaker, CircuitOpenError, OfflineAdviceQueue
+from checklist_catalog import BAD, CATALOG, IMPROVED, PRACTICED, item_frequencies
+from diagnostics_window import DiagnosticsWindow
+from diary_exporter import DiaryExporter, ExportError
+from diary_search import DiarySearch
+from perf_metrics import METRICS, PROMETHEUS_ENV, usage_tokens
+from search_panel import SearchPanel
+from sleep_store import CBT_ADVICE_MAX_CHARS, DatabaseManager, SleepStore
+from sleep_time_utils import duration_minutes, to_epoch
+from storage_migrator import StorageMigrator
+from virtual_list import VirtualList
+
+STARTUP.mark("imports")
+
+ADVICE_QUEUE_POLL_MS = 60 * 1000
+METRICS_FLUSH_MS = 5 * 60 * 1000
+
+# 以前のバージョンの保存先。見つかれば起動時に共通のストレージへ取り込む
+LEGACY_DB_NAME = 'sleep_data.db'
 
 class SleepTherapyApp:
-    def __init__(self, master):
+    def __init__(self, master, user_id=1, db_name='data2.db', shard_count=1):
         self.master = master
         self.master.title("不眠症認知行動療法支援アプリ")
         self.master.geometry("800x700")  # ウィンドウサイズを大きくしました
 
         API_KEY = ""
-        self.client = OpenAI(api_key=API_KEY)
+        self.api_key = API_KEY
+        self._client = None
+        self._client_lock = threading.Lock()
+        # 記録と助言は睡眠改善支援アプリ2.py と同じストレージ（sleep_store）に保存する
+        self.db_manager = DatabaseManager(db_name, user_id=user_id, shard_count=shard_count)
+        self.store = SleepStore(self.db_manager)
+        self.advice_executor = AdviceJobExecutor(self.master)
+        self.ai_breaker = CircuitBreaker()
+        self.advice_queue = OfflineAdviceQueue(
+            self.db_manager.connection_manager, self.request_ai_completion, self.store_ai_advice,
+            breaker=self.ai_breaker
+        )
 
         self.sleep_time = None
         self.wake_time = None
@@ -41,8 +76,44 @@ class SleepTherapyApp:
         self.wake_date_entry.bind("<FocusOut>", lambda e: self.restore_placeholder(e, "YYYY-MM-DD"))
         self.wake_time_entry.bind("<FocusOut>", lambda e: self.restore_placeholder(e, "HH:MM"))
 
-        self.create_database()
+        # 先に画面を描画し、DBの準備と履歴の読み込みはその後に行う
+        STARTUP.mark("shell_built")
+        STARTUP.watch_first_paint(self.master, then=self.finish_startup)
+
+    def finish_startup(self):
+        self.create_database()  # スキーマが最新ならバージョンを確認するだけ
+        STARTUP.mark("schema_checked")
         self.show_recent_history()
+        STARTUP.mark("history_loaded")
+        self.master.after(ADVICE_QUEUE_POLL_MS, self.drain_advice_queue)
+        self.master.after(METRICS_FLUSH_MS, self.schedule_metrics_flush)
+        # 診断ウィンドウはメニューに出さず、Ctrl+Shift+D で開く
+        self.master.bind_all("<Control-Shift-D>", lambda event: DiagnosticsWindow(self.master, METRICS))
+        STARTUP.finish(self.master)
+
+    def flush_metrics(self):
+        # 計測値を perf_metrics テーブルに書き、指定があれば Prometheus 形式のファイルも更新する
+        try:
+            with self.db_manager.transaction() as conn:
+                METRICS.flush_to_table(conn)
+            path = os.environ.get(PROMETHEUS_ENV)
+            if path:
+                METRICS.write_prometheus(path)
+        except (sqlite3.Error, OSError) as e:
+            print(f"Metrics flush error: {e}")
+
+    def schedule_metrics_flush(self):
+        self.flush_metrics()
+        self.master.after(METRICS_FLUSH_MS, self.schedule_metrics_flush)
+
+    @property
+    def client(self):
+        # openai の読み込みは重いので、最初に助言を生成するときまで遅らせる
+        with self._client_lock:
+            if self._client is None:
+                from openai import OpenAI
+                self._client = OpenAI(api_key=self.api_key)
+            return self._client
 
     def create_widgets(self):
         ttk.Button(self.master, text="不眠症の認知行動療法とは", command=self.show_cbt_info).pack(anchor="nw", padx=10, pady=10)
@@ -73,6 +144,8 @@ class SleepTherapyApp:
 
     #    ttk.Button(self.master, text="昼寝をした", command=self.record_nap).pack(pady=10)
         ttk.Button(self.master, text="睡眠履歴とAIの助言を振り返る", command=self.show_history).pack(pady=10)
+        ttk.Button(self.master, text="チェック項目の振り返り（90日）", command=self.show_checklist_summary).pack()
+        ttk.Button(self.master, text="自由記入とAIの助言を検索", command=self.show_search).pack(pady=(10, 0))
 
         self.info_label = ttk.Label(self.master, text="")
         self.info_label.pack(pady=10)
@@ -82,32 +155,57 @@ class SleepTherapyApp:
 
        
     def create_database(self):
-        conn = sqlite3.connect('sleep_data.db')
-        c = conn.cursor()
-        c.execute('''CREATE TABLE IF NOT EXISTS sleep_records
-                    (date TEXT, sleep_time TEXT, wake_time TEXT, nap_time TEXT, 
-                    good_points TEXT, good_points_free TEXT, 
-                    bad_points TEXT, bad_points_free TEXT, therapy_notes TEXT, ai_advice TEXT,
-                    sleep_duration TEXT, practiced_points TEXT)''')
-        c.execute('''CREATE TABLE IF NOT EXISTS cbt_info
-                    (id INTEGER PRIMARY KEY, content TEXT)''')
-        conn.commit()
-        conn.close()
+        # テーブルとインデックスはスキーマバージョンで管理し、既存のデータベースもその場で更新する
+        self.db_manager.create_tables()
+        if os.path.exists(LEGACY_DB_NAME):
+            # 以前の sleep_data.db の記録を取り込む。画面を止めないようワーカーで行い、取り込みと検証が済んでいれば何もしない
+            self.advice_executor.submit(
+                StorageMigrator(LEGACY_DB_NAME, self.db_manager).run,
+                on_success=self.on_storage_migrated, on_error=self.on_storage_migration_failed
+            )
+
+    def on_storage_migrated(self, results):
+        if results is None:
+            return
+        if not all(ok for _, _, _, ok in results):
+            print(f"Storage migration mismatch: {results}")
+        self.show_recent_history()  # 取り込んだ記録を一覧に出す
+
+    def on_storage_migration_failed(self, error):
+        print(f"Storage migration error: {error}")
 
 # クラス内のメソッドとして定義する場合
-    def generate_ai_response(self, user_input):
+    def generate_ai_response(self, user_input, record_key=None):
+        messages = [
+            {"role": "system", "content": "あなたは睡眠習慣の改善の情報提供サポーターです。全ての助言は医療行為の代替としての行為は行わなわず、一般的な情報提供を行うこと。#基本的にはチェック内容全体を分析して、サポート型の回答をして下さい。基本は助言や提案のみとし、あなたから、例えば気になる点や思ったことはありませんか？と問いかけたり、質問は絶対にしないこと。こちらから対話形式で返答が返せないからだ。 #あなたはあくまで不眠症改善の情報提供をする役割で、応援も大事だが、まず助言を最優先すること。できてないことや不合理な点があったとしても、批判的な回答はなるべく控えること。例えば睡眠時間が10時間で長すぎたとしても、表現はマイルドな内容にすること。#睡眠制限は睡眠時間の調整に置き換え、刺激制御は就寝前の習慣づくりに置き換えて、認知の変化は睡眠に対する意識に置き換え、睡眠習慣の改善が見られる場合は褒めて継続できるように促すこと。具体的例としては睡眠制限は睡眠時間の調整ができている時は今の睡眠時間が適切かどうか観察してみて下さい、等。就寝前の習慣づくりができている場合は、それは良い習慣です、続けていけば効果が期待できるかも知れません、等。睡眠に対する意識が変わっている場合は、一つずつ時間をかけて意識を変えていくことで、効果が得られるかも知れません、等。#睡眠時間の調整、睡眠習慣の改善を実践していない、及び睡眠に対する意識の歪みや考え方を是正した方が良い場合は、それらを提案すること。睡眠時間の計算結果が短すぎる、長すぎる場合は、睡眠時間の調整や睡眠習慣の改善の提案をしてみて下さい。具体例としては、寝る時間と起きる時間が把握できたら、そのペースを引き続き継続して、変化があるか観察してみましょう、や、脳に寝る準備をするシグナルを与えると眠気が来る可能性があるため、寝る前に何かの習慣づけることを試してみてはどうでしょうか、変化があるかも知れません、等。睡眠に対する意識がに歪みあった場合の具体例としては、何か決めつけていることや悲観的、不合理な点は対して、例えばこのように考え方が変われば睡眠に変化があるかも知れません、等。#睡眠薬をネガティブに伝えないこと。減らせる自信がついてきたという項目や、その旨の感想があれば今の量を減らせるようにサポートしてあげる方向性で良い。しかしその場合を除き、こちらから睡眠薬の話は絶対しないこと。また、睡眠薬の具体的な名称や用量、増減については、もしあなたが質問を受けてもあなたの判断で回答しないことを大前提とし、特に増減に関してはAIの助言や個人での判断は絶対させず、医師や専門家への相談を必ず強く勧めること。あなたから減薬しませんか？減薬にチャレンジしましょう、減薬を勧めます、という提案は絶対にしないこと。#不安、焦り、ストレス、過度な期待や、気になった点にネガティブな内容がある場合は、必ず励ましてサポートしてあげて下さい。#ネガティブな項目が複数見られる場合は、医師に相談することも勧めてみて下さい。#ネガティブなチェック項目が多い、気になる点の内容を鑑みて症状に深刻さが見られる場合は、必ず医師や専門家に相談するように強く提案すること。 #鬱傾向の人も考えられるので、励ましを行い、頑張ろう、頑張って、頑張って続けましょう。という提案や文章は絶対使わないこと。例えば、何か一つでも実践して継続していけるようになれば、変化があるかも知れません、サポート致します。等とする。#ユーザーの実名、かかっている医療機関名には触れないこと。個人情報の入力は基本的に避けてもらうこと。#改行は無しで350文字以内に必ずまとめて、文章が途切れないように注意して。 "},
+            {"role": "user", "content": user_input}
+        ]
         try:
+            if not self.ai_breaker.allow_request():
+                raise CircuitOpenError("AIへの接続に失敗が続いているため、一時的に送信を停止しています")
+            try:
+                ai_advice = self.request_ai_completion(messages)
+            except Exception:
+                self.ai_breaker.record_failure()
+                raise
+            self.ai_breaker.record_success()
+            return ai_advice
+        except Exception as e:
+            # エラー文を助言として保存せず、再試行キューに入れて接続が戻ったら再送する
+            print(f"AIの応答生成中にエラーが発生しました: {str(e)}")
+            if record_key:
+                self.advice_queue.enqueue(self.advice_target(record_key), messages, e)
+            return None
+
+    def request_ai_completion(self, messages):
+        with METRICS.timer("ai.chat_completion", "ai") as sample:
             response = self.client.chat.completions.create(
                 model="gpt-4o",
-                messages=[
-                    {"role": "system", "content": "あなたは睡眠習慣の改善の情報提供サポーターです。全ての助言は医療行為の代替としての行為は行わなわず、一般的な情報提供を行うこと。#基本的にはチェック内容全体を分析して、サポート型の回答をして下さい。基本は助言や提案のみとし、あなたから、例えば気になる点や思ったことはありませんか？と問いかけたり、質問は絶対にしないこと。こちらから対話形式で返答が返せないからだ。 #あなたはあくまで不眠症改善の情報提供をする役割で、応援も大事だが、まず助言を最優先すること。できてないことや不合理な点があったとしても、批判的な回答はなるべく控えること。例えば睡眠時間が10時間で長すぎたとしても、表現はマイルドな内容にすること。#睡眠制限は睡眠時間の調整に置き換え、刺激制御は就寝前の習慣づくりに置き換えて、認知の変化は睡眠に対する意識に置き換え、睡眠習慣の改善が見られる場合は褒めて継続できるように促すこと。具体的例としては睡眠制限は睡眠時間の調整ができている時は今の睡眠時間が適切かどうか観察してみて下さい、等。就寝前の習慣づくりができている場合は、それは良い習慣です、続けていけば効果が期待できるかも知れません、等。睡眠に対する意識が変わっている場合は、一つずつ時間をかけて意識を変えていくことで、効果が得られるかも知れません、等。#睡眠時間の調整、睡眠習慣の改善を実践していない、及び睡眠に対する意識の歪みや考え方を是正した方が良い場合は、それらを提案すること。睡眠時間の計算結果が短すぎる、長すぎる場合は、睡眠時間の調整や睡眠習慣の改善の提案をしてみて下さい。具体例としては、寝る時間と起きる時間が把握できたら、そのペースを引き続き継続して、変化があるか観察してみましょう、や、脳に寝る準備をするシグナルを与えると眠気が来る可能性があるため、寝る前に何かの習慣づけることを試してみてはどうでしょうか、変化があるかも知れません、等。睡眠に対する意識がに歪みあった場合の具体例としては、何か決めつけていることや悲観的、不合理な点は対して、例えばこのように考え方が変われば睡眠に変化があるかも知れません、等。#睡眠薬をネガティブに伝えないこと。減らせる自信がついてきたという項目や、その旨の感想があれば今の量を減らせるようにサポートしてあげる方向性で良い。しかしその場合を除き、こちらから睡眠薬の話は絶対しないこと。また、睡眠薬の具体的な名称や用量、増減については、もしあなたが質問を受けてもあなたの判断で回答しないことを大前提とし、特に増減に関してはAIの助言や個人での判断は絶対させず、医師や専門家への相談を必ず強く勧めること。あなたから減薬しませんか？減薬にチャレンジしましょう、減薬を勧めます、という提案は絶対にしないこと。#不安、焦り、ストレス、過度な期待や、気になった点にネガティブな内容がある場合は、必ず励ましてサポートしてあげて下さい。#ネガティブな項目が複数見られる場合は、医師に相談することも勧めてみて下さい。#ネガティブなチェック項目が多い、気になる点の内容を鑑みて症状に深刻さが見られる場合は、必ず医師や専門家に相談するように強く提案すること。 #鬱傾向の人も考えられるので、励ましを行い、頑張ろう、頑張って、頑張って続けましょう。という提案や文章は絶対使わないこと。例えば、何か一つでも実践して継続していけるようになれば、変化があるかも知れません、サポート致します。等とする。#ユーザーの実名、かかっている医療機関名には触れないこと。個人情報の入力は基本的に避けてもらうこと。#改行は無しで350文字以内に必ずまとめて、文章が途切れないように注意して。 "},
-                    {"role": "user", "content": user_input}
-                ],
+                messages=messages,
                 max_tokens=4096
             )
-            return response.choices[0].message.content
-        except Exception as e:
-            return f"AIの応答生成中にエラーが発生しました: {str(e)}"
+            sample['tokens'] = usage_tokens(response)
+        return response.choices[0].message.content
 
         
     def show_cbt_info(self):
@@ -115,17 +213,7 @@ class SleepTherapyApp:
         cbt_window.title("不眠症の認知行動療法とは")
         cbt_window.geometry("500x600")
 
-        conn = sqlite3.connect('sleep_data.db')
-        c = conn.cursor()
-        c.execute('SELECT content FROM cbt_info WHERE id = 1')
-        result = c.fetchone()
-        if result:
-            content = result[0]
-        else:
-            content = "不眠症の認知行動療法に関する情報をここに入力してください。"
-            c.execute('INSERT INTO cbt_info (id, content) VALUES (1, ?)', (content,))
-            conn.commit()
-        conn.close()
+        content = self.store.cbt_info("不眠症の認知行動療法に関する情報をここに入力してください。")
 
         text_area = scrolledtext.ScrolledText(cbt_window, wrap=tk.WORD)
         text_area.pack(expand=True, fill='both', padx=10, pady=10)
@@ -133,11 +221,7 @@ class SleepTherapyApp:
 
         def save_content():
             new_content = text_area.get("1.0", tk.END).strip()
-            conn = sqlite3.connect('sleep_data.db')
-            c = conn.cursor()
-            c.execute('UPDATE cbt_info SET content = ? WHERE id = 1', (new_content,))
-            conn.commit()
-            conn.close()
+            self.store.save_cbt_info(new_content)
             messagebox.showinfo("保存完了", "情報が更新されました。")
 
         ttk.Button(cbt_window, text="保存", command=save_content).pack(pady=10)
@@ -197,57 +281,12 @@ class SleepTherapyApp:
         notebook.add(improved_frame, text="改善が見られた点")
         self.create_improved_tab(improved_frame)
 
-        # 気になった点のカテゴリ
-        self.bad_points_categories = {
-            "不安感": [
-                "睡眠薬の効果を感じられず、不安だったり、寝起きを繰り返した",
-                "なぜ眠れないのか色々考えすぎて不安だった",
-                "今日も寝付きが悪いのではないかと不安だった",
-                "全く眠れないかもしれないと不安だった",
-                "何時に寝られるか気になって不快だった",
-                "途中で起きたり、早く起きたりしないか不安だった",
-                "寝坊やそれによるトラブルが心配で不安だった",
-                "寝不足による集中力や気力不足の発生に不安があった",
-                "ホテル宿泊などの外泊で環境がいつもと違ったので、入眠や睡眠時間に不安を感じた",
-            ],
-            "焦り": [
-                "昼寝を長時間したので、寝られるか焦りがあった",
-                "寝る前にカフェイン摂取したりニコチンを摂取したので、寝られるか焦った",
-                "寝具の中で眠れないと悲観的になり、焦りがあった",
-                "眠れないと健康面での支障や、仕事面での支障を感じ焦りがあった",
-                "時計や目覚まし時計を見て睡眠時間を考えると焦りが出た",
-                "早く起きなければならないなど、寝られる時間が限られていて入眠に焦りがあった",
-                "眠れないと取り返しがつかないと焦りがあった",
-                "ホテル宿泊などの外泊で環境がいつもと違ったので、寝られるかどうか焦りがあった",
-            ],
-            "緊張、ストレス感":[
-            "寝室や寝具に入ると緊張してしまった",
-            "夜中に何度も起きたり、15分くらいかそれ以上の中途覚醒があってストレスを感じた",
-            "中途覚醒してトイレに何度も行って不快だった",
-            "眠るまでの時間や起きるまでの時間がゆっくり感じてストレスだった",
-            "恐怖を感じる悪夢をみた、もしくは悪夢を見ないか恐怖があった",
-            "かなしばりのような感覚があった",
-            "かなり長い時間夢を見ている感覚があり、ストレスを感じた",
-            "ホテル宿泊の外泊で環境がいつもと違ったので、寝られるか緊張した"
-            ],
-            "期待への不満":[
-            "眠りが浅いことへの不満があった", 
-            "眠る環境が悪いと感じて寝れた気がせず不満だった",
-            "自分の期待した時間寝られなかったことに悲観的になり、不満があった",
-            "若い頃と同じ睡眠パターンを維持できると期待していて悲観的になった",
-            "リラックスや環境改善したのに、期待通りの睡眠ができず不満や悲観があった",
-            "ストレスや心配事があると絶対に眠れないと決めつけてしまっていた",
-            "睡眠薬を飲まないと絶対に眠れないと信じ込み、寝つきや質が悪いと感じた" ,
-            "寝る前の習慣を1つでも忘れたので、寝られないと思い込んだ" ,
-            "外泊などで睡眠環境が違ったので、寝られないと思い込んだ" ,
-            ]
-        }
-
-        self.bad_point_vars = {}
-        for category, points in self.bad_points_categories.items():
+        # 気になった点はカテゴリごとのタブにする。項目は checklist_catalog の一覧から作る
+        self.bad_point_vars = []
+        for category, items in CATALOG.categories(BAD).items():
             category_frame = ttk.Frame(notebook)
             notebook.add(category_frame, text=category)
-            self.create_bad_points_tab(category_frame, points, category)
+            self.create_bad_points_tab(category_frame, items)
 
         # 自由記入欄のタブ
         free_text_frame = ttk.Frame(notebook)
@@ -289,26 +328,7 @@ class SleepTherapyApp:
         canvas.create_window((0, 0), window=scrollable_frame, anchor="nw")
         canvas.configure(yscrollcommand=scrollbar.set)
 
-        self.practiced_points = [
-            "睡眠制限で、規則正しい就寝,起床時間を維持できた（多少の前後は気にしない）",
-            "睡眠時間の把握や、質の良い睡眠時間がわかってきた",
-            "睡眠制限により、以前より少し早く眠れるようになった気がする",
-            "睡眠準備で、何か習慣化できることを探した、行ってみた",
-            "睡眠準備で、リラックスする方法を探した、行ってみた",
-            "睡眠環境整備で、室温を考えたり、寝具を変えてみた",
-            "寝る前のカフェイン、アルコール、ニコチンの摂取を避けてみた",
-            "寝る前にパソコンやスマートフォン等のブルーライトを避けてみた",
-            "データと自分の認知を見直し、眠りの質について考える機会を持ち、意識を変えてみた",
-            "データと自分の認知を見直し、期待と実際の睡眠時間のギャップを考えてみた",
-            "データと自分の認知を見直し、リラックスや環境改善の効果について考えた",
-            "データと自分の認知を見直し、就寝前の習慣の重要性を考え、意識を変えてみた",
-        ]
-
-        self.practiced_point_vars = []
-        for item in self.practiced_points:
-            var = tk.BooleanVar()
-            ttk.Checkbutton(scrollable_frame, text=item, variable=var).pack(anchor="w", pady=2)
-            self.practiced_point_vars.append(var)
+        self.practiced_point_vars = self.create_checkbuttons(scrollable_frame, CATALOG.group_items(PRACTICED))
 
         explanation_label = ttk.Label(scrollable_frame, 
                                       text="実際に実践した内容を自由記入欄に書いてみましょう。\nAIの回答がより正確になる可能性があります。", 
@@ -332,35 +352,12 @@ class SleepTherapyApp:
         canvas.create_window((0, 0), window=scrollable_frame, anchor="nw")
         canvas.configure(yscrollcommand=scrollbar.set)
 
-        self.improved_points = [
-            "日中の眠気が以前より改善した気がする",
-            "よく寝れた（気がするだけでも大丈夫です）",
-            "熟睡できた感覚があった",
-            "睡眠の質が向上した気がする",
-            "目覚めがすっきりしている",
-            "睡眠にストレスを感じなかった",
-            "入眠がスムーズだった",
-            "途中覚醒が少なかった、もしくは無かった",
-            "全体的に睡眠パターンが改善してきたと感じる",
-            "認知の変化で、睡眠に対する不安が少し和らいだ感じがする",
-            "認知の変化で、眠れないことへの焦りが以前より減った感じがする",
-            "認知の変化で、睡眠時間にこだわりすぎないようになった",
-            "認知の変化で、夜中に目覚めても、以前より落ち着いて対処できたと思う",
-            "睡眠薬が良く効いていた気がする",
-            "睡眠薬を減らせるかもと自信がついてきたので、医師や専門家に相談してみたい",
-            "医師や専門家に相談して睡眠薬を減らしても、睡眠の傾向が良かったと思う"
-        ]
-
-        self.improved_point_vars = []
-        for item in self.improved_points:
-            var = tk.BooleanVar()
-            ttk.Checkbutton(scrollable_frame, text=item, variable=var).pack(anchor="w", pady=2)
-            self.improved_point_vars.append(var)
+        self.improved_point_vars = self.create_checkbuttons(scrollable_frame, CATALOG.group_items(IMPROVED))
 
         canvas.pack(side="left", fill="both", expand=True)
         scrollbar.pack(side="right", fill="y")
 
-    def create_bad_points_tab(self, parent_frame, points, category):
+    def create_bad_points_tab(self, parent_frame, items):
         canvas = tk.Canvas(parent_frame)
         scrollbar = ttk.Scrollbar(parent_frame, orient="vertical", command=canvas.yview)
         scrollable_frame = ttk.Frame(canvas)
@@ -373,59 +370,50 @@ class SleepTherapyApp:
         canvas.create_window((0, 0), window=scrollable_frame, anchor="nw")
         canvas.configure(yscrollcommand=scrollbar.set)
 
-        self.bad_point_vars[category] = []
-        for item in points:
-            var = tk.BooleanVar()
-            ttk.Checkbutton(scrollable_frame, text=item, variable=var).pack(anchor="w", pady=2)
-            self.bad_point_vars[category].append(var)
+        self.bad_point_vars.extend(self.create_checkbuttons(scrollable_frame, items))
 
         canvas.pack(side="left", fill="both", expand=True)
         scrollbar.pack(side="right", fill="y")
 
+    def create_checkbuttons(self, parent_frame, items):
+        # [(項目, BooleanVar), ...] を返す
+        item_vars = []
+        for item in items:
+            var = tk.BooleanVar()
+            ttk.Checkbutton(parent_frame, text=item.label, variable=var).pack(anchor="w", pady=2)
+            item_vars.append((item, var))
+        return item_vars
+
     def create_free_text_tab(self, parent_frame):
         ttk.Label(parent_frame, text="自由記入欄:", font=("", 12, "bold")).pack(anchor="w", pady=5)
         self.free_text = scrolledtext.ScrolledText(parent_frame, height=10, width=50)
         self.free_text.pack(pady=5, fill="both", expand=True)
 
     def save_feedback(self):
-        now = datetime.now()
-        
-        practiced_feedback = [item for item, var in zip(self.practiced_points, self.practiced_point_vars) if var.get()]
-        practiced_feedback_str = ','.join(practiced_feedback)
-        
-        improved_feedback = [item for item, var in zip(self.improved_points, self.improved_point_vars) if var.get()]
-        improved_feedback_str = ','.join(improved_feedback)
-        
-        bad_feedback = {}
+        # 選択はグループごとのビットマスクで保存する。AIへの入力には項目の文章を使う
+        practiced_items = [item for item, var in self.practiced_point_vars if var.get()]
+        practiced_feedback_str = ','.join(item.label for item in practiced_items)
+
+        improved_items = [item for item, var in self.improved_point_vars if var.get()]
+        improved_feedback_str = ','.join(item.label for item in improved_items)
+
+        bad_items = [item for item, var in self.bad_point_vars if var.get()]
         bad_feedback_str = ""
-        for category, vars in self.bad_point_vars.items():
-            category_points = [item for item, var in zip(self.bad_points_categories[category], vars) if var.get()]
+        for category, items in CATALOG.categories(BAD).items():
+            category_points = [item.label for item in items if item in bad_items]
             if category_points:
-                bad_feedback[category] = category_points
                 bad_feedback_str += f"{category}: {', '.join(category_points)}\n"
         
         free_text = self.free_text.get("1.0", tk.END).strip()
 
         sleep_duration = self.calculate_sleep_duration(self.sleep_time, self.wake_time)
 
-        conn = sqlite3.connect('sleep_data.db')
-        c = conn.cursor()
-        yesterday = (now - timedelta(days=1)).strftime("%Y-%m-%d")
-        c.execute("SELECT therapy_notes FROM sleep_records WHERE date = ?", (yesterday,))
-        result = c.fetchone()
-        previous_notes = result[0] if result else ""
-
         user_input = f"睡眠時間: {sleep_duration}\n"
         user_input += f"実践したこと: {practiced_feedback_str}\n"
         user_input += f"改善が見られた点: {improved_feedback_str}\n"
         user_input += f"気になった点:\n{bad_feedback_str}\n"
         user_input += f"自由記入: {free_text}\n"
-       # user_input += f"前日の取り組み: {previous_notes}"
         
-        ai_advice = self.generate_ai_response(user_input)
-        if len(ai_advice) > 400:  
-            ai_advice = ai_advice[:400]
-
         sleep_date = self.sleep_date_entry.get()
         sleep_time = self.sleep_time_entry.get()
         if sleep_date != "YYYY-MM-DD" and sleep_time != "HH:MM":
@@ -433,37 +421,70 @@ class SleepTherapyApp:
         else:
             sleep_datetime = self.sleep_time.strftime("%Y-%m-%d %H:%M:%S") if self.sleep_time else None
 
-        c.execute("""INSERT INTO sleep_records 
-                (date, sleep_time, wake_time, nap_time, good_points, good_points_free, 
-                bad_points, bad_points_free, therapy_notes, ai_advice, sleep_duration, practiced_points)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-            (self.wake_time.strftime("%Y-%m-%d"),
-            self.sleep_time.strftime("%Y-%m-%d %H:%M:%S"),
-            self.wake_time.strftime("%Y-%m-%d %H:%M:%S"),
-            self.nap_time.strftime("%Y-%m-%d %H:%M:%S") if self.nap_time else None,
-            improved_feedback_str,
-            free_text,
-            json.dumps(bad_feedback),
-            "",
-            "",
-            ai_advice,
-            sleep_duration,
-            practiced_feedback_str))
-
-        conn.commit()
-        conn.close()
+        sleep_epoch = to_epoch(self.sleep_time)
+        wake_epoch = to_epoch(self.wake_time)
+
+        # 自由記入は睡眠改善支援アプリ2.py の起床後の振り返りと同じ列に保存する
+        record_id = self.store.save_record({
+            'date': self.wake_time.strftime("%Y-%m-%d"),
+            'sleep_time': self.sleep_time.strftime("%Y-%m-%d %H:%M:%S"),
+            'wake_time': self.wake_time.strftime("%Y-%m-%d %H:%M:%S"),
+            'nap_time': self.nap_time.strftime("%Y-%m-%d %H:%M:%S") if self.nap_time else None,
+            'sleep_reflection': free_text,
+            'bad_points_free': "",
+            'therapy_notes': "",
+            'sleep_duration': sleep_duration,
+            'sleep_epoch': sleep_epoch,
+            'wake_epoch': wake_epoch,
+            'duration_minutes': duration_minutes(sleep_epoch, wake_epoch),
+            'practiced_mask': CATALOG.encode(practiced_items),
+            'improved_mask': CATALOG.encode(improved_items),
+            'bad_mask': CATALOG.encode(bad_items),
+        })
+
+        record_key = (self.wake_time.strftime("%Y-%m-%d"), record_id)
+        self.advice_executor.submit(
+            self.generate_ai_response, user_input, record_key,
+            on_success=lambda ai_advice: self.save_ai_advice(record_key, ai_advice)
+        )
 
         self.feedback_window.destroy()
         self.reset_daily_data()
-        messagebox.showinfo("記録完了", "睡眠記録が保存されました。")
+        messagebox.showinfo("記録完了", "睡眠記録が保存されました。AIの助言は生成され次第、履歴に表示されます。")
         self.show_recent_history()
 
+    def save_ai_advice(self, record_key, ai_advice):
+        if not ai_advice:  # 生成に失敗した助言は再試行キューから後で書き込まれる
+            return
+        self.store_ai_advice(self.advice_target(record_key), ai_advice)
+        self.show_recent_history()
+
+    def advice_target(self, record_key):
+        # record_key は (日付, 記録のID)。キューのジョブにも同じ形で保存する
+        return {'date': record_key[0], 'user_id': self.db_manager.user_id,
+                'record_id': record_key[1], 'max_chars': CBT_ADVICE_MAX_CHARS}
+
+    def store_ai_advice(self, target, ai_advice):
+        # 再試行キューのワーカースレッドからも呼ばれるので、ウィジェットには触れない
+        self.store.save_queued_advice(target, ai_advice)
+
+    def drain_advice_queue(self):
+        # 保存しておいた助言リクエストを定期的に再送する（ブレーカーが開いている間は何もしない）
+        if self.advice_queue.has_due_jobs():
+            self.advice_executor.submit(self.advice_queue.drain, on_success=self.on_queued_advice_completed)
+        self.master.after(ADVICE_QUEUE_POLL_MS, self.drain_advice_queue)
+
+    def on_queued_advice_completed(self, completed):
+        if completed:
+            self.show_recent_history()
+
     def reset_daily_data(self):
         self.sleep_time = None
         self.wake_time = None
         self.nap_time = None
         self.update_info()
 
+    @METRICS.timed("ui.show_recent_history")
     def show_recent_history(self):
         for widget in self.history_frame.winfo_children():
             widget.destroy()
@@ -488,12 +509,8 @@ class SleepTherapyApp:
         canvas.create_window((0, 0), window=scrollable_frame, anchor="nw")
         canvas.configure(yscrollcommand=scrollbar.set)
 
-        conn = sqlite3.connect('sleep_data.db')
-        c = conn.cursor()
         seven_days_ago = (datetime.now() - timedelta(days=7)).strftime("%Y-%m-%d")
-        c.execute("SELECT * FROM sleep_records WHERE date >= ? ORDER BY date DESC", (seven_days_ago,))
-        records = c.fetchall()
-        conn.close()
+        records = self.store.records_between(seven_days_ago)
 
         for record in records:
             self.create_recent_record_display(scrollable_frame, record)
@@ -508,20 +525,64 @@ class SleepTherapyApp:
         info_frame = ttk.Frame(record_frame)
         info_frame.pack(side="left", fill="x", expand=True)
 
-        ttk.Label(info_frame, text=f"日付: {record[0]}", wraplength=550).pack(anchor="w")
-        ttk.Label(info_frame, text=f"就寝時間: {record[1]}", wraplength=550).pack(anchor="w")
-        ttk.Label(info_frame, text=f"起床時間: {record[2]}", wraplength=550).pack(anchor="w")
-        ttk.Label(info_frame, text=f"睡眠時間: {record[10]}", wraplength=550).pack(anchor="w")
-        if record[3]:
-            ttk.Label(info_frame, text=f"昼寝時間: {record[3]}", wraplength=550).pack(anchor="w")
+        ttk.Label(info_frame, text=f"日付: {record.date}", wraplength=550).pack(anchor="w")
+        ttk.Label(info_frame, text=f"就寝時間: {record.sleep_time}", wraplength=550).pack(anchor="w")
+        ttk.Label(info_frame, text=f"起床時間: {record.wake_time}", wraplength=550).pack(anchor="w")
+        ttk.Label(info_frame, text=f"睡眠時間: {record.sleep_duration}", wraplength=550).pack(anchor="w")
+        if record.nap_time:
+            ttk.Label(info_frame, text=f"昼寝時間: {record.nap_time}", wraplength=550).pack(anchor="w")
 
-        if len(record) > 9 and record[9]:
+        if record.advice:
             ttk.Label(info_frame, text="AIからの助言:", wraplength=550, font=("", 10, "bold")).pack(anchor="w")
-            ai_advice_label = ttk.Label(info_frame, text=record[9], wraplength=550)
+            ai_advice_label = ttk.Label(info_frame, text=record.advice, wraplength=550)
             ai_advice_label.pack(anchor="w", pady=5)
 
         ttk.Separator(parent_frame, orient='horizontal').pack(fill='x', pady=5)
 
+    def show_checklist_summary(self, days=90):
+        # 項目ごとの回数はビットマスクの列から1回の集計クエリで数える
+        end_date = datetime.now().date()
+        start_date = end_date - timedelta(days=days - 1)
+        conn = self.db_manager.connection_manager.get_connection()
+        groups = [(title, item_frequencies(conn, group, start_date, end_date, self.db_manager.user_id))
+                  for title, group in (("実践したこと", PRACTICED), ("改善が見られた点", IMPROVED),
+                                       ("気になった点", BAD))]
+
+        summary_window = tk.Toplevel(self.master)
+        summary_window.title(f"チェック項目の振り返り（直近{days}日）")
+        summary_window.geometry("700x600")
+
+        text_area = scrolledtext.ScrolledText(summary_window, wrap=tk.WORD)
+        text_area.pack(expand=True, fill='both', padx=10, pady=10)
+        for title, (counts, nights) in groups:
+            text_area.insert(tk.END, f"{title}（{nights}件の記録）\n")
+            for item, count in counts:
+                if count:
+                    text_area.insert(tk.END, f"  {count}回  {item.label}\n")
+            text_area.insert(tk.END, "\n")
+        text_area.configure(state="disabled")
+
+    def show_search(self):
+        search = DiarySearch(self.db_manager.execute_query, user_id=self.db_manager.user_id)
+        SearchPanel(self.master, search, self.open_search_result)
+
+    def open_search_result(self, rowid, kind, date):
+        # 索引の rowid は、記録なら id * 2、助言なら advice_history.id * 2 + 1
+        if kind == 'advice':
+            record = next((r for r in self.store.records_between(date, date) if r.advice_history_id == rowid // 2),
+                          None)
+            if record is None:
+                advice = self.store.advice(rowid // 2)
+                if advice:
+                    messagebox.showinfo(f"AIからの助言 {date}", advice)
+                    return
+        else:
+            record = self.store.record(rowid // 2)
+        if record:
+            self.show_record_detail(record, lambda: None)
+        else:
+            messagebox.showinfo("検索", "この記録は削除されています。")
+
     def show_history(self):
         history_window = tk.Toplevel(self.master)
         history_window.title("睡眠履歴")
@@ -540,113 +601,207 @@ class SleepTherapyApp:
         refresh_button = ttk.Button(history_window, text="履歴を更新", command=refresh_history)
         refresh_button.pack(pady=10)
 
-    def populate_history(self, notebook):
-        conn = sqlite3.connect('sleep_data.db')
-        c = conn.cursor()
-        c.execute("SELECT * FROM sleep_records ORDER BY date DESC")
-        records = c.fetchall()
-        conn.close()
+        export_button = ttk.Button(history_window, text="記録を書き出す（医師との共有用）", command=self.export_history)
+        export_button.pack(pady=(0, 10))
 
-        classified_records = defaultdict(lambda: defaultdict(list))
-        for record in records:
-            date = datetime.strptime(record[0], "%Y-%m-%d")
-            year = date.year
-            month = date.month
-            classified_records[year][month].append(record)
+    def export_history(self):
+        path = filedialog.asksaveasfilename(
+            title="記録を書き出す",
+            defaultextension=".csv",
+            filetypes=[("CSV", "*.csv"), ("Parquet", "*.parquet"), ("Arrow", "*.arrow"), ("JSON Lines", "*.jsonl")]
+        )
+        if not path:
+            return
+        # 書き出しはワーカースレッドで行い、画面は止めない
+        self.advice_executor.submit(
+            DiaryExporter(self.db_manager).export, path,
+            on_success=lambda result: messagebox.showinfo(
+                "書き出し完了", f"{result['rows']}件の記録を {result['path']} に書き出しました。"),
+            on_error=lambda e: messagebox.showerror(
+                "書き出しエラー", str(e) if isinstance(e, ExportError) else f"書き出しに失敗しました: {e}")
+        )
 
-        for year in sorted(classified_records.keys(), reverse=True):
+    @METRICS.timed("ui.populate_history")
+    def populate_history(self, notebook):
+        # 先に月ごとの件数だけを数え、各月の記録は月のタブが最初に表示されたときに読み込む
+        month_counts = self.load_history_months()
+
+        classified_months = defaultdict(list)
+        for month_key, count in month_counts:
+            try:
+                date = datetime.strptime(month_key, "%Y-%m")
+            except (TypeError, ValueError):
+                continue
+            classified_months[date.year].append((date.month, count))
+
+        for year in sorted(classified_months.keys(), reverse=True):
             year_frame = ttk.Frame(notebook)
             notebook.add(year_frame, text=str(year))
 
             year_notebook = ttk.Notebook(year_frame)
             year_notebook.pack(fill="both", expand=True)
 
-            for month in sorted(classified_records[year].keys(), reverse=True):
+            for month, count in classified_months[year]:
                 month_frame = ttk.Frame(year_notebook)
+                month_frame.history_month = (year, month, count)
                 year_notebook.add(month_frame, text=f"{month}月")
 
-                canvas = tk.Canvas(month_frame)
-                scrollbar = ttk.Scrollbar(month_frame, orient="vertical", command=canvas.yview)
-                scrollable_frame = ttk.Frame(canvas)
+            year_notebook.bind("<<NotebookTabChanged>>", lambda e: self.build_history_month(e.widget))
+
+        def on_year_changed(event):
+            selected = event.widget.select()
+            if selected:
+                year_frame = event.widget.nametowidget(selected)
+                self.build_history_month(year_frame.winfo_children()[0])
+
+        notebook.bind("<<NotebookTabChanged>>", on_year_changed)
+        if notebook.tabs():
+            self.build_history_month(notebook.nametowidget(notebook.tabs()[0]).winfo_children()[0])
+
+    @METRICS.timed("ui.build_history_month")
+    def build_history_month(self, year_notebook):
+        selected = year_notebook.select()
+        if not selected:
+            return
+        month_frame = year_notebook.nametowidget(selected)
+        if month_frame.winfo_children():
+            return  # 作成済み
+
+        year, month, count = month_frame.history_month
+        start = f"{year:04d}-{month:02d}-01"
+        end = f"{year + 1:04d}-01-01" if month == 12 else f"{year:04d}-{month + 1:02d}-01"
+
+        records_list = VirtualList(month_frame, count,
+                                   lambda last_row, limit: self.fetch_history_page(start, end, last_row, limit),
+                                   lambda frame, record: self.create_record_row(frame, record, records_list))
+        records_list.refresh()
+
+    def load_history_months(self):
+        # [(YYYY-MM, 件数), ...] の新しい順
+        return self.store.month_counts()
 
-                scrollable_frame.bind(
-                    "<Configure>",
-                    lambda e: canvas.configure(
-                        scrollregion=canvas.bbox("all")
-                    )
-                )
+    def fetch_history_page(self, start, end, last_row, limit):
+        # (date, wake_time, id) のキーセットで次のページを読む。idx_sleep_records_user_date_wake で範囲検索になる
+        return self.store.page(start, end, last_row, limit)
 
-                canvas.create_window((0, 0), window=scrollable_frame, anchor="nw")
-                canvas.configure(yscrollcommand=scrollbar.set)
+    def create_record_row(self, row_frame, record, records_list):
+        # 一覧の1行は要約だけにして高さを揃える。全項目は「詳細」で別ウィンドウに表示する
+        def on_deleted():
+            records_list.remove(lambda r: r.id == record.id)
 
-                for record in classified_records[year][month]:
-                    self.create_record_display(scrollable_frame, record)
+        button_frame = ttk.Frame(row_frame)
+        button_frame.pack(side="right", padx=5)
+        ttk.Button(button_frame, text="詳細",
+                   command=lambda: self.show_record_detail(record, on_deleted)).pack(side="top", pady=2)
+        ttk.Button(button_frame, text="削除",
+                   command=lambda: self.delete_record(record, on_deleted)).pack(side="top", pady=2)
+
+        info_frame = ttk.Frame(row_frame)
+        info_frame.pack(side="left", fill="both", expand=True, padx=5, pady=5)
+
+        ttk.Label(info_frame, text=f"日付: {record.date}", font=("", 10, "bold")).pack(anchor="w")
+        summary = f"就寝時間: {record.sleep_time}　起床時間: {record.wake_time}　睡眠時間: {record.sleep_duration}"
+        if record.nap_time:
+            summary += f"　昼寝時間: {record.nap_time}"
+        ttk.Label(info_frame, text=summary, wraplength=600).pack(anchor="w")
+
+        advice = record.advice or "助言なし"
+        if len(advice) > 120:
+            advice = advice[:120] + "…"
+        ttk.Label(info_frame, text=f"AIからの助言: {advice}", wraplength=600).pack(anchor="w", pady=(5, 0))
+
+        ttk.Separator(row_frame, orient='horizontal').place(relx=0, rely=1.0, relwidth=1.0, anchor="sw")
+
+    def show_record_detail(self, record, on_deleted):
+        detail_window = tk.Toplevel(self.master)
+        detail_window.title(f"睡眠記録 {record.date}")
+        detail_window.geometry("700x600")
+
+        canvas = tk.Canvas(detail_window)
+        scrollbar = ttk.Scrollbar(detail_window, orient="vertical", command=canvas.yview)
+        scrollable_frame = ttk.Frame(canvas)
 
-                canvas.pack(side="left", fill="both", expand=True)
-                scrollbar.pack(side="right", fill="y")
+        scrollable_frame.bind(
+            "<Configure>",
+            lambda e: canvas.configure(
+                scrollregion=canvas.bbox("all")
+            )
+        )
 
-    def create_record_display(self, parent_frame, record):
+        canvas.create_window((0, 0), window=scrollable_frame, anchor="nw")
+        canvas.configure(yscrollcommand=scrollbar.set)
+
+        def on_detail_deleted():
+            detail_window.destroy()
+            on_deleted()
+
+        self.create_record_display(scrollable_frame, record, on_detail_deleted)
+
+        canvas.pack(side="left", fill="both", expand=True)
+        scrollbar.pack(side="right", fill="y")
+
+    def create_record_display(self, parent_frame, record, on_deleted=None):
         record_frame = ttk.Frame(parent_frame)
         record_frame.pack(fill="x", expand=True, pady=5)
 
         info_frame = ttk.Frame(record_frame)
         info_frame.pack(side="left", fill="x", expand=True)
 
-        ttk.Label(info_frame, text=f"日付: {record[0]}", wraplength=550).pack(anchor="w")
-        ttk.Label(info_frame, text=f"就寝時間: {record[1]}", wraplength=550).pack(anchor="w")
-        ttk.Label(info_frame, text=f"起床時間: {record[2]}", wraplength=550).pack(anchor="w")
-        ttk.Label(info_frame, text=f"睡眠時間: {record[10]}", wraplength=550).pack(anchor="w")
-        if record[3]:
-            ttk.Label(info_frame, text=f"昼寝時間: {record[3]}", wraplength=550).pack(anchor="w")
+        ttk.Label(info_frame, text=f"日付: {record.date}", wraplength=550).pack(anchor="w")
+        ttk.Label(info_frame, text=f"就寝時間: {record.sleep_time}", wraplength=550).pack(anchor="w")
+        ttk.Label(info_frame, text=f"起床時間: {record.wake_time}", wraplength=550).pack(anchor="w")
+        ttk.Label(info_frame, text=f"睡眠時間: {record.sleep_duration}", wraplength=550).pack(anchor="w")
+        if record.nap_time:
+            ttk.Label(info_frame, text=f"昼寝時間: {record.nap_time}", wraplength=550).pack(anchor="w")
 
         ai_frame = ttk.Frame(info_frame)
         ai_frame.pack(fill="x", expand=True, pady=5)
 
         ttk.Label(ai_frame, text="AIからの助言:", wraplength=550, font=("", 10, "bold")).pack(anchor="w")
-        ai_advice_label = ttk.Label(ai_frame, text=record[9] if record[9] else "助言なし", wraplength=550)
+        ai_advice_label = ttk.Label(ai_frame, text=record.advice if record.advice else "助言なし", wraplength=550)
         ai_advice_label.pack(anchor="w", pady=5)
 
-        improved_points = record[4].split(',') if record[4] else []
-        bad_points = json.loads(record[6]) if record[6] else {}
-        practiced_points = record[11].split(',') if record[11] else []
-        
+        # 選択は practiced_mask / improved_mask / bad_mask のビットで持っている
+        practiced_points = CATALOG.decode(PRACTICED, record.practiced_mask)
+        improved_points = CATALOG.decode(IMPROVED, record.improved_mask)
+        bad_points = CATALOG.decode(BAD, record.bad_mask)
+
         if practiced_points:
             ttk.Label(info_frame, text="実践したこと:", wraplength=550, font=("", 10, "bold")).pack(anchor="w")
             for point in practiced_points:
-                ttk.Label(info_frame, text=f"- {point}", wraplength=550).pack(anchor="w")
+                ttk.Label(info_frame, text=f"- {point.label}", wraplength=550).pack(anchor="w")
 
         if improved_points:
             ttk.Label(info_frame, text="改善が見られた点:", wraplength=550, font=("", 10, "bold")).pack(anchor="w")
             for point in improved_points:
-                ttk.Label(info_frame, text=f"- {point}", wraplength=550).pack(anchor="w")
+                ttk.Label(info_frame, text=f"- {point.label}", wraplength=550).pack(anchor="w")
     
-        if record[5]:  # good_points_free
+        if record.sleep_reflection:  # 自由記入
             ttk.Label(info_frame, text="自由記入欄:", wraplength=550, font=("", 10, "bold")).pack(anchor="w")
-            ttk.Label(info_frame, text=record[5], wraplength=550).pack(anchor="w")
+            ttk.Label(info_frame, text=record.sleep_reflection, wraplength=550).pack(anchor="w")
     
         if bad_points:
             ttk.Label(info_frame, text="気になった点:", wraplength=550, font=("", 10, "bold")).pack(anchor="w")
-            for category, points in bad_points.items():
+            for category, items in CATALOG.categories(BAD).items():
+                points = [item for item in items if item in bad_points]
+                if not points:
+                    continue
                 ttk.Label(info_frame, text=f"{category}:", wraplength=550).pack(anchor="w")
                 for point in points:
-                    ttk.Label(info_frame, text=f"- {point}", wraplength=550).pack(anchor="w")
+                    ttk.Label(info_frame, text=f"- {point.label}", wraplength=550).pack(anchor="w")
 
         button_frame = ttk.Frame(record_frame)
         button_frame.pack(side="right", padx=5)
 
         ttk.Button(button_frame, text="削除", 
-                   command=lambda: self.delete_record(record[0], record[2], record_frame)).pack(side="top", pady=2)
+                   command=lambda: self.delete_record(record, on_deleted or record_frame.destroy)).pack(side="top", pady=2)
 
         ttk.Separator(parent_frame, orient='horizontal').pack(fill='x', pady=5)
 
-    def delete_record(self, date, time, frame):
-        if messagebox.askyesno("削除確認", f"{date}の記録を削除しますか？"):
-            conn = sqlite3.connect('sleep_data.db')
-            c = conn.cursor()
-            c.execute("DELETE FROM sleep_records WHERE date = ? AND wake_time = ?", (date, time))
-            conn.commit()
-            conn.close()
-            frame.destroy()
+    def delete_record(self, record, on_deleted):
+        if messagebox.askyesno("削除確認", f"{record.date}の記録を削除しますか？"):
+            self.store.delete_record(record.id)
+            on_deleted()
             messagebox.showinfo("削除完了", "記録が削除されました。")
             self.show_recent_history()
 
@@ -673,7 +828,18 @@ class SleepTherapyApp:
         if event.widget.get() == "":
             event.widget.insert(0, placeholder)
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="不眠症認知行動療法支援アプリ")
+    parser.add_argument("--user", type=int, default=1, help="利用者ID")
+    parser.add_argument("--db", default="data2.db", help="データベースファイル")
+    parser.add_argument("--shards", type=int, default=1, help="利用者を振り分けるファイルの数")
+    return parser.parse_args()
+
 if __name__ == "__main__":
+    args = parse_args()
     root = tk.Tk()
-    app = SleepTherapyApp(root)
+    app = SleepTherapyApp(root, user_id=args.user, db_name=args.db, shard_count=args.shards)
     root.mainloop()
+    app.advice_executor.shutdown()
+    app.flush_metrics()
+    app.db_manager.close()
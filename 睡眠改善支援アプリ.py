@@ -1,86 +1,10 @@
+import os
 import sqlite3
-from datetime import datetime, timedelta
-
-class DatabaseManager:
-    def __init__(self, db_name='data2.db'):
-        self.db_name = db_name
-
-    def execute_query(self, query, params=None):
-        conn = None
-        try:
-            conn = sqlite3.connect(self.db_name)
-            cursor = conn.cursor()
-            if params:
-                cursor.execute(query, params)
-            else:
-                cursor.execute(query)
-            conn.commit()
-            result = cursor.fetchall()
-            print(f"Debug: SQL Query: {query}, Params: {params}, Result: {result}")  # デバッグ出力
-            return result
-        except sqlite3.Error as e:
-            print(f"Database error: {e}")
-            return None
-        finally:
-            if conn:
-               conn.close()
-
-    def create_tables(self):
-        sleep_records_table = '''CREATE TABLE IF NOT EXISTS sleep_records
-            (id INTEGER PRIMARY KEY AUTOINCREMENT,
-            date TEXT,
-            sleep_time TEXT,
-            wake_time TEXT,
-            sleep_duration TEXT,
-            sleep_satisfaction INTEGER,
-            sleep_quality INTEGER,
-            sleep_dissatisfaction INTEGER,
-            sleep_anxiety INTEGER,
-            sleep_preparation TEXT,
-            sleep_reflection TEXT,
-            advice_history_id INTEGER)'''
-
-        advice_history_table = '''CREATE TABLE IF NOT EXISTS advice_history
-            (id INTEGER PRIMARY KEY,
-            advice TEXT,
-            date TEXT,
-            FOREIGN KEY(id) REFERENCES sleep_records(id))'''
-
-        user_profiles_table = '''CREATE TABLE IF NOT EXISTS user_profiles
-            (id INTEGER PRIMARY KEY AUTOINCREMENT,
-            nickname TEXT,
-            sleep_medication TEXT,
-            medication_reduction TEXT,
-            advice_intensity TEXT)'''
-
-        cbt_info_table = '''CREATE TABLE IF NOT EXISTS cbt_info
-            (id INTEGER PRIMARY KEY,
-            content TEXT)'''
-
-        self.execute_query(sleep_records_table)
-        self.execute_query(advice_history_table)
-        self.execute_query(user_profiles_table)
-        self.execute_query(cbt_info_table)
-        print("All tables created successfully")
-    
-    @staticmethod
-    def get_advice_for_recent_records(conn):
-        seven_days_ago = (datetime.now() - timedelta(days=7)).strftime("%Y-%m-%d")
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT sr.*, ah.advice 
-            FROM sleep_records sr
-            LEFT JOIN advice_history ah ON sr.date = ah.date
-            WHERE sr.date >= ?
-            ORDER BY sr.date DESC
-        """, (seven_days_ago,))
-        return cursor.fetchall()
-    
-    def get_all_advice_history(self):
-        query = "SELECT * FROM advice_history"
-        result = self.execute_query(query)
-        print("Debug: All advice history:", result)
-        return result
+from datetime import date, datetime, timedelta
+from diagnostics_window import DiagnosticsWindow
+from perf_metrics import METRICS, PROMETHEUS_ENV, usage_tokens
+from sleep_store import DatabaseManager, SleepStore
+from sleep_time_utils import duration_minutes, to_epoch
 
 class UserProfileManager:
     def __init__(self, db_manager):
@@ -136,47 +60,39 @@ class UserProfileManager:
 class SleepRecordManager:
     def __init__(self, db_manager):
         self.db_manager = db_manager
+        self.store = SleepStore(db_manager)
 
     def get_sleep_records(self, start_date, end_date):
-        query = '''SELECT * FROM sleep_records 
-                   WHERE date BETWEEN ? AND ? 
-                   ORDER BY date DESC'''
-        return self.db_manager.execute_query(query, (start_date, end_date))
+        return self.store.sleep_records(start_date, end_date)
+
+    def get_records_with_advice(self, start_date, end_date):
+        # 記録と助言（結び付けた助言か、その日の最新の助言）を1回の結合クエリで取得する
+        return self.store.records_between(start_date, end_date)
 
     def save_sleep_record(self, record):
-        query = '''INSERT INTO sleep_records 
-                   (date, sleep_time, wake_time, sleep_duration, 
-                   sleep_satisfaction, sleep_quality, sleep_dissatisfaction, sleep_anxiety,
-                   sleep_preparation, sleep_reflection)
-                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'''
-        self.db_manager.execute_query(query, (
-            record['date'],
-            record['sleep_time'],
-            record['wake_time'],
-            record['sleep_duration'],
-            record['sleep_satisfaction'],
-            record['sleep_quality'],
-            record['sleep_dissatisfaction'],
-            record['sleep_anxiety'],
-            record['sleep_preparation'],
-            record['sleep_reflection']
+        # 集計用にエポック秒と分単位の睡眠時間も保存する（睡眠改善支援アプリ2.py と同じ列）
+        sleep_epoch = to_epoch(record['sleep_time'])
+        wake_epoch = to_epoch(record['wake_time'])
+        record_id = self.store.save_record(dict(
+            record,
+            sleep_epoch=sleep_epoch,
+            wake_epoch=wake_epoch,
+            duration_minutes=duration_minutes(sleep_epoch, wake_epoch)
         ))
         print(f"Saved sleep record for date: {record['date']}")
+        return record_id
 
     def get_recent_records(self, days=7):
         end_date = datetime.now().strftime("%Y-%m-%d")
         start_date = (datetime.now() - timedelta(days=days)).strftime("%Y-%m-%d")
-        records = self.get_sleep_records(start_date, end_date)
-        return records if records else []
+        return self.get_records_with_advice(start_date, end_date)
 
     def delete_record(self, record_id):
-        query = "DELETE FROM sleep_records WHERE id = ?"
-        self.db_manager.execute_query(query, (record_id,))
+        self.store.delete_record(record_id)
         print(f"Deleted sleep record with ID: {record_id}")
 
     def update_advice_id(self, sleep_record_id, advice_id):
-        query = "UPDATE sleep_records SET advice_history_id = ? WHERE id = ?"
-        self.db_manager.execute_query(query, (advice_id, sleep_record_id))
+        self.store.link_advice(sleep_record_id, advice_id)
         print(f"Updated advice ID for sleep record: {sleep_record_id}")
 
     def calculate_sleep_duration(self, sleep_time, wake_time):
@@ -206,7 +122,6 @@ class SleepRecordManager:
 
 import tkinter as tk
 from tkinter import ttk, messagebox, scrolledtext
-from tkcalendar import Calendar
 
 class UIManager:
     def __init__(self, master):
@@ -425,6 +340,8 @@ class UIManager:
         history_window.title("睡眠履歴とAI助言")
         history_window.geometry("800x700")
 
+        from tkcalendar import Calendar  # 起動を速くするため、履歴を初めて開いたときに読み込む
+
         cal = Calendar(history_window, selectmode='day', date_pattern='y-mm-dd')
         cal.pack(pady=20)
         cal.bind("<<CalendarSelected>>", calendar_callback)
@@ -493,10 +410,10 @@ class UIManager:
         ttk.Label(info_frame, text=f"起床時間: {record[3]}", wraplength=550).pack(anchor="w")
         ttk.Label(info_frame, text=f"睡眠時間: {record[4]}", wraplength=550).pack(anchor="w")
 
-        if record[11]:  # AI助言がある場合（advice_history_idが存在する場合）
+        if record.advice:  # AI助言がある場合
             ttk.Label(info_frame, text="AIからの助言:", wraplength=550, font=("", 10, "bold")).pack(anchor="w")
             ttk.Button(info_frame, text="アドバイスを表示", 
-                       command=lambda: self.show_ai_advice(record[11], record[1])).pack(anchor="w", pady=5)
+                       command=lambda: self.show_ai_advice(record.advice, record[1])).pack(anchor="w", pady=5)
 
         button_frame = ttk.Frame(record_frame)
         button_frame.pack(side="right", padx=5)
@@ -533,10 +450,10 @@ class UIManager:
         ttk.Label(scrollable_frame, text=f"寝る前の振り返り: {record[9]}", wraplength=550).pack(anchor="w")
         ttk.Label(scrollable_frame, text=f"起床後の振り返り: {record[10]}", wraplength=550).pack(anchor="w")
         
-        if record[11]:  # AI助言がある場合（advice_history_idが存在する場合）
+        if record.advice:  # AI助言がある場合
             ttk.Label(scrollable_frame, text="AIからの助言:", wraplength=550, font=("", 10, "bold")).pack(anchor="w")
             ttk.Button(scrollable_frame, text="アドバイスを表示", 
-                       command=lambda: self.show_ai_advice(record[11], record[1])).pack(anchor="w", pady=5)
+                       command=lambda: self.show_ai_advice(record.advice, record[1])).pack(anchor="w", pady=5)
 
         canvas.pack(side="left", fill="both", expand=True)
         scrollbar.pack(side="right", fill="y")
@@ -544,45 +461,52 @@ class UIManager:
     def refresh_calendar(self, all_dates):
         self.cal.calevent_remove('all')
         
-        for date_tuple in all_dates:
-            date_str = date_tuple[0]
+        for date_str in all_dates:
             date_obj = datetime.strptime(date_str, "%Y-%m-%d").date()
             self.cal.calevent_create(date=date_obj, text="AI助言あり", tags="advice")
         
         self.cal.tag_config('advice', background='lightblue')
 
-from openai import OpenAI
-
 class AIAdviceManager:
     def __init__(self, db_manager, api_key):
         self.db_manager = db_manager
-        self.client = OpenAI(api_key=api_key)
+        self.store = SleepStore(db_manager)
+        self.api_key = api_key
+        self._client = None
+
+    @property
+    def client(self):
+        # openai の読み込みは重いので、最初に助言を生成するときまで遅らせる
+        if self._client is None:
+            from openai import OpenAI
+            self._client = OpenAI(api_key=self.api_key)
+        return self._client
 
     def generate_advice(self, sleep_data, user_profile):
         # AIに送信するプロンプトを作成
         prompt = self._create_prompt(sleep_data, user_profile)
 
         try:
-            response = self.client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {"role": "system", "content": prompt},
-                    {"role": "user", "content": str(sleep_data)}
-                ],
-                max_tokens=1000
-            )
+            with METRICS.timer("ai.chat_completion", "ai") as sample:
+                response = self.client.chat.completions.create(
+                    model="gpt-4o-mini",
+                    messages=[
+                        {"role": "system", "content": prompt},
+                        {"role": "user", "content": str(sleep_data)}
+                    ],
+                    max_tokens=1000
+                )
+                sample['tokens'] = usage_tokens(response)
             return response.choices[0].message.content
         except Exception as e:
             print(f"AIの応答生成中にエラーが発生しました: {str(e)}")
             return None
 
-    def save_advice(self, advice, date):
-        query = "INSERT INTO advice_history (advice, date) VALUES (?, ?)"
-        self.db_manager.execute_query(query, (advice, date))
+    def save_advice(self, advice, date, record_id=None):
+        return self.store.save_advice(advice, date, record_id=record_id)
 
     def get_advice_history(self, limit=5):
-        query = "SELECT advice, date FROM advice_history ORDER BY date DESC LIMIT ?"
-        return self.db_manager.execute_query(query, (limit,))
+        return self.store.advice_history(limit)
 
     def _create_prompt(self, sleep_data, user_profile):
         med_instruction = self._get_med_instruction(user_profile)
@@ -642,22 +566,21 @@ class AIAdviceManager:
             return "中程度の強度でアドバイスを提供してください。"
 
     def get_advice_for_date(self, date):
-        query = "SELECT advice FROM advice_history WHERE date = ?"
         formatted_date = date if isinstance(date, str) else date.strftime("%Y-%m-%d")
-        result = self.db_manager.execute_query(query, (formatted_date,))
-        advice = result[0][0] if result else None
-        print(f"Debug: get_advice_for_date called for {formatted_date}, result: {advice}")
-        return advice
+        return self.store.latest_advice(formatted_date)
     
 import tkinter as tk
 from datetime import datetime, timedelta
 
+METRICS_FLUSH_MS = 5 * 60 * 1000
+
 class SleepTherapyApp:
-    def __init__(self, master):
+    def __init__(self, master, user_id=1):
         self.master = master
         
         # 各マネージャーのインスタンス化
-        self.db_manager = DatabaseManager()
+        self.db_manager = DatabaseManager(user_id=user_id)
+        self.store = SleepStore(self.db_manager)
         self.user_profile_manager = UserProfileManager(self.db_manager)
         self.sleep_record_manager = SleepRecordManager(self.db_manager)
         self.ui_manager = UIManager(master)
@@ -667,9 +590,9 @@ class SleepTherapyApp:
         self.db_manager.create_tables()
 
         # ユーザープロフィールの読み込み
-        self.current_user = self.user_profile_manager.get_user_profile(1)  # 仮のユーザーID
+        self.current_user = self.user_profile_manager.get_user_profile(user_id)
         if not self.current_user:
-            self.current_user = self.user_profile_manager.create_new_profile(1)
+            self.current_user = self.user_profile_manager.create_new_profile(user_id)
 
         # UIの初期化
         self.ui_manager.create_main_window()
@@ -677,9 +600,25 @@ class SleepTherapyApp:
 
         # 最近の履歴を表示
         self.show_recent_history()
-    
-        print("All advice history:")
-        print(self.ai_advice_manager.get_advice_history())
+
+        self.master.after(METRICS_FLUSH_MS, self.schedule_metrics_flush)
+        # 診断ウィンドウはメニューに出さず、Ctrl+Shift+D で開く
+        self.master.bind_all("<Control-Shift-D>", lambda event: DiagnosticsWindow(self.master, METRICS))
+
+    def flush_metrics(self):
+        # 計測値を perf_metrics テーブルに書き、指定があれば Prometheus 形式のファイルも更新する
+        try:
+            with self.db_manager.transaction() as conn:
+                METRICS.flush_to_table(conn)
+            path = os.environ.get(PROMETHEUS_ENV)
+            if path:
+                METRICS.write_prometheus(path)
+        except (sqlite3.Error, OSError) as e:
+            print(f"Metrics flush error: {e}")
+
+    def schedule_metrics_flush(self):
+        self.flush_metrics()
+        self.master.after(METRICS_FLUSH_MS, self.schedule_metrics_flush)
 
     def bind_events(self):
         self.ui_manager.profile_button.config(command=self.show_user_profile)
@@ -697,21 +636,9 @@ class SleepTherapyApp:
         self.ui_manager.show_message("プロフィールが更新されました。")
 
     def show_cbt_info(self):
-        # CBT情報をデータベースから取得
-        cbt_content = self.db_manager.execute_query("SELECT content FROM cbt_info WHERE id = 1")
-        
-        if not cbt_content:
-            # CBT情報がない場合、デフォルトの内容を設定
-            default_content = "不眠症の認知行動療法に関する情報をここに入力してください。"
-            self.db_manager.execute_query("INSERT INTO cbt_info (id, content) VALUES (1, ?)", (default_content,))
-            cbt_content = default_content
-        else:
-            cbt_content = cbt_content[0][0]  # 結果はリストのタプルで返されるため
-
-        def save_cbt_content(new_content):
-            self.db_manager.execute_query("UPDATE cbt_info SET content = ? WHERE id = 1", (new_content,))
-
-        self.ui_manager.show_cbt_info(cbt_content, save_cbt_content)
+        # CBT情報をデータベースから取得（ない場合はデフォルトの内容を保存して使う）
+        cbt_content = self.store.cbt_info("不眠症の認知行動療法に関する情報をここに入力してください。")
+        self.ui_manager.show_cbt_info(cbt_content, self.store.save_cbt_info)
 
     def show_ai_advice_for_record(self, date):
         advice = self.ai_advice_manager.get_advice_for_date(date)
@@ -778,13 +705,13 @@ class SleepTherapyApp:
             'sleep_preparation': self.sleep_preparation_data.get('preparation_text', ''),
             'sleep_reflection': feedback_data['reflection']
         }
-        self.sleep_record_manager.save_sleep_record(record)
-        self.generate_ai_advice(record)
+        record_id = self.sleep_record_manager.save_sleep_record(record)
+        self.generate_ai_advice(record, record_id)
 
-    def generate_ai_advice(self, sleep_record):
+    def generate_ai_advice(self, sleep_record, record_id=None):
         advice = self.ai_advice_manager.generate_advice(sleep_record, self.current_user)
         if advice:
-            self.ai_advice_manager.save_advice(advice, sleep_record['date'])
+            self.ai_advice_manager.save_advice(advice, sleep_record['date'], record_id)
             self.ui_manager.show_ai_advice(advice, sleep_record['date'])
             self.refresh_calendar()  # カレンダーを更新
         else:
@@ -803,8 +730,8 @@ class SleepTherapyApp:
         self.refresh_calendar()
     
     def refresh_calendar(self):
-    # データベースから全ての日付を取得
-        all_dates = self.db_manager.execute_query("SELECT DISTINCT date FROM advice_history")
+        # 助言のある全ての日付を取得
+        all_dates = self.store.advice_dates(date.min, date.max)
         
         # UIManagerのrefresh_calendarメソッドを呼び出す
         self.ui_manager.refresh_calendar(all_dates)
@@ -812,7 +739,7 @@ class SleepTherapyApp:
     def on_date_selected(self, event):
         selected_date = self.history_calendar.get_date()
         formatted_date = selected_date if isinstance(selected_date, str) else selected_date.strftime("%Y-%m-%d")
-        records = self.sleep_record_manager.get_sleep_records(formatted_date, formatted_date)
+        records = self.sleep_record_manager.get_records_with_advice(formatted_date, formatted_date)
 
         # 履歴を表示するセクションをクリア
         for widget in self.history_info_frame.winfo_children():
@@ -821,8 +748,8 @@ class SleepTherapyApp:
         if records:
             self.ui_manager.create_record_display(self.history_info_frame, records[0])
 
-            # AIの助言を直接取得
-            advice = self.ai_advice_manager.get_advice_for_date(formatted_date)
+            # 記録と一緒に読んだ助言を使う
+            advice = records[0].advice
             if advice:
                 self.ui_manager.show_ai_advice(advice, formatted_date)
             else:
@@ -830,8 +757,6 @@ class SleepTherapyApp:
         else:
             ttk.Label(self.history_info_frame, text="この日の記録はありません。").pack()
 
-        print(f"Debug: Selected date: {formatted_date}, Advice: {advice if advice else 'None'}")
-
     def get_period_advice(self, period):
         end_date = datetime.now().date()
         if period == "week":
@@ -862,4 +787,6 @@ class SleepTherapyApp:
 if __name__ == "__main__":
     root = tk.Tk()
     app = SleepTherapyApp(root)
-    root.mainloop()
\ No newline at end of file
+    root.mainloop()
+    app.flush_metrics()
+    app.db_manager.close()
\ No newline at end of file
@@ -1,89 +1,67 @@
+from startup_profile import StartupProfile
+
+STARTUP = StartupProfile()  # 他のインポートより先に計測を始める
+
+import argparse
+import os
 import sqlite3
-from datetime import datetime, timedelta
+import time
+from datetime import date, datetime, timedelta
 import asyncio
 import threading
 import tkinter as tk
-from tkinter import ttk, messagebox, scrolledtext
-from tkcalendar import Calendar
+from tkinter import ttk, filedialog, messagebox, scrolledtext
+from advice_cache import AdviceCache
+from advice_jobs import AdviceJobExecutor, AdviceStream, AdviceStreamCancelled
+from advice_queue import AdviceQueued, CircuitBreaker, CircuitOpenError, OfflineAdviceQueue
+from change_feed import ChangeFeed
+from diagnostics_window import DiagnosticsWindow
+from diary_importer import DiaryImporter
+from diary_search import DiarySearch
+from perf_metrics import METRICS, PROMETHEUS_ENV, usage_tokens
+from prompt_encoder import PromptEncoder
+from sleep_aggregates import PeriodStats
+from sleep_restriction import SleepWindowCalculator
+from sleep_store import DatabaseManager, SleepStore, StoredRecord
+from sleep_time_utils import duration_minutes, format_duration, parse_minutes, to_epoch
+from search_panel import SearchPanel
+
+STARTUP.mark("imports")
+
+
+class AdviceDateIndex:
+    """助言のある日付を表示中の範囲だけ読み込み、保存・削除の差分を購読者（カレンダー）に通知する。
+
+    通知はメインスレッドから呼ぶこと。購読者は (追加された日付, 削除された日付) を受け取る。
+    """
 
+    def __init__(self, db_manager):
+        self.db_manager = db_manager
+        self.store = SleepStore(db_manager)
+        self.subscribers = []
 
-class DatabaseManager:
-    def __init__(self, db_name='data2.db'):
-        self.db_name = db_name
+    def subscribe(self, callback):
+        self.subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        if callback in self.subscribers:
+            self.subscribers.remove(callback)
+
+    def dates_in_range(self, start_date, end_date):
+        return self.store.advice_dates(start_date, end_date)
+
+    def advice_saved(self, date):
+        self._notify({str(date)}, set())
+
+    def advice_deleted(self, date):
+        # 同じ日の助言が他に残っていれば印は消さない
+        if not self.dates_in_range(date, date):
+            self._notify(set(), {str(date)})
+
+    def _notify(self, added, removed):
+        for callback in list(self.subscribers):
+            callback(added, removed)
 
-    def execute_query(self, query, params=None):
-        conn = None
-        try:
-            conn = sqlite3.connect(self.db_name)
-            cursor = conn.cursor()
-            if params:
-                cursor.execute(query, params)
-            else:
-                cursor.execute(query)
-            conn.commit()
-            return cursor.fetchall()
-        except sqlite3.Error as e:
-            print(f"Database error: {e}")
-            return None
-        finally:
-            if conn:
-                conn.close()
-
-    def create_tables(self):
-        sleep_records_table = '''CREATE TABLE IF NOT EXISTS sleep_records
-            (id INTEGER PRIMARY KEY AUTOINCREMENT,
-            date TEXT,
-            sleep_time TEXT,
-            wake_time TEXT,
-            sleep_duration TEXT,
-            sleep_satisfaction INTEGER,
-            sleep_quality INTEGER,
-            sleep_dissatisfaction INTEGER,
-            sleep_anxiety INTEGER,
-            sleep_preparation TEXT,
-            sleep_reflection TEXT,
-            advice_history_id INTEGER)'''
-
-        advice_history_table = '''CREATE TABLE IF NOT EXISTS advice_history
-            (id INTEGER PRIMARY KEY,
-            advice TEXT,
-            date TEXT,
-            FOREIGN KEY(id) REFERENCES sleep_records(id))'''
-
-        user_profiles_table = '''CREATE TABLE IF NOT EXISTS user_profiles
-            (id INTEGER PRIMARY KEY AUTOINCREMENT,
-            nickname TEXT,
-            sleep_medication TEXT,
-            medication_reduction TEXT,
-            advice_intensity TEXT)'''
-
-        cbt_info_table = '''CREATE TABLE IF NOT EXISTS cbt_info
-            (id INTEGER PRIMARY KEY,
-            content TEXT)'''
-
-        self.execute_query(sleep_records_table)
-        self.execute_query(advice_history_table)
-        self.execute_query(user_profiles_table)
-        self.execute_query(cbt_info_table)
-        print("All tables created successfully")
-    
-    @staticmethod
-    def get_advice_for_recent_records(conn):
-        seven_days_ago = (datetime.now() - timedelta(days=7)).strftime("%Y-%m-%d")
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT sr.*, ah.advice 
-            FROM sleep_records sr
-            LEFT JOIN advice_history ah ON sr.date = ah.date
-            WHERE sr.date >= ?
-            ORDER BY sr.date DESC
-        """, (seven_days_ago,))
-        return cursor.fetchall()
-    
-    def get_all_advice_dates(self):
-        query = "SELECT DISTINCT date FROM advice_history"
-        result = self.execute_query(query)
-        return [date[0] for date in result]
 
 class UserProfileManager:
     def __init__(self, db_manager):
@@ -136,36 +114,54 @@ class UserProfileManager:
             profile['advice_intensity']
         ])
 
+# sleep_records の1行とその日の助言（列は sleep_store.SLEEP_RECORD_COLUMNS）
+RecordWithAdvice = StoredRecord
+
 class SleepRecordManager:
     def __init__(self, db_manager, ai_advice_manager):
         self.db_manager = db_manager
         self.ai_advice_manager = ai_advice_manager
+        self.store = SleepStore(db_manager)
+        self.period_stats = PeriodStats(db_manager)
+        # この画面で保存・削除してキャッシュに反映済みの記録のID（チェンジフィードで二重に反映しない）
+        self.applied_ids = set()
 
     def get_sleep_records(self, start_date, end_date):
-        query = '''SELECT * FROM sleep_records 
-                   WHERE date BETWEEN ? AND ? 
-                   ORDER BY date DESC'''
-        return self.db_manager.execute_query(query, (start_date, end_date))
+        return self.store.sleep_records(start_date, end_date)
 
     def save_sleep_record(self, record):
-        query = '''INSERT INTO sleep_records 
-                   (date, sleep_time, wake_time, sleep_duration, 
-                   sleep_satisfaction, sleep_quality, sleep_dissatisfaction, sleep_anxiety,
-                   sleep_preparation, sleep_reflection)
-                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'''
-        self.db_manager.execute_query(query, (
-            record['date'],
-            record['sleep_time'],
-            record['wake_time'],
-            record['sleep_duration'],
-            record['sleep_satisfaction'],
-            record['sleep_quality'],
-            record['sleep_dissatisfaction'],
-            record['sleep_anxiety'],
-            record['sleep_preparation'],
-            record['sleep_reflection']
+        # 集計用にエポック秒と分単位の睡眠時間も保存する。表示用の文字列への変換は表示時に行う
+        sleep_epoch = record.get('sleep_epoch', to_epoch(record['sleep_time']))
+        wake_epoch = record.get('wake_epoch', to_epoch(record['wake_time']))
+        minutes = record.get('duration_minutes', duration_minutes(sleep_epoch, wake_epoch))
+        record_id = self.store.save_record(dict(
+            record,
+            sleep_epoch=sleep_epoch,
+            wake_epoch=wake_epoch,
+            duration_minutes=minutes
         ))
+        self.applied_ids.add(record_id)
+        self.ai_advice_manager.invalidate_analytics()
+        self.ai_advice_manager.record_night(record, sleep_epoch, wake_epoch)
         print(f"Saved sleep record for date: {record['date']}")
+        return record_id
+
+    def get_duration_summary(self, start_date, end_date):
+        # 記録の行は読まず、トリガーで保たれている日・週・月の集計（sleep_period_stats）を組み合わせる
+        summary = self.period_stats.summary(start_date, end_date)
+        duration = summary['metrics']['duration_minutes'] if summary else None
+        if not duration or not duration['count']:
+            return None
+        return {
+            'count': duration['count'],
+            'average_minutes': duration['mean'],
+            'min_minutes': duration['min'],
+            'max_minutes': duration['max']
+        }
+
+    def count_records(self, start_date, end_date):
+        summary = self.period_stats.summary(start_date, end_date)
+        return summary['count'] if summary else 0
 
     def get_recent_records(self, days=7):
         end_date = datetime.now().strftime("%Y-%m-%d")
@@ -174,54 +170,39 @@ class SleepRecordManager:
         return records if records else []
     
     def get_recent_records_with_advice(self, days=7, user_profile=None):
-        recent_records = self.get_recent_records(days)
-        advice_list = []
-
-        for record in recent_records:
-            advice = self.fetch_advice_for_record(record)
-            record_with_advice = record + (advice,)  # 助言をタプルに追加
-            advice_list.append(record_with_advice)
+        end_date = datetime.now().strftime("%Y-%m-%d")
+        start_date = (datetime.now() - timedelta(days=days)).strftime("%Y-%m-%d")
+        return self.get_records_with_advice(start_date, end_date)
 
-        return advice_list
+    def get_records_with_advice(self, start_date, end_date):
+        # 記録と助言を1回の結合クエリで取得する。同じ日に複数の助言がある場合は最新のものを使う
+        return self.store.records_between(start_date, end_date)
 
     def fetch_advice_for_record(self, record):
-        record_date = record[1]  # recordのdateフィールド
-        advice_history = self.db_manager.execute_query(
-            "SELECT advice FROM advice_history WHERE date = ?",
-            (record_date,)
-        )
-        return advice_history[0][0] if advice_history else None
+        return self.store.latest_advice(record[1])  # recordのdateフィールド
 
     def delete_record(self, record_id):
-        query = "DELETE FROM sleep_records WHERE id = ?"
-        self.db_manager.execute_query(query, (record_id,))
+        self.store.delete_record(record_id)
+        self.applied_ids.add(record_id)
+        self.ai_advice_manager.invalidate_analytics()
+        self.ai_advice_manager.reset_sleep_window()
         print(f"Deleted sleep record with ID: {record_id}")
 
     def update_advice_id(self, sleep_record_id, advice_id):
-        query = "UPDATE sleep_records SET advice_history_id = ? WHERE id = ?"
-        self.db_manager.execute_query(query, (advice_id, sleep_record_id))
+        self.store.link_advice(sleep_record_id, advice_id)
         print(f"Updated advice ID for sleep record: {sleep_record_id}")
 
     def calculate_sleep_duration(self, sleep_time, wake_time):
-        time_format = "%Y-%m-%d %H:%M:%S"
-
-        try:
-            sleep_datetime = datetime.strptime(sleep_time, time_format)
-            wake_datetime = datetime.strptime(wake_time, time_format)
-        except ValueError as e:
-            return f"無効な時間形式: {e}"
-
-        if wake_datetime <= sleep_datetime:
-            wake_datetime += timedelta(days=1)  # 起床時間が前日であれば調整
-
-        duration = wake_datetime - sleep_datetime
-        hours, remainder = divmod(duration.total_seconds(), 3600)
-        minutes, _ = divmod(remainder, 60)
-        return f"{int(hours)}時間{int(minutes)}分"
+        sleep_epoch = to_epoch(sleep_time)
+        wake_epoch = to_epoch(wake_time)
+        if sleep_epoch is None or wake_epoch is None:
+            return f"無効な時間形式: {sleep_time}, {wake_time}"
+        return format_duration(duration_minutes(sleep_epoch, wake_epoch))
 
 class UIManager:
     def __init__(self, master):
         self.master = master
+        self.recent_header = None
         self.create_main_window()
 
     def create_main_window(self):
@@ -263,6 +244,12 @@ class UIManager:
         self.history_button = ttk.Button(top_frame, text="睡眠履歴を表示")
         self.history_button.pack(side="left", padx=10)
 
+        self.search_button = ttk.Button(top_frame, text="記録を検索")
+        self.search_button.pack(side="left", padx=10)
+
+        self.import_button = ttk.Button(top_frame, text="過去の日記を取り込む")
+        self.import_button.pack(side="left", padx=10)
+
         # 時間入力部分
         self.create_sleep_input_fields()
 
@@ -270,6 +257,21 @@ class UIManager:
         self.info_label = ttk.Label(self.main_frame, text="")
         self.info_label.pack(pady=10)
 
+        # 睡眠制限法の計算結果
+        sleep_window_frame = ttk.LabelFrame(self.main_frame, text="睡眠時間の調整の目安")
+        sleep_window_frame.pack(fill="x", padx=10, pady=5)
+        self.sleep_window_label = ttk.Label(sleep_window_frame, text="", wraplength=700, justify="left")
+        self.sleep_window_label.pack(anchor="w", padx=5, pady=5)
+
+    def show_sleep_window(self, lines):
+        self.sleep_window_label.config(text="\n".join(lines))
+
+    def format_record_duration(self, record):
+        # duration_minutes（record[14]）から表示用の文字列を作る。変換できなかった古い行は保存済みの文字列を使う
+        if len(record) > 14 and record[14] is not None:
+            return format_duration(record[14])
+        return record[4]
+
     def on_frame_configure(self, event=None):
         self.canvas.configure(scrollregion=self.canvas.bbox("all"))
 
@@ -303,77 +305,98 @@ class UIManager:
         self.wake_button = ttk.Button(wake_frame, text="起床")
         self.wake_button.grid(row=0, column=3, padx=5)
 
-    def show_recent_history(self, recent_records, delete_callback):
-        for widget in self.history_content.winfo_children():
-            widget.destroy()
-
-        ttk.Label(self.history_content, text="直近7日の履歴データ").pack()
-
-        if not recent_records:
-            ttk.Label(self.history_content, text="最近の履歴はありません。").pack()
-            return
-
+    def show_recent_history(self, recent_records, delete_callback, show_advice_callback):
+        # 表示中の行を記録IDで管理し、新しい一覧との差分（追加・削除・内容の変化）だけをウィジェットに反映する
+        if self.recent_header is None or not self.recent_header.winfo_exists():
+            for widget in self.history_content.winfo_children():
+                widget.destroy()
+            self.recent_header = ttk.Label(self.history_content, text="直近7日の履歴データ")
+            self.recent_header.pack()
+            self.recent_empty_label = ttk.Label(self.history_content, text="最近の履歴はありません。")
+            self.recent_rows = {}
+            self.recent_order = []
+
+        new_ids = [record[0] for record in recent_records]
+        new_id_set = set(new_ids)
+        changed = False
+
+        for record_id in [i for i in self.recent_order if i not in new_id_set]:
+            row = self.recent_rows.pop(record_id)
+            row['frame'].destroy()
+            row['separator'].destroy()
+            changed = True
+        kept_order = [i for i in self.recent_order if i in new_id_set]
+
+        # 残った行の並びが変わっていなければ、新しい行を前後の行の間に差し込むだけで済む
+        repack = kept_order != [i for i in new_ids if i in self.recent_rows]
+        previous = self.recent_header
         for record in recent_records:
-            self.create_recent_record_display(self.history_content, record, delete_callback)
-
-        self.on_frame_configure()
+            row = self.recent_rows.get(record[0])
+            if row is None:
+                row = self.create_recent_record_display(self.history_content, record, delete_callback, show_advice_callback)
+                self.recent_rows[record[0]] = row
+                self.pack_recent_row(row, previous)
+                changed = True
+            else:
+                if row['record'] != record:
+                    self.update_recent_record_display(row, record)
+                    changed = True
+                if repack:
+                    self.pack_recent_row(row, previous)
+            previous = row['separator']
+        self.recent_order = new_ids
+
+        if recent_records:
+            self.recent_empty_label.pack_forget()
+        elif not self.recent_empty_label.winfo_manager():
+            self.recent_empty_label.pack(after=self.recent_header)
+            changed = True
+
+        if changed or repack:
+            self.on_frame_configure()
+
+    def pack_recent_row(self, row, previous):
+        row['frame'].pack(fill="x", expand=True, pady=5, after=previous)
+        row['separator'].pack(fill='x', pady=5, after=row['frame'])
 
     def create_recent_record_display(self, parent_frame, record, delete_callback, show_advice_callback):
         record_frame = ttk.Frame(parent_frame)
-        record_frame.pack(fill="x", expand=True, pady=5)
 
         info_frame = ttk.Frame(record_frame)
         info_frame.pack(side="left", fill="x", expand=True)
 
-        ttk.Label(info_frame, text=f"日付: {record[1]}", wraplength=550).pack(anchor="w")
-        ttk.Label(info_frame, text=f"就寝時間: {record[2]}", wraplength=550).pack(anchor="w")
-        ttk.Label(info_frame, text=f"起床時間: {record[3]}", wraplength=550).pack(anchor="w")
-        ttk.Label(info_frame, text=f"睡眠時間: {record[4]}", wraplength=550).pack(anchor="w")
+        labels = []
+        for _ in range(4):
+            label = ttk.Label(info_frame, wraplength=550)
+            label.pack(anchor="w")
+            labels.append(label)
+
+        row = {
+            'frame': record_frame,
+            'labels': labels,
+            'separator': ttk.Separator(parent_frame, orient='horizontal'),
+            'record': None,
+        }
 
         button_frame = ttk.Frame(record_frame)
         button_frame.pack(side="right", padx=5)
 
-        ttk.Button(button_frame, text="削除", command=lambda: delete_callback(record[0])).pack(side="top", pady=2)
-        ttk.Button(button_frame, text="AI助言を見る", command=lambda: show_advice_callback(record[1])).pack(side="top", pady=2)
-
-        ttk.Separator(parent_frame, orient='horizontal').pack(fill='x', pady=5)
-    
-    def show_recent_history(self, recent_records, delete_callback, show_advice_callback):
-        print("Entering UIManager.show_recent_history method")
-        for widget in self.history_content.winfo_children():
-            widget.destroy()
-
-        ttk.Label(self.history_content, text="直近7日の履歴データ").pack()
-
-        if not recent_records:
-            ttk.Label(self.history_content, text="最近の履歴はありません。").pack()
-            return
-
-        for record in recent_records:
-            print(f"Creating display for record: {record[1]}")
-            self.create_recent_record_display(self.history_content, record, delete_callback, show_advice_callback)
+        ttk.Button(button_frame, text="削除", command=lambda: delete_callback(row['record'][0])).pack(side="top", pady=2)
+        ttk.Button(button_frame, text="AI助言を見る", command=lambda: show_advice_callback(row['record'][1])).pack(side="top", pady=2)
 
-        self.on_frame_configure()
-        print("Exiting UIManager.show_recent_history method")
-    
-    def show_advice_for_record(self, record):
-        advice = self.fetch_advice_for_record(record)  # 電話先でのアドバイス取得
-        self.show_ai_advice(advice, record[1])  # 日付を使って助言を表示
+        self.update_recent_record_display(row, record)
+        return row
 
-    def fetch_advice_for_record(self, record):
-        record_date = record[1]  # recordのdateフィールド
-        advice_history = self.db_manager.execute_query(
-            "SELECT advice FROM advice_history WHERE date = ?",
-            (record_date,)
+    def update_recent_record_display(self, row, record):
+        texts = (
+            f"日付: {record[1]}",
+            f"就寝時間: {record[2]}",
+            f"起床時間: {record[3]}",
+            f"睡眠時間: {self.format_record_duration(record)}",
         )
-        return advice_history[0][0] if advice_history else None
-
-    def get_recent_advice(self):
-        # このメソッドはAI助言を取得するためのコールバックに接続されます
-        if hasattr(self, 'recent_records'):
-            for record in self.recent_records:
-                # 各記録に基づいてAIの助言を生成する
-                self.show_ai_advice(record[11], record[1])  # record[11]はadvice_history_idを指す
+        for label, text in zip(row['labels'], texts):
+            label.config(text=text)
+        row['record'] = record
 
     def show_cbt_info(self, content, save_callback):
         cbt_window = tk.Toplevel(self.master)
@@ -509,6 +532,14 @@ class UIManager:
             scale.pack()
             scales[label] = scale
 
+        # 睡眠効率（睡眠時間 / 床上時間）の計算に使う。分からなければ空欄のままで良い
+        ttk.Label(scrollable_frame, text="寝付くまでにかかった時間（分・おおよそで構いません）").pack(pady=(10, 0))
+        latency_entry = ttk.Entry(scrollable_frame, width=8)
+        latency_entry.pack()
+        ttk.Label(scrollable_frame, text="夜中に目が覚めていた時間の合計（分）").pack()
+        awake_entry = ttk.Entry(scrollable_frame, width=8)
+        awake_entry.pack()
+
         ttk.Label(scrollable_frame, text="これらを振り返って思ったこと、思い足りそうな点、その他気になることを入力して下さい", font=("", 12, "bold")).pack(pady=10)
         reflection_text = scrolledtext.ScrolledText(scrollable_frame, height=10, width=50)
         reflection_text.pack(pady=5)
@@ -522,7 +553,9 @@ class UIManager:
                 "快眠度合": scales["快眠度合"].get(),
                 "睡眠への不満度": scales["睡眠への不満度"].get(),
                 "睡眠への不安、焦り、ストレス": scales["睡眠への不安、焦り、ストレス"].get(),
-                "reflection": reflection_text.get("1.0", tk.END).strip()
+                "reflection": reflection_text.get("1.0", tk.END).strip(),
+                "寝付くまでの時間": parse_minutes(latency_entry.get()),
+                "夜中に目覚めていた時間": parse_minutes(awake_entry.get())
             }
             save_callback(feedback_data)
             feedback_window.destroy()
@@ -533,11 +566,13 @@ class UIManager:
         scrollbar.pack(side="right", fill="y")
         pass
 
-    def show_history_window(self, calendar_callback, week_advice_callback, month_advice_callback):
+    def show_history_window(self, calendar_callback, week_advice_callback, month_advice_callback, statistics_callback=None):
         history_window = tk.Toplevel(self.master)
         history_window.title("睡眠履歴とAI助言")
         history_window.geometry("800x700")
 
+        from tkcalendar import Calendar  # 起動を速くするため、履歴を初めて開いたときに読み込む
+
         cal = Calendar(history_window, selectmode='day', date_pattern='y-mm-dd')
         cal.pack(pady=20)
         cal.bind("<<CalendarSelected>>", calendar_callback)
@@ -546,31 +581,139 @@ class UIManager:
                    command=week_advice_callback).pack(pady=10)
         ttk.Button(history_window, text="直近1ヶ月のAI助言を受ける", 
                    command=month_advice_callback).pack(pady=10)
+        if statistics_callback:
+            ttk.Button(history_window, text="睡眠の統計を見る",
+                       command=statistics_callback).pack(pady=10)
 
         info_frame = ttk.Frame(history_window)
         info_frame.pack(fill="both", expand=True, padx=20, pady=20)
 
         return cal, info_frame
 
+    def show_statistics_window(self, sections):
+        statistics_window = tk.Toplevel(self.master)
+        statistics_window.title("睡眠の統計")
+        statistics_window.geometry("600x400")
+
+        for title, lines in sections:
+            ttk.Label(statistics_window, text=title, font=("", 10, "bold")).pack(anchor="w", padx=10, pady=(10, 0))
+            for line in lines or ["記録が2件以上になると表示されます。"]:
+                ttk.Label(statistics_window, text=line, wraplength=560).pack(anchor="w", padx=20)
+
+        ttk.Button(statistics_window, text="閉じる", command=statistics_window.destroy).pack(pady=10)
+
     def show_ai_advice(self, advice, date):
+        advice_window, text_widget = self.open_advice_window(date)
+        self.fill_advice_window(text_widget, advice, date)
+
+    def open_advice_window(self, date, placeholder=None, on_close=None):
+        # 助言の生成中でもすぐに開けるウィンドウ。内容は fill_advice_window で後から埋める
         advice_window = tk.Toplevel(self.master)
         advice_window.title("AIからのアドバイス")
         advice_window.geometry("600x400")
 
         text_widget = scrolledtext.ScrolledText(advice_window, wrap=tk.WORD)
         text_widget.pack(expand=True, fill="both", padx=10, pady=10)
-        
+
+        text_widget.insert(tk.END, f"日付: {date}\n\n")
+        if placeholder:
+            text_widget.insert(tk.END, placeholder)
+
+        text_widget.config(state=tk.DISABLED)
+
+        def close():
+            if on_close:
+                on_close()
+            advice_window.destroy()
+
+        advice_window.protocol("WM_DELETE_WINDOW", close)
+        ttk.Button(advice_window, text="OK", command=close).pack(pady=10)
+        return advice_window, text_widget
+
+    def stream_into_advice_window(self, text_widget, stream, date, interval=100):
+        # 受信済みのトークンを interval ミリ秒ごとにまとめて追記する（1トークンごとに再描画しない）
+        started = False
+
+        def update():
+            nonlocal started
+            if not text_widget.winfo_exists():
+                return
+            text = stream.drain()
+            if text:
+                text_widget.config(state=tk.NORMAL)
+                if not started:
+                    text_widget.delete("1.0", tk.END)
+                    text_widget.insert(tk.END, f"日付: {date}\n\n")
+                    started = True
+                text_widget.insert(tk.END, text)
+                text_widget.see(tk.END)
+                text_widget.config(state=tk.DISABLED)
+            if not stream.closed:
+                self.master.after(interval, update)
+
+        self.master.after(interval, update)
+
+    def fill_advice_window(self, text_widget, advice, date):
+        if not text_widget.winfo_exists():  # 生成中にウィンドウが閉じられた
+            return
+        text_widget.config(state=tk.NORMAL)
+        text_widget.delete("1.0", tk.END)
         text_widget.insert(tk.END, f"日付: {date}\n\n")
         text_widget.insert(tk.END, advice if advice else "この日のアドバイスはありません。")
-        
         text_widget.config(state=tk.DISABLED)
-        ttk.Button(advice_window, text="OK", command=advice_window.destroy).pack(pady=10)
-        pass
 
-    def create_record_display(self, parent_frame, record):
-        for widget in parent_frame.winfo_children():
-            widget.destroy()
+    RECORD_DETAIL_FIELDS = (
+        ("日付", lambda ui, record: record[1]),
+        ("就寝時間", lambda ui, record: record[2]),
+        ("起床時間", lambda ui, record: record[3]),
+        ("睡眠時間", lambda ui, record: ui.format_record_duration(record)),
+        ("睡眠満足度", lambda ui, record: record[5]),
+        ("快眠度合", lambda ui, record: record[6]),
+        ("睡眠への不満度", lambda ui, record: record[7]),
+        ("睡眠への不安、焦り、ストレス", lambda ui, record: record[8]),
+        ("寝る前の振り返り", lambda ui, record: record[9]),
+        ("起床後の振り返り", lambda ui, record: record[10]),
+    )
+
+    def create_record_display(self, parent_frame, record, message=None):
+        # 日付を選ぶたびにキャンバスとラベルを作り直さず、最初に作ったものの文字だけを差し替える
+        detail = getattr(parent_frame, 'record_detail', None)
+        if detail is None:
+            detail = self._build_record_display(parent_frame)
+            parent_frame.record_detail = detail
+
+        if record is None:
+            detail['canvas'].pack_forget()
+            detail['scrollbar'].pack_forget()
+        else:
+            for label, (name, value) in zip(detail['labels'], self.RECORD_DETAIL_FIELDS):
+                label.config(text=f"{name}: {value(self, record)}")
+
+            if record.advice:  # AI助言がある場合（記録と同じクエリで取得済み）
+                detail['advice_button'].config(command=lambda: self.show_ai_advice(record.advice, record.date))
+                detail['advice_heading'].pack(anchor="w")
+                detail['advice_button'].pack(anchor="w", pady=5)
+            else:
+                detail['advice_heading'].pack_forget()
+                detail['advice_button'].pack_forget()
+
+            detail['canvas'].yview_moveto(0)
+            detail['canvas'].pack(side="left", fill="both", expand=True)
+            detail['scrollbar'].pack(side="right", fill="y")
+
+        if message:
+            detail['message'].config(text=message)
+            detail['message'].pack()
+        else:
+            detail['message'].pack_forget()
 
+    def show_record_window(self, record):
+        record_window = tk.Toplevel(self.master)
+        record_window.title(f"睡眠記録 {record[1]}")
+        record_window.geometry("600x400")
+        self.create_record_display(record_window, record)
+
+    def _build_record_display(self, parent_frame):
         canvas = tk.Canvas(parent_frame)
         scrollbar = ttk.Scrollbar(parent_frame, orient="vertical", command=canvas.yview)
         scrollable_frame = ttk.Frame(canvas)
@@ -583,63 +726,209 @@ class UIManager:
         canvas.create_window((0, 0), window=scrollable_frame, anchor="nw")
         canvas.configure(yscrollcommand=scrollbar.set)
 
-        ttk.Label(scrollable_frame, text=f"日付: {record[1]}", wraplength=550).pack(anchor="w")
-        ttk.Label(scrollable_frame, text=f"就寝時間: {record[2]}", wraplength=550).pack(anchor="w")
-        ttk.Label(scrollable_frame, text=f"起床時間: {record[3]}", wraplength=550).pack(anchor="w")
-        ttk.Label(scrollable_frame, text=f"睡眠時間: {record[4]}", wraplength=550).pack(anchor="w")
-        ttk.Label(scrollable_frame, text=f"睡眠満足度: {record[5]}", wraplength=550).pack(anchor="w")
-        ttk.Label(scrollable_frame, text=f"快眠度合: {record[6]}", wraplength=550).pack(anchor="w")
-        ttk.Label(scrollable_frame, text=f"睡眠への不満度: {record[7]}", wraplength=550).pack(anchor="w")
-        ttk.Label(scrollable_frame, text=f"睡眠への不安、焦り、ストレス: {record[8]}", wraplength=550).pack(anchor="w")
-        ttk.Label(scrollable_frame, text=f"寝る前の振り返り: {record[9]}", wraplength=550).pack(anchor="w")
-        ttk.Label(scrollable_frame, text=f"起床後の振り返り: {record[10]}", wraplength=550).pack(anchor="w")
-        
-        if record[11]:  # AI助言がある場合（advice_history_idが存在する場合）
-            ttk.Label(scrollable_frame, text="AIからの助言:", wraplength=550, font=("", 10, "bold")).pack(anchor="w")
-            ttk.Button(scrollable_frame, text="アドバイスを表示", 
-                       command=lambda: self.show_ai_advice(record[11], record[1])).pack(anchor="w", pady=5)
-
-        canvas.pack(side="left", fill="both", expand=True)
-        scrollbar.pack(side="right", fill="y")
+        labels = []
+        for _ in self.RECORD_DETAIL_FIELDS:
+            label = ttk.Label(scrollable_frame, wraplength=550)
+            label.pack(anchor="w")
+            labels.append(label)
+
+        return {
+            'canvas': canvas,
+            'scrollbar': scrollbar,
+            'labels': labels,
+            'advice_heading': ttk.Label(scrollable_frame, text="AIからの助言:", wraplength=550, font=("", 10, "bold")),
+            'advice_button': ttk.Button(scrollable_frame, text="アドバイスを表示"),
+            'message': ttk.Label(parent_frame),
+        }
 
-    def refresh_calendar(self, cal, all_dates):
-        cal.calevent_remove('all')
-        for date_str in all_dates:
-            date_obj = datetime.strptime(date_str, "%Y-%m-%d").date()
-            cal.calevent_create(date=date_obj, text="AI助言あり", tags="advice")
-        cal.tag_config('advice', background='lightblue')
+    def calendar_visible_range(self, cal):
+        # 表示中の月と、その前後にはみ出して表示される週を含む範囲
+        month, year = cal.get_displayed_month()
+        first_day = date(year, month, 1)
+        next_month = date(year + 1, 1, 1) if month == 12 else date(year, month + 1, 1)
+        return first_day - timedelta(days=7), next_month + timedelta(days=14)
+
+    def refresh_calendar(self, cal, dates, start_date, end_date):
+        # 範囲内の印だけを、読み込んだ日付の集合との差分で付け外しする
+        events = self.calendar_events(cal)
+        start, end = str(start_date), str(end_date)
+        shown = {d for d in events if start <= d <= end}
+        self.apply_calendar_changes(cal, dates - shown, shown - dates)
+
+    def apply_calendar_changes(self, cal, added, removed):
+        events = self.calendar_events(cal)
+        for date_str in removed:
+            event_id = events.pop(date_str, None)
+            if event_id is not None:
+                cal.calevent_remove(event_id)
+        for date_str in added:
+            if date_str in events:
+                continue
+            try:
+                date_obj = date.fromisoformat(date_str)
+            except (TypeError, ValueError):
+                continue
+            events[date_str] = cal.calevent_create(date=date_obj, text="AI助言あり", tags="advice")
+
+    def calendar_events(self, cal):
+        if not hasattr(cal, 'advice_events'):
+            cal.advice_events = {}  # 日付の文字列 -> calevent のID
+            cal.tag_config('advice', background='lightblue')
+        return cal.advice_events
 
-from openai import OpenAI
 class AIAdviceManager:
-    def __init__(self, db_manager, api_key):
+    def __init__(self, db_manager, api_key, model="gpt-4o-mini"):
         self.db_manager = db_manager
-        self.client = OpenAI(api_key=api_key)
+        self.store = SleepStore(db_manager)
+        self.api_key = api_key
+        self._client = None
+        self._lazy_lock = threading.Lock()
+        self._analytics = None
+        self._sleep_window = None
+        self.model = model
+        self.cache = AdviceCache(db_manager)
+        self.prompt_encoder = PromptEncoder()
+        # 失敗が続いたらAPIを呼ばずにキューへ回し、接続が戻ったら drain で再送する
+        self.breaker = CircuitBreaker()
+        self.offline_queue = OfflineAdviceQueue(
+            db_manager.connection_manager, self._request_completion, self.store.save_queued_advice,
+            breaker=self.breaker
+        )
+
+    @property
+    def client(self):
+        # openai の読み込みは重いので、最初に助言を生成するときまで遅らせる
+        with self._lazy_lock:
+            if self._client is None:
+                from openai import OpenAI
+                self._client = OpenAI(api_key=self.api_key)
+            return self._client
+
+    @property
+    def analytics(self):
+        # NumPy の読み込みも、最初に統計が必要になるまで遅らせる
+        with self._lazy_lock:
+            if self._analytics is None:
+                from sleep_analytics import SleepAnalytics
+                self._analytics = SleepAnalytics(self.db_manager)
+            return self._analytics
+
+    def invalidate_analytics(self):
+        if self._analytics is not None:
+            self._analytics.invalidate()
+
+    @property
+    def sleep_window(self):
+        # 最初に使うときに保存済みの夜を順に流し込み、以降は record_night で1夜ずつ更新する
+        with self._lazy_lock:
+            if self._sleep_window is None:
+                calculator = SleepWindowCalculator()
+                rows = self.db_manager.execute_query(
+                    '''SELECT date, sleep_epoch, wake_epoch, sleep_latency_minutes, awake_minutes
+                       FROM sleep_records WHERE user_id = ? ORDER BY date, id''',
+                    (self.db_manager.user_id,)
+                ) or []
+                for row in rows:
+                    calculator.add_night(*row)
+                self._sleep_window = calculator
+            return self._sleep_window
+
+    def record_night(self, record, sleep_epoch, wake_epoch):
+        if self._sleep_window is not None:
+            self._sleep_window.add_night(
+                record['date'], sleep_epoch, wake_epoch,
+                record.get('sleep_latency_minutes'), record.get('awake_minutes')
+            )
+
+    def reset_sleep_window(self):
+        # 削除は差分で戻せないので、次に使うときに読み直す
+        with self._lazy_lock:
+            self._sleep_window = None
 
-    def generate_advice(self, sleep_data, user_profile):
+    def generate_advice(self, sleep_data, user_profile, on_chunk=None, queue_date=None, queue_record_id=None):
         # AIに送信するプロンプトを作成
         prompt = self._create_prompt(sleep_data, user_profile)
-
+        # 生のタプルではなく、夜ごとの主要な値と傾向だけを予算内のテキストにまとめて送る
+        user_content = self.prompt_encoder.encode(sleep_data)
+        history_lines = self.analytics.summary_lines(days=90)
+        if history_lines:
+            user_content += "\n直近90日の統計:\n" + "\n".join(history_lines)
+        user_content += "\n睡眠時間の調整（計算済み）:\n" + "\n".join(self.sleep_window.summary_lines())
+
+        # 同じデータ・同じプロフィールへの助言はキャッシュから返す
+        cache_key = self.cache.make_key(self.model, prompt, user_content, user_profile)
+        cached_advice = self.cache.get(cache_key)
+        if cached_advice is not None:
+            return cached_advice
+
+        messages = [
+            {"role": "system", "content": prompt},
+            {"role": "user", "content": user_content}
+        ]
         try:
-            response = self.client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {"role": "system", "content": prompt},
-                    {"role": "user", "content": str(sleep_data)}
-                ],
-                max_tokens=1000
-            )
-            return response.choices[0].message.content
+            if not self.breaker.allow_request():
+                raise CircuitOpenError("AIへの接続に失敗が続いているため、一時的に送信を停止しています")
+            try:
+                if on_chunk:
+                    advice = self._stream_completion(messages, on_chunk)
+                else:
+                    advice = self._request_completion(messages)
+            except AdviceStreamCancelled:
+                self.breaker.record_success()  # 利用者によるキャンセルはエンドポイントの失敗ではない
+                return None
+            except Exception:
+                self.breaker.record_failure()
+                raise
+            self.breaker.record_success()
+            if advice:
+                self.cache.put(cache_key, advice)
+            return advice
         except Exception as e:
             print(f"AIの応答生成中にエラーが発生しました: {str(e)}")
+            if queue_date is not None:
+                # 保存すべき助言は失わずにキューへ入れ、後で自動的に再送する
+                target = {'date': queue_date, 'user_id': self.db_manager.user_id}
+                if queue_record_id is not None:
+                    target['record_id'] = queue_record_id  # 保存した助言をこの記録に結び付ける
+                raise AdviceQueued(self.offline_queue.enqueue(target, messages, e))
             return None
 
-    def save_advice(self, advice, date):
-        query = "INSERT INTO advice_history (advice, date) VALUES (?, ?)"
-        self.db_manager.execute_query(query, (advice, date))
+    def _request_completion(self, messages):
+        with METRICS.timer("ai.chat_completion", "ai") as sample:
+            response = self.client.chat.completions.create(
+                model=self.model,
+                messages=messages,
+                max_tokens=1000
+            )
+            sample['tokens'] = usage_tokens(response)
+        return response.choices[0].message.content
+
+    def _stream_completion(self, messages, on_chunk):
+        # 受信したトークンを順に on_chunk へ渡し、最後に全文を返す
+        with METRICS.timer("ai.chat_completion_stream", "ai") as sample:
+            stream = self.client.chat.completions.create(
+                model=self.model,
+                messages=messages,
+                max_tokens=1000,
+                stream=True
+            )
+            parts = []
+            for chunk in stream:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    parts.append(delta)
+                    on_chunk(delta)
+            # ストリームでは usage が返らないので、受信したチャンク数をトークン数の目安にする
+            sample['tokens'] = len(parts)
+        return "".join(parts)
+
+    def save_advice(self, advice, date, record_id=None):
+        return self.store.save_advice(advice, date, record_id=record_id)
 
     def get_advice_history(self, limit=5):
-        query = "SELECT advice, date FROM advice_history ORDER BY date DESC LIMIT ?"
-        return self.db_manager.execute_query(query, (limit,))
+        return self.store.advice_history(limit)
 
     def _create_prompt(self, sleep_data, user_profile):
         med_instruction = self._get_med_instruction(user_profile)
@@ -656,6 +945,7 @@ class AIAdviceManager:
         1. 指定された起床日の記録に特に注目し、それに対して具体的に応答してください。
         2. ユーザーの感情や経験に共感を示し、肯定的なフィードバックを提供しつつ、認知再構成法の一般論を提案、具体的な手法を示して下さい。
         3. 指定された起床日の記録と過去のパターンを比較し、睡眠制限法の一般論を提案、具体的な手法を示し、改善点や変化を指摘してください。
+           床上時間や就寝・起床時刻の目安は、データの「睡眠時間の調整（計算済み）」の値をそのまま使い、自分で計算し直さないでください。
         4. ユーザーが実践しているルーティンや習慣を肯定的に評価し、刺激統制法の一般論を提案、具体的な手法を示し、その継続を奨励してください。
         5. 睡眠データの傾向に基づいて、具体的な改善点や新たな目標を提案してください。また、マインドフルネス（一般的なリラクゼーションとは区別すること、逆効果が示唆されているため）の一般論を提案、具体的な手法を示して下さい。
         ※2、3、4、5についての認知行動療法における提案は、必ず1日に1つの手法の提案に留めて、それをわかりやすく解説して提案してください。一日の助言に複数の手法を提案をしてユーザーを混乱させないように努めて下さい。
@@ -700,33 +990,154 @@ class AIAdviceManager:
             return "中程度の強度でアドバイスを提供してください。"
 
     def get_advice_for_date(self, date):
-        query = "SELECT advice FROM advice_history WHERE date = ?"
         formatted_date = date if isinstance(date, str) else date.strftime("%Y-%m-%d")
-        result = self.db_manager.execute_query(query, (formatted_date,))
-        advice = result[0][0] if result else None
-        print(f"Debug: get_advice_for_date called for {formatted_date}, result: {advice}")
-        return advice
+        return self.store.latest_advice(formatted_date)
     
 import tkinter as tk
 from datetime import datetime, timedelta
 
+ADVICE_QUEUE_POLL_MS = 60 * 1000
+METRICS_FLUSH_MS = 5 * 60 * 1000
+CHANGE_FEED_POLL_MS = 5 * 1000
+CHANGE_FEED_PRUNE_SECONDS = 10 * 60  # 処理済みの変更を消す間隔（何か処理したときだけ）
+
 # SleepTherapyApp クラス内の関連部分の修正
 class SleepTherapyApp:
-    def __init__(self, master):
+    def __init__(self, master, user_id=1, db_name='data2.db', shard_count=1):
         self.master = master
-        self.db_manager = DatabaseManager()
+        self.db_manager = DatabaseManager(db_name, user_id=user_id, shard_count=shard_count)
         self.ai_advice_manager = AIAdviceManager(self.db_manager, "")
         self.user_profile_manager = UserProfileManager(self.db_manager)
         self.sleep_record_manager = SleepRecordManager(self.db_manager, self.ai_advice_manager)
         self.ui_manager = UIManager(master)
-
-
-        self.db_manager.create_tables()
-        threading.Thread(target=self.load_user_profile, daemon=True).start()
-        self.ui_manager.create_main_window()
+        self.advice_executor = AdviceJobExecutor(master)
+        # 不眠症アプリなど他のプロセスが同じファイルに書いた変更を、チェンジフィードで画面に反映する
+        self.change_feed = ChangeFeed(self.db_manager.connection_manager)
+        self.change_consume_pending = False
+        self.change_feed_pruned_at = time.monotonic()
+        self.change_consumer = f"sleep_app2.user{user_id}"
+        self.advice_date_index = AdviceDateIndex(self.db_manager)
+        self.advice_date_index.subscribe(self.on_advice_dates_changed)
+        self.diary_search = DiarySearch(self.db_manager.execute_query, user_id=user_id)
+        self.current_user = None
+
+        # 先に空のメインウィンドウを描画し、DBの準備と履歴の読み込みはその後に行う
         self.bind_events()
+        STARTUP.mark("shell_built")
+        STARTUP.watch_first_paint(self.master, then=self.finish_startup)
 
+    def finish_startup(self):
+        self.db_manager.create_tables()  # スキーマが最新ならバージョンを確認するだけ
+        STARTUP.mark("schema_checked")
+        self.load_user_profile()
         self.show_recent_history()
+        STARTUP.mark("history_loaded")
+        self.update_sleep_window_panel()
+        # 画面は今読み込んだので、それより前の変更は読み飛ばす
+        try:
+            self.change_feed.seek(self.change_consumer)
+        except sqlite3.Error as e:
+            print(f"Database error: {e}")
+        self.master.after(ADVICE_QUEUE_POLL_MS, self.drain_advice_queue)
+        self.master.after(METRICS_FLUSH_MS, self.schedule_metrics_flush)
+        self.master.after(CHANGE_FEED_POLL_MS, self.poll_change_feed)
+        STARTUP.finish(self.master)
+
+    def drain_advice_queue(self):
+        # 保存しておいた助言リクエストを定期的に再送する（ブレーカーが開いている間は何もしない）
+        queue = self.ai_advice_manager.offline_queue
+        if queue.has_due_jobs():
+            self.advice_executor.submit(queue.drain, on_success=self.on_queued_advice_completed)
+        self.master.after(ADVICE_QUEUE_POLL_MS, self.drain_advice_queue)
+
+    def poll_change_feed(self):
+        # 新しい変更があるかは読むだけで確かめ、書き込みのロックを取る consume はワーカーで行う
+        try:
+            if not self.change_consume_pending and self.change_feed.has_changes(self.change_consumer):
+                self.change_consume_pending = True
+                self.advice_executor.submit(self.consume_changes, on_success=self.on_changes_consumed,
+                                            on_error=self.on_changes_consume_failed)
+        except sqlite3.Error as e:
+            print(f"Database error: {e}")
+        finally:
+            self.master.after(CHANGE_FEED_POLL_MS, self.poll_change_feed)
+
+    def consume_changes(self):
+        # ワーカーで実行する。途中で失敗しても受け取った分は返す（カーソルが進んでいない分は次回また届く）
+        changes = []
+        try:
+            self.change_feed.consume(self.change_consumer, changes.extend)
+            if changes and time.monotonic() - self.change_feed_pruned_at >= CHANGE_FEED_PRUNE_SECONDS:
+                self.change_feed.prune()
+                self.change_feed_pruned_at = time.monotonic()
+        except sqlite3.Error as e:
+            print(f"Database error: {e}")
+        return changes
+
+    def on_changes_consumed(self, changes):
+        self.change_consume_pending = False
+        if changes:
+            self.apply_changes(changes)
+
+    def on_changes_consume_failed(self, error):
+        self.change_consume_pending = False
+        print(f"Change feed error: {error}")
+
+    @METRICS.timed("ui.apply_changes")
+    def apply_changes(self, changes):
+        user_id = self.db_manager.user_id
+        applied_ids = self.sleep_record_manager.applied_ids
+        records_changed = False
+        for change in changes:
+            if change.user_id != user_id:
+                continue
+            if change.table_name == 'sleep_records':
+                if change.row_id in applied_ids:
+                    applied_ids.discard(change.row_id)  # この画面の保存・削除は反映済み
+                else:
+                    records_changed = True
+            elif change.table_name == 'advice_history':
+                if change.op == 'delete':
+                    self.advice_date_index.advice_deleted(change.date)
+                else:
+                    self.advice_date_index.advice_saved(change.date)
+            elif change.table_name == 'user_profiles':
+                self.load_user_profile()
+        if records_changed:
+            self.ai_advice_manager.invalidate_analytics()
+            self.ai_advice_manager.reset_sleep_window()
+            self.update_sleep_window_panel()
+        if records_changed or any(change.table_name == 'advice_history' for change in changes):
+            self.show_recent_history()
+
+    def flush_metrics(self):
+        # 計測値を perf_metrics テーブルに書き、指定があれば Prometheus 形式のファイルも更新する
+        try:
+            with self.db_manager.transaction() as conn:
+                METRICS.flush_to_table(conn)
+            path = os.environ.get(PROMETHEUS_ENV)
+            if path:
+                METRICS.write_prometheus(path)
+        except (sqlite3.Error, OSError) as e:
+            print(f"Metrics flush error: {e}")
+
+    def schedule_metrics_flush(self):
+        self.flush_metrics()
+        self.master.after(METRICS_FLUSH_MS, self.schedule_metrics_flush)
+
+    def show_diagnostics(self, event=None):
+        DiagnosticsWindow(self.master, METRICS)
+
+    def on_queued_advice_completed(self, completed):
+        if not completed:
+            return
+        completed = [(target, advice) for target, advice in completed
+                     if target.get('user_id', 1) == self.db_manager.user_id]
+        if not completed:
+            return
+        for target, _ in completed:
+            self.advice_date_index.advice_saved(target['date'])
+        self.ui_manager.show_message(f"保存しておいた{len(completed)}件のAI助言を生成しました。履歴から確認できます。")
 
     def bind_events(self):
         self.ui_manager.profile_button.config(command=self.show_user_profile)
@@ -734,22 +1145,27 @@ class SleepTherapyApp:
         self.ui_manager.sleep_button.config(command=self.record_sleep)  # ここを修正
         self.ui_manager.wake_button.config(command=self.record_wake)
         self.ui_manager.history_button.config(command=self.show_history)
+        self.ui_manager.search_button.config(command=self.show_search)
+        self.ui_manager.import_button.config(command=self.import_diary)
+        # 診断ウィンドウはメニューに出さず、Ctrl+Shift+D で開く
+        self.master.bind_all("<Control-Shift-D>", self.show_diagnostics)
 
     def load_user_profile(self):
-        self.current_user = self.user_profile_manager.get_user_profile(1)
+        user_id = self.db_manager.user_id
+        self.current_user = self.user_profile_manager.get_user_profile(user_id)
         if not self.current_user:
-            self.current_user = self.user_profile_manager.create_new_profile(1)
-        self.master.after(0, self.show_recent_history)
+            self.current_user = self.user_profile_manager.create_new_profile(user_id)
     
+    @METRICS.timed("ui.show_recent_history")
     def show_recent_history(self):
-        print("Entering show_recent_history method")
-        recent_records = self.sleep_record_manager.get_recent_records(days=7)
-        print(f"Retrieved {len(recent_records)} recent records")
+        recent_records = self.sleep_record_manager.get_recent_records_with_advice(days=7)
         self.ui_manager.show_recent_history(recent_records, self.delete_record, self.show_ai_advice_for_record)
-        print("Exiting show_recent_history method")
+
+    @METRICS.timed("ui.update_sleep_window_panel")
+    def update_sleep_window_panel(self):
+        self.ui_manager.show_sleep_window(self.ai_advice_manager.sleep_window.summary_lines())
 
     def show_ai_advice_for_record(self, date):
-        print(f"Showing AI advice for date: {date}")
         advice = self.ai_advice_manager.get_advice_for_date(date)  # この行を修正
         if advice:
             self.ui_manager.show_ai_advice(advice, date)
@@ -770,19 +1186,9 @@ class SleepTherapyApp:
         self.ui_manager.show_message("プロフィールが更新されました。")
 
     def show_cbt_info(self):
-        cbt_content = self.db_manager.execute_query("SELECT content FROM cbt_info WHERE id = 1")
-        
-        if not cbt_content:
-            default_content = "不眠症の認知行動療法に関する情報をここに入力してください。"
-            self.db_manager.execute_query("INSERT INTO cbt_info (id, content) VALUES (1, ?)", (default_content,))
-            cbt_content = default_content
-        else:
-            cbt_content = cbt_content[0][0]
-
-        def save_cbt_content(new_content):
-            self.db_manager.execute_query("UPDATE cbt_info SET content = ? WHERE id = 1", (new_content,))
-
-        self.ui_manager.show_cbt_info(cbt_content, save_cbt_content)
+        store = self.sleep_record_manager.store
+        cbt_content = store.cbt_info("不眠症の認知行動療法に関する情報をここに入力してください。")
+        self.ui_manager.show_cbt_info(cbt_content, store.save_cbt_info)
 
     def show_sleep_preparation(self):
         self.ui_manager.show_sleep_preparation_window(self.save_sleep_preparation)
@@ -801,8 +1207,6 @@ class SleepTherapyApp:
         date_str = self.ui_manager.sleep_date_entry.get()
         time_str = self.ui_manager.sleep_time_entry.get()
         
-        print(f"Debug: date_str = {date_str}, time_str = {time_str}")  # デバッグ用
-        
         if not date_str or not time_str:
             self.ui_manager.show_message("日付と時刻を入力してください。", "error")
             return
@@ -810,11 +1214,9 @@ class SleepTherapyApp:
         try:
             sleep_datetime = datetime.strptime(f"{date_str} {time_str}", "%Y-%m-%d %H:%M")
             self.sleep_time = sleep_datetime.strftime("%Y-%m-%d %H:%M:%S")
-            print(f"Debug: sleep_time set to {self.sleep_time}")  # デバッグ用
             self.ui_manager.show_message(f"就寝時間を記録しました: {self.sleep_time}")
             self.ui_manager.show_sleep_preparation_window(self.save_sleep_preparation)
-        except ValueError as e:
-            print(f"Debug: ValueError - {e}")  # デバッグ用
+        except ValueError:
             self.ui_manager.show_message("無効な日付または時間形式です。YYYY-MM-DD HH:MM の形式で入力してください。", "error")
 
     def record_wake(self):
@@ -834,69 +1236,188 @@ class SleepTherapyApp:
             self.ui_manager.show_message("無効な日付または時間形式です。YYYY-MM-DD HH:MM の形式で入力してください。", "error")
 
     def save_sleep_record(self, feedback_data):
-        sleep_duration = self.sleep_record_manager.calculate_sleep_duration(self.sleep_time, self.wake_time)
+        sleep_epoch = to_epoch(self.sleep_time)
+        wake_epoch = to_epoch(self.wake_time)
+        minutes = duration_minutes(sleep_epoch, wake_epoch)
         record = {
             'date': self.wake_time.split()[0],
             'sleep_time': self.sleep_time,
             'wake_time': self.wake_time,
-            'sleep_duration': sleep_duration,
+            'sleep_duration': format_duration(minutes),  # 旧バージョンのアプリ向けの表示用文字列
+            'sleep_epoch': sleep_epoch,
+            'wake_epoch': wake_epoch,
+            'duration_minutes': minutes,
             'sleep_satisfaction': feedback_data['睡眠の満足度'],
             'sleep_quality': feedback_data['快眠度合'],
             'sleep_dissatisfaction': feedback_data['睡眠への不満度'],
             'sleep_anxiety': feedback_data['睡眠への不安、焦り、ストレス'],
             'sleep_preparation': self.sleep_preparation_data.get('preparation_text', ''),
-            'sleep_reflection': feedback_data['reflection']
+            'sleep_reflection': feedback_data['reflection'],
+            'sleep_latency_minutes': feedback_data.get('寝付くまでの時間'),
+            'awake_minutes': feedback_data.get('夜中に目覚めていた時間')
         }
-        self.sleep_record_manager.save_sleep_record(record)
-        self.generate_ai_advice(record)
-
-    def generate_ai_advice(self, sleep_record):
-        advice = self.ai_advice_manager.generate_advice(sleep_record, self.current_user)
-        if advice:
-            self.ai_advice_manager.save_advice(advice, sleep_record['date'])
-            self.ui_manager.show_ai_advice(advice, sleep_record['date'])
-            self.refresh_calendar()  # カレンダーを更新
-        else:
+        record_id = self.sleep_record_manager.save_sleep_record(record)
+        self.update_sleep_window_panel()
+        self.generate_ai_advice(record, record_id)
+
+    def generate_ai_advice(self, sleep_record, record_id=None):
+        def on_advice(advice):
+            self.ai_advice_manager.save_advice(advice, sleep_record['date'], record_id)
+            self.advice_date_index.advice_saved(sleep_record['date'])  # カレンダーに印を追加
+
+        # ウィンドウを閉じても助言の保存は続ける。API呼び出しに失敗した場合は再試行キューに入る
+        self.run_advice_job(sleep_record, sleep_record['date'], on_advice=on_advice, cancel_on_close=False,
+                            queue_date=sleep_record['date'], queue_record_id=record_id)
+
+    def run_advice_job(self, sleep_data, title, on_advice=None, cancel_on_close=True, queue_date=None,
+                       queue_record_id=None):
+        # API呼び出しはワーカースレッドで行い、助言ウィンドウは先に開いて受信したトークンから順に表示する
+        stream = AdviceStream()
+
+        def on_success(advice):
+            stream.close()
+            stream.drain()  # 全文で置き換えるので未表示のトークンは捨てる
+            if not advice:
+                on_error(None)
+                return
+            if on_advice:
+                on_advice(advice)
+            self.ui_manager.fill_advice_window(text_widget, advice, title)
+
+        def on_error(error):
+            stream.close()
+            if advice_window.winfo_exists():
+                advice_window.destroy()
+            if isinstance(error, AdviceQueued):
+                self.ui_manager.show_message("現在AIに接続できないため、助言のリクエストを保存しました。接続が回復し次第、自動で生成します。")
+                return
             self.ui_manager.show_message("AI助言の生成に失敗しました。", "error")
 
+        def on_close():
+            job.cancel()
+            stream.cancel()
+
+        job = self.advice_executor.submit(
+            self.ai_advice_manager.generate_advice, sleep_data, self.current_user,
+            on_chunk=stream.append, queue_date=queue_date, queue_record_id=queue_record_id,
+            on_success=on_success, on_error=on_error
+        )
+        advice_window, text_widget = self.ui_manager.open_advice_window(
+            title,
+            placeholder="AIの助言を生成しています。しばらくお待ちください…",
+            on_close=on_close if cancel_on_close else None
+        )
+        self.ui_manager.stream_into_advice_window(text_widget, stream, title)
+        return job
+
+    @METRICS.timed("ui.show_history")
     def show_history(self):
         cal, info_frame = self.ui_manager.show_history_window(
             self.on_date_selected,
             lambda: self.get_period_advice("week"),
-            lambda: self.get_period_advice("month")
+            lambda: self.get_period_advice("month"),
+            self.show_sleep_statistics
         )
         self.history_calendar = cal
         self.history_info_frame = info_frame
-        
+        cal.bind("<<CalendarMonthChanged>>", lambda e: self.refresh_calendar())
+
         # カレンダーの更新
         self.refresh_calendar()
 
-    def refresh_calendar(self):
-        all_dates = self.db_manager.get_all_advice_dates()
-        self.ui_manager.refresh_calendar(self.history_calendar, all_dates)
+    def show_search(self):
+        SearchPanel(self.master, self.diary_search, self.open_search_result)
+
+    def import_diary(self):
+        path = filedialog.askopenfilename(
+            title="過去の日記を取り込む",
+            filetypes=[("CSV / JSONL", "*.csv *.jsonl *.json"), ("すべてのファイル", "*.*")]
+        )
+        if not path:
+            return
+        # 取り込みはワーカースレッドで行い、終わったら画面の一覧と集計を読み直す
+        self.advice_executor.submit(
+            DiaryImporter(self.db_manager).import_file, path,
+            on_success=self.on_diary_imported,
+            on_error=lambda e: self.ui_manager.show_message(f"取り込みに失敗しました: {e}", "error")
+        )
+        self.ui_manager.show_message("日記の取り込みを始めました。終わったらお知らせします。")
+
+    def on_diary_imported(self, totals):
+        self.ai_advice_manager.invalidate_analytics()
+        self.ai_advice_manager.reset_sleep_window()
+        self.show_recent_history()
+        self.update_sleep_window_panel()
+        message = f"{totals['imported']}件の記録を取り込みました。"
+        if totals['rejected']:
+            message += f"\n取り込めなかった{totals['rejected']}行は {totals['reject_path']} に書き出しました。"
+        self.ui_manager.show_message(message)
+
+    def open_search_result(self, rowid, kind, date):
+        # 索引の rowid は、記録なら id * 2、助言なら advice_history.id * 2 + 1
+        if kind == 'advice':
+            advice = self.sleep_record_manager.store.advice(rowid // 2)
+            if advice:
+                self.ui_manager.show_ai_advice(advice, date)
+            return
+        record = self.sleep_record_manager.store.record(rowid // 2)
+        if record:
+            self.ui_manager.show_record_window(record)
+        else:
+            self.ui_manager.show_message("この記録は削除されています。")
 
+    def history_calendar_open(self):
+        return hasattr(self, 'history_calendar') and self.history_calendar.winfo_exists()
+
+    @METRICS.timed("ui.refresh_calendar")
+    def refresh_calendar(self):
+        # 表示中の月の範囲だけを読み込む。月を移動したときにも呼ばれる
+        if not self.history_calendar_open():
+            return  # 履歴ウィンドウが開いていない
+        start_date, end_date = self.ui_manager.calendar_visible_range(self.history_calendar)
+        dates = self.advice_date_index.dates_in_range(start_date, end_date)
+        self.ui_manager.refresh_calendar(self.history_calendar, dates, start_date, end_date)
+
+    def on_advice_dates_changed(self, added, removed):
+        if self.history_calendar_open():
+            self.ui_manager.apply_calendar_changes(self.history_calendar, added, removed)
+
+    @METRICS.timed("ui.on_date_selected")
     def on_date_selected(self, event):
         selected_date = self.history_calendar.get_date()
         formatted_date = selected_date if isinstance(selected_date, str) else selected_date.strftime("%Y-%m-%d")
-        records = self.sleep_record_manager.get_sleep_records(formatted_date, formatted_date)
-
-        # 履歴を表示するセクションをクリア
-        for widget in self.history_info_frame.winfo_children():
-            widget.destroy()
+        records = self.sleep_record_manager.get_records_with_advice(formatted_date, formatted_date)
 
+        advice = None
         if records:
-            self.ui_manager.create_record_display(self.history_info_frame, records[0])
-
-            # AIの助言を直接取得
-            advice = self.ai_advice_manager.get_advice_for_date(formatted_date)
+            # 助言は記録と同じクエリで取得済み
+            advice = records[0].advice
+            self.ui_manager.create_record_display(
+                self.history_info_frame, records[0], None if advice else "この日の助言はありません。"
+            )
             if advice:
                 self.ui_manager.show_ai_advice(advice, formatted_date)
-            else:
-                ttk.Label(self.history_info_frame, text="この日の助言はありません。").pack()
         else:
-            ttk.Label(self.history_info_frame, text="この日の記録はありません。").pack()
+            self.ui_manager.create_record_display(self.history_info_frame, None, "この日の記録はありません。")
+
+    def show_sleep_statistics(self):
+        analytics = self.ai_advice_manager.analytics
+        today = datetime.now().date()
+        self.ui_manager.show_statistics_window([
+            ("直近30日", self.duration_summary_lines(today - timedelta(days=29), today)
+                + analytics.summary_lines(days=30)),
+            ("全期間", analytics.summary_lines()),
+        ])
 
-        print(f"Debug: Selected date: {formatted_date}, Advice: {advice if advice else 'None'}")
+    def duration_summary_lines(self, start_date, end_date):
+        summary = self.sleep_record_manager.get_duration_summary(start_date, end_date)
+        if not summary:
+            return []
+        return [
+            f"睡眠時間: 平均{format_duration(round(summary['average_minutes']))}"
+            f"（最短{format_duration(summary['min_minutes'])} / 最長{format_duration(summary['max_minutes'])}、"
+            f"{summary['count']}件）"
+        ]
 
     def get_period_advice(self, period):
         end_date = datetime.now().date()
@@ -905,31 +1426,36 @@ class SleepTherapyApp:
         else:  # month
             start_date = end_date - timedelta(days=30)
 
-        records = self.sleep_record_manager.get_sleep_records(start_date, end_date)
-        if not records:
+        # 記録がない期間は集計テーブルの件数だけで判定し、記録の行を読まない
+        if not self.sleep_record_manager.count_records(start_date, end_date):
             self.ui_manager.show_message(f"選択された期間（{period}）のデータがありません。")
             return
+        records = self.sleep_record_manager.get_records_with_advice(start_date, end_date)
 
-        advice = self.ai_advice_manager.generate_advice(records, self.current_user)
-        if advice:
-            self.ui_manager.show_ai_advice(advice, f"{start_date} から {end_date}")
-        else:
-            self.ui_manager.show_message("AI助言の生成に失敗しました。", "error")
-        pass
+        self.run_advice_job(records, f"{start_date} から {end_date}")
  
     def request_ai_advice(self, record):
-        advice = self.ai_advice_manager.generate_advice(record, self.current_user)
-        if advice:
-            self.ui_manager.show_ai_advice(advice, record['date'])
-        else:
-            self.ui_manager.show_message("AI助言の生成に失敗しました。", "error")
+        self.run_advice_job(record, record['date'])
 
     def delete_record(self, record_id):
         self.sleep_record_manager.delete_record(record_id)
         self.show_recent_history()
+        self.update_sleep_window_panel()
         self.ui_manager.show_message("記録が削除されました。")
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="睡眠改善支援アプリ")
+    parser.add_argument("--user", type=int, default=1, help="利用者のプロフィールID")
+    parser.add_argument("--db", default="data2.db", help="データベースのファイル")
+    parser.add_argument("--shards", type=int, default=1, help="利用者を振り分けるファイルの数")
+    return parser.parse_args()
+
+
 if __name__ == "__main__":
+    args = parse_args()
     root = tk.Tk()
-    app = SleepTherapyApp(root)
+    app = SleepTherapyApp(root, user_id=args.user, db_name=args.db, shard_count=args.shards)
     root.mainloop()
+    app.advice_executor.shutdown()
+    app.flush_metrics()
+    app.db_manager.close()